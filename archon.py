@@ -0,0 +1,467 @@
+"""
+Driver for the STA Archon CCD controller.
+
+The Archon is not a ktl service: it is driven directly over its TCP command
+protocol, and frames are read straight out of its frame buffers. It is kept
+apart from controller.py because it needs numpy, which the ktl controllers
+do not.
+
+archon_simulator.ArchonSimulator stands in for an Archon, for testing and
+benchmarking without the hardware.
+"""
+
+
+import os
+import socket
+import threading
+from time import monotonic, perf_counter, sleep
+
+import numpy as np
+
+import frame_ingest
+import metrics
+import wire_log
+from controller import Controller
+
+
+class ArchonController(Controller):
+    """
+    Driver for an STA Archon CCD controller, over its TCP command protocol.
+
+    Commands are sent as '>xxCOMMAND\\n', where xx is a two hex digit message
+    reference, and answered with '<xx...\\n', or '?xx\\n' if the Archon
+    rejected the command. Frames are read straight out of the Archon frame
+    buffers with FETCH, which answers with binary blocks of 1024 bytes, each
+    prefixed with '<xx:'. The whole reply is received with large socket
+    reads into a preallocated numpy buffer, and the pixel bytes are copied
+    out of it into the frame array in a single strided copy, so a frame is
+    never assembled from byte-strings, and readout runs at the network rate
+    rather than going through a keyword server.
+
+    The exposure is driven through timing script parameters, set with
+    FASTLOADPARAM. Their names depend on the timing script loaded in the
+    Archon, so they can be changed with the parameters argument.
+
+    Parameters
+    ----------
+    ip_port: tuple
+        the ip address and port of the Archon, in the format
+        (<ip address>, <port number>). The Archon listens on port 4242.
+    service_config_dict: dict, optional
+        timing script parameter: value pairs loaded at startup
+    verbose: bool, optional
+        Set to False to turn off print outputs
+    timeout: float, optional
+        Seconds to wait for a reply to a command
+    parameters: dict, optional
+        Names of the timing script parameters used by this class, updating
+        the defaults {'exposures': 'Exposures', 'exposure_time': 'IntMS'}.
+        'exposures' is the number of exposures to take, 'exposure_time' the
+        integration time in milliseconds.
+    poll_interval: float, optional
+        Seconds between FRAME status polls while waiting on an exposure. The
+        Archon does not broadcast its state, so waits have to poll.
+    output_directory: string, optional
+        Where wait_for_frame writes frames, as FITS files named after the
+        Archon frame number, e.g. archon_000042.fits
+
+    Notes
+    -----
+    The Archon does not write files itself. wait_for_frame fetches each
+    frame and writes it to output_directory, so like the other controllers
+    it returns a filename, which run_qe_scan, reduce functions and scan
+    journals can all use. The array just fetched is kept in last_frame.
+    fetch_frame reads a frame without writing it; fetch it before the
+    Archon reuses its buffer, i.e. within two more frames.
+
+    The Archon does not report the values of timing script parameters, so
+    the get methods return the value last written by this class, or None.
+    """
+    # bytes per FETCH block, and the '<xx:' prefix of each block
+    _BLOCK_SIZE = 1024
+    _BLOCK_PREFIX = 4
+    # number of Archon frame buffers
+    _BUFFERS = (1, 2, 3)
+
+    def __init__(self, ip_port, service_config_dict=None, verbose=True, timeout=10.0,
+                 parameters=None, poll_interval=0.01, output_directory='.'):
+        self.verbose = verbose
+        self.output_directory = output_directory
+        # the frame fetched by the latest wait_for_frame
+        self.last_frame = None
+        self.ip_address = ip_port[0]
+        self.port_number = int(ip_port[1])
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.parameters = {'exposures': 'Exposures', 'exposure_time': 'IntMS'}
+        self.parameters.update(parameters or {})
+        # label for this controller in the wire log and metrics
+        self.service_name = 'archon %s:%s' % (self.ip_address, self.port_number)
+
+        self._lock = threading.RLock()
+        self._buffer = bytearray()
+        self._message_ref = 0
+        # FETCH replies are received here, then copied into the frame array
+        self._fetch_buffer = np.empty(0, dtype=np.uint8)
+        # parameter: value pairs as last written, the Archon can't report them
+        self._values = {}
+        # frame number of the newest frame when the latest exposure was started
+        self._start_frame = 0
+
+        self._socket = socket.create_connection((self.ip_address, self.port_number),
+                                                timeout=timeout)
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        if service_config_dict:
+            if verbose:
+                print('Setting up initial configuration ')
+            self.configure(service_config_dict)
+
+    def close(self):
+        """
+        Close the connection to the Archon.
+
+        Returns
+        -------
+        None
+        """
+        with self._lock:
+            self._socket.close()
+
+    def _send(self, command, echo=None):
+        # send a command, return its message reference
+        reference = '%02X' % self._message_ref
+        self._message_ref = (self._message_ref + 1) % 256
+        self._socket.sendall(b'>' + reference.encode() + command.encode() + b'\n')
+        wire_log.record(self.service_name, 'send', command,
+                        echo=self.verbose if echo is None else echo)
+        return reference
+
+    def _recv_into(self, view):
+        # fill a memoryview completely, first from whatever is left in the
+        # line buffer, then straight from the socket
+        filled = min(len(self._buffer), len(view))
+        if filled:
+            view[:filled] = self._buffer[:filled]
+            del self._buffer[:filled]
+        while filled < len(view):
+            received = self._socket.recv_into(view[filled:])
+            if received == 0:
+                raise BrokenPipeError('%s closed connection' % self.service_name)
+            filled += received
+
+    def _recv_line(self):
+        end = self._buffer.find(b'\n')
+        while end < 0:
+            chunk = self._socket.recv(4096)
+            if chunk == b'':
+                raise BrokenPipeError('%s closed connection' % self.service_name)
+            self._buffer += chunk
+            end = self._buffer.find(b'\n')
+        line = bytes(self._buffer[:end])
+        del self._buffer[:end + 1]
+        return line.decode('ascii', errors='replace')
+
+    def _recv_reply(self, reference, command, echo=None):
+        # read the reply to a command, and check it is the one expected
+        line = self._recv_line()
+        wire_log.record(self.service_name, 'recv', line,
+                        echo=self.verbose if echo is None else echo)
+        if line[1:3] != reference:
+            raise RuntimeError('%s: expected reply %s to %s, got %r'
+                               % (self.service_name, reference, command, line))
+        if line[0] == '?':
+            raise RuntimeError('%s rejected command %s' % (self.service_name, command))
+        return line[3:]
+
+    def command(self, command):
+        """
+        Send a command to the Archon, and return its reply.
+
+        Parameters
+        ----------
+        command: string
+            The command without message reference or newline, e.g. 'STATUS'
+
+        Returns
+        -------
+        reply: string
+            The reply without message reference or newline
+
+        Raises
+        ------
+        RuntimeError:
+            If the Archon rejected the command
+        """
+        with self._lock:
+            return self._recv_reply(self._send(command), command)
+
+    def _poll(self, command):
+        # a command sent over and over while waiting, logged but never printed
+        with self._lock:
+            return self._recv_reply(self._send(command, echo=False), command, echo=False)
+
+    def _commands(self, commands):
+        # send several commands before reading any reply, so the batch costs
+        # about one round trip instead of one per command
+        # every reply is read, and the first error raised afterwards
+        with self._lock:
+            references = [self._send(command) for command in commands]
+            replies = []
+            error = None
+            for reference, command in zip(references, commands):
+                try:
+                    replies.append(self._recv_reply(reference, command))
+                except RuntimeError as err:
+                    replies.append(None)
+                    error = error or err
+            if error is not None:
+                raise error
+            return replies
+
+    @staticmethod
+    def _parse_status(reply):
+        # 'KEY=value KEY=value ...' into a dict
+        return dict(item.split('=', 1) for item in reply.split() if '=' in item)
+
+    def status(self):
+        """
+        Return the Archon system status, e.g. temperatures and power.
+
+        Returns
+        -------
+        status: dict
+            STATUS key: value string pairs
+        """
+        return self._parse_status(self.command('STATUS'))
+
+    def frame_status(self):
+        """
+        Return the state of the Archon frame buffers.
+
+        Returns
+        -------
+        frame_status: dict
+            FRAME key: value string pairs, e.g. 'BUF1FRAME', 'BUF1COMPLETE'
+        """
+        return self._parse_status(self._poll('FRAME'))
+
+    def _newest_buffer(self, frame_status, complete=True):
+        # the buffer holding the highest frame number, optionally only
+        # counting buffers that have been completely written
+        newest = None
+        for buffer in self._BUFFERS:
+            if complete and frame_status.get('BUF%iCOMPLETE' % buffer) != '1':
+                continue
+            frame = int(frame_status.get('BUF%iFRAME' % buffer, 0))
+            if newest is None or frame > newest[1]:
+                newest = (buffer, frame)
+        return newest
+
+    def configure(self, keyword_dict, timeout=None):
+        """
+        Load several timing script parameters at once.
+
+        Parameters
+        ----------
+        keyword_dict: dict
+            parameter: value pairs, e.g. {'IntMS': 500}
+        timeout: float, optional
+            Unused, all commands use the connection timeout
+
+        Returns
+        -------
+        None
+        """
+        self._commands(['FASTLOADPARAM %s %s' % (name, value)
+                        for name, value in keyword_dict.items()])
+        self._values.update(keyword_dict)
+
+    def keyword_state(self):
+        # the parameters loaded by this class instance, except the exposure
+        # trigger, which configure would fire
+        return {name: value for name, value in self._values.items()
+                if name != self.parameters['exposures']}
+
+    def expose(self, command):
+        # start or stop exposures, with matching strings as for the Andor
+        valid = {string.casefold() for string in {'None', 'Abort', 'Stop', 'Start'}}
+        if command.casefold() not in valid:
+            raise ValueError('expose: command must be one of %s' % valid)
+        if command.casefold() == 'none':
+            return
+        exposures = self.parameters['exposures']
+        if command.casefold() == 'start':
+            # remember the newest frame, to tell when this exposure's frame is done
+            newest = self._newest_buffer(self.frame_status(), complete=False)
+            self._start_frame = 0 if newest is None else newest[1]
+            self.configure({exposures: 1})
+        else:
+            self.configure({exposures: 0})
+
+    def _wait_for_frame_status(self, condition, timeout=None):
+        # poll FRAME until condition(frame_status) is True
+        deadline = None if timeout is None else monotonic() + timeout
+        while True:
+            frame_status = self.frame_status()
+            if condition(frame_status):
+                return frame_status
+            if deadline is not None and monotonic() >= deadline:
+                raise TimeoutError('timed out after %s s waiting for frame %i'
+                                   % (timeout, self._start_frame + 1))
+            sleep(self.poll_interval)
+
+    def wait_for_readout(self, timeout=None):
+        """
+        Block until the exposure started by expose('Start') has finished
+        integrating, i.e. the Archon has started writing its frame.
+
+        Parameters
+        ----------
+        timeout: float, optional
+            Seconds to wait. None waits forever.
+
+        Returns
+        -------
+        None
+        """
+        start_frame = self._start_frame
+
+        def reading_out(frame_status):
+            newest = self._newest_buffer(frame_status, complete=False)
+            return newest is not None and newest[1] > start_frame
+
+        self._wait_for_frame_status(reading_out, timeout=timeout)
+
+    def wait_for_frame(self, timeout=None, out=None):
+        """
+        Block until the frame of the exposure started by expose('Start') has
+        been read out, fetch it and write it to a FITS file.
+
+        Parameters
+        ----------
+        timeout: float, optional
+            Seconds to wait. None waits forever.
+        out: numpy.ndarray, optional
+            Array to fetch the frame into, see fetch_frame
+
+        Returns
+        -------
+        filename: string
+            The FITS file in output_directory. The frame itself is kept in
+            last_frame.
+        """
+        start_frame = self._start_frame
+
+        def read_out(frame_status):
+            newest = self._newest_buffer(frame_status)
+            return newest is not None and newest[1] > start_frame
+
+        frame_status = self._wait_for_frame_status(read_out, timeout=timeout)
+        buffer, frame_number = self._newest_buffer(frame_status)
+        frame = self.fetch_frame(buffer, out=out, frame_status=frame_status)
+        filename = os.path.join(self.output_directory, 'archon_%06i.fits' % frame_number)
+        header = {'FRAMENUM': frame_number}
+        exposure_time = self.get_exposure_time()
+        if exposure_time is not None:
+            header['EXPTIME'] = exposure_time
+        frame_ingest.write_fits_frame(filename, frame, header)
+        self.last_frame = frame
+        return filename
+
+    def fetch_frame(self, buffer=None, out=None, frame_status=None):
+        """
+        Read a frame out of an Archon frame buffer.
+
+        The buffer is locked, fetched in one FETCH command, and unlocked.
+
+        Parameters
+        ----------
+        buffer: int, optional
+            Frame buffer 1, 2 or 3. Defaults to the newest complete frame.
+        out: numpy.ndarray, optional
+            A C contiguous array of the frame shape and dtype to receive the
+            frame, e.g. one reused for every frame of a scan. If None, a new
+            array is allocated.
+        frame_status: dict, optional
+            A FRAME reply from just before, to save asking again
+
+        Returns
+        -------
+        frame: numpy.ndarray
+            The frame, shape (height, width), dtype uint16 or uint32
+            depending on the buffer sample size
+        """
+        if frame_status is None:
+            frame_status = self.frame_status()
+        if buffer is None:
+            newest = self._newest_buffer(frame_status)
+            if newest is None:
+                raise RuntimeError('%s has no complete frame' % self.service_name)
+            buffer = newest[0]
+
+        prefix = 'BUF%i' % buffer
+        width = int(frame_status[prefix + 'WIDTH'])
+        height = int(frame_status[prefix + 'HEIGHT'])
+        dtype = np.dtype('<u4' if frame_status[prefix + 'SAMPLE'] == '1' else '<u2')
+        base = int(frame_status[prefix + 'BASE'])
+
+        if out is None:
+            out = np.empty((height, width), dtype=dtype)
+        elif out.shape != (height, width) or out.dtype != dtype or not out.flags.c_contiguous:
+            raise ValueError('fetch_frame: out must be a C contiguous %s array of shape %s'
+                             % (dtype, (height, width)))
+
+        frame_bytes = width * height * dtype.itemsize
+        blocks = -(-frame_bytes // self._BLOCK_SIZE)
+        reply_bytes = blocks * (self._BLOCK_PREFIX + self._BLOCK_SIZE)
+        if len(self._fetch_buffer) < reply_bytes:
+            # kept between fetches, so it is only allocated once per frame size
+            self._fetch_buffer = np.empty(reply_bytes, dtype=np.uint8)
+        reply = self._fetch_buffer[:reply_bytes]
+
+        start = perf_counter()
+        with self._lock:
+            self.command('LOCK%i' % buffer)
+            try:
+                reference = self._send('FETCH%08X%08X' % (base, blocks))
+                # the whole reply in as few socket reads as possible
+                self._recv_into(memoryview(reply))
+            finally:
+                self.command('LOCK0')
+
+        # one row per block, the '<xx:' prefix then the pixel bytes
+        reply = reply.reshape(blocks, self._BLOCK_PREFIX + self._BLOCK_SIZE)
+        prefixes = reply[:, :self._BLOCK_PREFIX]
+        expected = np.frombuffer(('<%s:' % reference).encode(), dtype=np.uint8)
+        if not (prefixes == expected).all():
+            bad = int(np.argmin((prefixes == expected).all(axis=1)))
+            raise RuntimeError('%s: bad FETCH block %i header %r'
+                               % (self.service_name, bad, prefixes[bad].tobytes()))
+        # strip the prefixes and the padding of the last block, in one copy
+        # straight into the output array
+        pixels = out.reshape(-1).view(np.uint8)
+        whole_blocks, remainder = divmod(frame_bytes, self._BLOCK_SIZE)
+        whole_bytes = whole_blocks * self._BLOCK_SIZE
+        pixels[:whole_bytes].reshape(whole_blocks, self._BLOCK_SIZE)[:] = \
+            reply[:whole_blocks, self._BLOCK_PREFIX:]
+        if remainder:
+            pixels[whole_bytes:] = reply[whole_blocks, self._BLOCK_PREFIX:][:remainder]
+
+        wire_log.record(self.service_name, 'fetch', '%i blocks' % blocks, buffer=buffer)
+        if metrics.registry.enabled:
+            metrics.registry.observe('archon_fetch_seconds', perf_counter() - start,
+                                     service=self.service_name)
+            metrics.registry.increment('archon_bytes_fetched_total',
+                                       blocks * (self._BLOCK_SIZE + self._BLOCK_PREFIX),
+                                       service=self.service_name)
+        return out
+
+    def set_exposure_time(self, new_exposure_time):
+        # set the exposure time, in seconds
+        self.configure({self.parameters['exposure_time']: int(round(new_exposure_time * 1000))})
+
+    def get_exposure_time(self):
+        # retrieve the exposure time last set, in seconds
+        milliseconds = self._values.get(self.parameters['exposure_time'])
+        return None if milliseconds is None else float(milliseconds) / 1000
@@ -0,0 +1,277 @@
+"""
+A stand-in for an STA Archon CCD controller.
+
+ArchonSimulator is a localhost TCP server that speaks the part of the
+Archon command protocol used by archon.ArchonController:
+
+    STATUS                  reply with a few system status KEY=value pairs
+    FRAME                   reply with the state of the three frame buffers
+    FASTLOADPARAM name n    set a timing script parameter. Setting the
+                            exposures parameter to 1 takes one exposure.
+    LOCKn                   lock frame buffer n, 0 unlocks
+    FETCHaaaaaaaabbbbbbbb   reply with b blocks of the buffer at address a
+
+Commands are '>xxCOMMAND\\n', with a two digit hex message reference, and
+are answered '<xxREPLY\\n'. A FETCH is answered with 1024 byte blocks, each
+prefixed '<xx:', and no newline, the same as the real Archon. Unknown
+commands are answered '?xx\\n'.
+
+An exposure integrates for the exposure time parameter, in milliseconds,
+then fills the next frame buffer over readout_time seconds. The frame
+number goes up by one per exposure, and the pixels count up from it, so a
+test can tell frames apart and check they arrive intact. Pixels are 16 bit,
+or 32 bit with sample=1, as the Archon's SAMPLE mode, e.g.
+
+>>> simulator = ArchonSimulator(width=2048, height=2048, readout_time=0.05)
+>>> simulator.start()
+>>> ccd = ArchonController(simulator.address, verbose=False)
+
+Run this module directly for a quick fetch throughput benchmark of
+ArchonController:
+
+    python archon_simulator.py --frames 20 --width 4096 --height 4096 --sample 1
+"""
+
+
+import socket
+import socketserver
+import threading
+from time import sleep
+
+import numpy as np
+
+
+# FETCH replies are 1024 byte blocks, the Archon's frame buffers are 3
+_BLOCK_SIZE = 1024
+_BUFFERS = (1, 2, 3)
+# the base address of frame buffer n is n times this
+_BUFFER_SPACING = 0x10000000
+
+
+class _ArchonHandler(socketserver.StreamRequestHandler):
+    # one handler runs per client connection, the controller state is kept
+    # on the simulator so it survives reconnects
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        super().setup()
+
+    def handle(self):
+        simulator = self.server.simulator
+        for line in self.rfile:
+            line = line.decode('ascii', errors='replace').strip()
+            if not line.startswith('>') or len(line) < 3:
+                continue
+            reply = simulator.execute(line[1:3], line[3:])
+            try:
+                self.request.sendall(reply)
+            except OSError:
+                return
+
+
+class _ArchonServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class ArchonSimulator:
+    """
+    Localhost TCP server emulating an Archon controller.
+
+    Parameters
+    ----------
+    host: string, optional
+        The interface to listen on. Default is localhost.
+    port: int, optional
+        The port to listen on. Default is 0, which picks a free port. The
+        chosen port is in the address attribute after start.
+    width, height: int, optional
+        The frame size, in pixels
+    readout_time: non-negative float, optional
+        Seconds a frame takes to read out into its buffer
+    exposures: string, optional
+        The timing script parameter that starts exposures
+    exposure_time: string, optional
+        The timing script parameter of the exposure time, in milliseconds
+    sample: int, optional
+        The frame buffers' SAMPLE mode, 0 for 16 bit pixels, 1 for 32 bit
+
+    Attributes
+    ----------
+    parameters: dict
+        Timing script parameter: value strings, as loaded
+    frames_taken: int
+        The number of exposures taken
+    locked: int
+        The locked frame buffer, 0 for none
+    """
+    def __init__(self, host='127.0.0.1', port=0, width=2048, height=2048, readout_time=0.0,
+                 exposures='Exposures', exposure_time='IntMS', sample=0):
+        if sample not in (0, 1):
+            raise ValueError('sample must be 0 or 1, got %r' % (sample,))
+        self.width = width
+        self.height = height
+        self.readout_time = readout_time
+        self.exposures = exposures
+        self.exposure_time = exposure_time
+        self.sample = sample
+        self._lock = threading.Lock()
+
+        self.parameters = {}
+        self.frames_taken = 0
+        self.locked = 0
+        # buffer: [frame number, complete, pixel bytes]
+        self._buffers = {buffer: [0, True, b''] for buffer in _BUFFERS}
+
+        self._server = _ArchonServer((host, port), _ArchonHandler, bind_and_activate=False)
+        self._server.simulator = self
+        self._thread = None
+
+    @property
+    def address(self):
+        """(<ip address>, <port number>) the simulator is listening on"""
+        return self._server.server_address[:2]
+
+    def start(self):
+        """
+        Start listening, and serve clients from a background thread.
+
+        Returns
+        -------
+        address: tuple
+            (<ip address>, <port number>)
+        """
+        self._server.server_bind()
+        self._server.server_activate()
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name='ArchonSimulator', daemon=True)
+        self._thread.start()
+        return self.address
+
+    def stop(self):
+        """
+        Stop the server, and close the listening socket.
+
+        Returns
+        -------
+        None
+        """
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
+
+    def _expose(self):
+        # integrate, then read out into the next buffer
+        sleep(float(self.parameters.get(self.exposure_time, 0)) / 1000)
+        with self._lock:
+            self.frames_taken += 1
+            frame_number = self.frames_taken
+            buffer = _BUFFERS[(frame_number - 1) % len(_BUFFERS)]
+            self._buffers[buffer] = [frame_number, False, b'']
+        pixels = (np.arange(self.width * self.height, dtype='<u4') + frame_number)
+        pixels = pixels.astype('<u4' if self.sample else '<u2').tobytes()
+        sleep(self.readout_time)
+        with self._lock:
+            self._buffers[buffer] = [frame_number, True, pixels]
+
+    def _frame_status(self):
+        items = ['TIMER=0', 'RBUF=1', 'WBUF=1']
+        for buffer, (frame_number, complete, _) in self._buffers.items():
+            items += ['BUF%iFRAME=%i' % (buffer, frame_number),
+                      'BUF%iCOMPLETE=%i' % (buffer, complete),
+                      'BUF%iWIDTH=%i' % (buffer, self.width),
+                      'BUF%iHEIGHT=%i' % (buffer, self.height),
+                      'BUF%iSAMPLE=%i' % (buffer, self.sample),
+                      'BUF%iBASE=%i' % (buffer, buffer * _BUFFER_SPACING)]
+        return ' '.join(items)
+
+    def execute(self, reference, command):
+        """
+        Carry out a single command.
+
+        Parameters
+        ----------
+        reference: string
+            The two digit hex message reference
+        command: string
+            The command, e.g. 'FASTLOADPARAM IntMS 500'
+
+        Returns
+        -------
+        reply: bytes
+            The complete reply to send back
+        """
+        with self._lock:
+            if command == 'STATUS':
+                return ('<%sVALID=1 COUNT=%i POWER=4\n' % (reference, self.frames_taken)).encode()
+            if command == 'FRAME':
+                return ('<%s%s\n' % (reference, self._frame_status())).encode()
+            if command.startswith('FASTLOADPARAM '):
+                _, name, value = command.split(None, 2)
+                self.parameters[name] = value
+                if name == self.exposures and value == '1':
+                    threading.Thread(target=self._expose, daemon=True).start()
+                return ('<%s\n' % reference).encode()
+            if command[:4] == 'LOCK' and command[4:] in ('0', '1', '2', '3'):
+                self.locked = int(command[4:])
+                return ('<%s\n' % reference).encode()
+            if command.startswith('FETCH') and len(command) == 21:
+                base, blocks = int(command[5:13], 16), int(command[13:21], 16)
+                pixels = self._buffers.get(base // _BUFFER_SPACING, (0, True, b''))[2]
+        if command.startswith('FETCH') and len(command) == 21:
+            data = pixels.ljust(blocks * _BLOCK_SIZE, b'\0')
+            prefix = ('<%s:' % reference).encode()
+            return b''.join(prefix + data[start:start + _BLOCK_SIZE]
+                            for start in range(0, blocks * _BLOCK_SIZE, _BLOCK_SIZE))
+        return ('?%s\n' % reference).encode()
+
+
+def _benchmark(frames, width, height, sample=0, output_directory=None):
+    # time exposures and fetches through ArchonController against the simulator
+    import tempfile
+    from time import perf_counter
+    from archon import ArchonController
+
+    simulator = ArchonSimulator(width=width, height=height, sample=sample)
+    simulator.start()
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        ccd = ArchonController(simulator.address, verbose=False,
+                               output_directory=output_directory or temporary_directory)
+        try:
+            ccd.set_exposure_time(0)
+            out = np.empty((height, width), dtype=np.uint32 if sample else np.uint16)
+            fetch_seconds = 0.0
+            start = perf_counter()
+            for _ in range(frames):
+                ccd.expose('Start')
+                ccd.wait_for_frame(timeout=30, out=out)
+                # fetch the same frame again, timing only the transfer
+                fetch_start = perf_counter()
+                ccd.fetch_frame(out=out)
+                fetch_seconds += perf_counter() - fetch_start
+            elapsed = perf_counter() - start
+        finally:
+            ccd.close()
+            simulator.stop()
+
+    megabytes = frames * width * height * out.itemsize / 1e6
+    print('%i frames of %ix%i in %.3f s: %.1f frames/s, fetch %.1f MB/s'
+          % (frames, width, height, elapsed, frames / elapsed, megabytes / fetch_seconds))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark ArchonController against a simulated '
+                                                 'Archon')
+    parser.add_argument('--frames', type=int, default=10)
+    parser.add_argument('--width', type=int, default=2048)
+    parser.add_argument('--height', type=int, default=2048)
+    parser.add_argument('--sample', type=int, choices=(0, 1), default=0,
+                        help='1 for 32 bit pixels')
+    parser.add_argument('--output-directory', default=None,
+                        help='where frames are written, default a temporary directory')
+    args = parser.parse_args()
+
+    _benchmark(args.frames, args.width, args.height, args.sample, args.output_directory)
@@ -1,19 +1,40 @@
-# test space for poking the IMC17 step motor that controls the bellows
+# driver for the IMC17 step motor that controls the bellows
 """
+The IMC17 is an addressable step motor controller on a Lantronix serial
+port. Commands are ASCII, addressed to motor 1 and ended with a carriage
+return, e.g. '/1A1000R\\r' moves to absolute position 1000. Every command is
+answered with
 
+    /0<status byte><data><ETX>\\r\\n
+
+where the status byte holds the ready flag (0x20, set when the motor is idle
+and can take a new move) and an error code in the low four bits, see
+decode_status.
+
+Moves do not block. A move is queued, and a single background thread sends
+it and polls the motor until it is ready again, so the lamp, camera and
+monochromator can be commanded while the bellows move. Each move returns a
+concurrent.futures.Future that resolves to the final position, and can be
+waited on, given a callback, or awaited in an event loop:
+
+>>> bellows = BellowsLifter(('128.114.17.188', 10001))
+>>> move = bellows.move_to(12000)
+>>> # ... set up the lamp and the camera ...
+>>> move.result(timeout=60)
+12000
+>>> bellows.move_to(0, callback=lambda future: print('down'))
 """
+
+
+import asyncio
+import collections
+import concurrent.futures
 import socket
+from time import monotonic, sleep
+
+import lantronix
+import wire_log
 
-# transliteration of the tkl code
-def readbytes(fd):
-    # This procedure is called as a fileevent when there are characters
-    # to read on the bellows lifter serial port.
-    
-    if fd=='':
-        return 1
-    # from there the code adds the value to a global variable
-    # ewwwww
-    return 0
 
 def decode_status(status):
     status_dict = {
@@ -24,48 +45,284 @@ def decode_status(status):
             7: 'OVERLOAD'
         }
     # return status translation, or UNKNOWN if not found
-    return status_dict.get(status, 'UNKNOWN_STATUS_%i' %status)
+    return status_dict.get(status, 'UNKNOWN_STATUS_%i' % status)
+
+
+# the ready flag of the status byte
+_READY = 0x20
+# end of text, ends the data of every reply
+_ETX = b'\x03'
+
+
+BellowsStatus = collections.namedtuple('BellowsStatus', ['ready', 'status', 'data'])
+BellowsStatus.__doc__ = """
+A decoded IMC17 reply.
+
+ready: bool
+    True if the motor is idle and can take a new move
+status: string
+    The error code, translated by decode_status, 'OK' if there is no error
+data: string
+    The data of the reply, e.g. the position asked for with '?0'
+"""
+
+
+def parse_reply(reply):
+    """
+    Decode an IMC17 reply.
+
+    Parameters
+    ----------
+    reply: bytes
+        The reply as received, e.g. b'/0`1000\\x03'. Anything before the
+        '/0' start of the reply, like line ends left from the previous
+        reply, is ignored.
+
+    Returns
+    -------
+    BellowsStatus
+
+    Raises
+    ------
+    RuntimeError:
+        If the reply is not an IMC17 reply
+    """
+    start = reply.find(b'/0')
+    if start < 0 or len(reply) < start + 3:
+        raise RuntimeError('bellows: unreadable reply %r' % reply)
+    status_byte = reply[start + 2]
+    data = reply[start + 3:].split(_ETX)[0]
+    return BellowsStatus(bool(status_byte & _READY), decode_status(status_byte & 0x0F),
+                         data.decode('ascii', errors='replace').strip())
+
+
+class BellowsLifter:
+    """
+    Driver for the IMC17 step motor that lifts the bellows.
+
+    Parameters
+    ----------
+    ip_port: tuple
+        the ip address and port of the Lantronix serial port, in the format
+        (<ip address>, <port number>). This is the 'bellows' entry of the
+        lantronix section of config.yaml.
+    timeout: float, optional
+        Seconds to wait for a reply to a command
+    move_timeout: float, optional
+        Seconds a move may take before its future fails with a TimeoutError
+    poll_interval: float, optional
+        Seconds between status queries while a move is in progress. The
+        IMC17 does not report when a move has finished, so it has to be
+        asked.
+    address: int, optional
+        The motor address set on the IMC17
+    verbose: bool, optional
+        If True, print every command sent and reply received
+
+    Notes
+    -----
+    Moves run one at a time, in the order they were asked for. Queries like
+    get_position, and stop, are sent straight away, between the status
+    queries of a running move.
+    """
+    def __init__(self, ip_port, timeout=2, move_timeout=120, poll_interval=0.1, address=1,
+                 verbose=True):
+        self.timeout = timeout
+        self.move_timeout = move_timeout
+        self.poll_interval = poll_interval
+        self.address = address
+        self.verbose = verbose
+
+        # the IMC17 pads its replies with 0xff, discard it like noise
+        self._connection = lantronix.get_connection(ip_port, timeout=timeout, noise=b'\xff')
+        self._connection.connect()
+        # one worker, so queued moves run in order
+        self._moves = concurrent.futures.ThreadPoolExecutor(max_workers=1,
+                                                            thread_name_prefix='bellows')
+        # counts calls to stop, moves queued before a stop are cancelled
+        self._stops = 0
+
+    def query(self, command):
+        """
+        Send a command and return the decoded reply.
+
+        Parameters
+        ----------
+        command: string
+            The command without the address and carriage return, e.g. '?0'
+
+        Returns
+        -------
+        BellowsStatus
+
+        Raises
+        ------
+        RuntimeError:
+            If the IMC17 reports an error
+        """
+        output_string = ('/%i%s\r' % (self.address, command)).encode('ascii')
+        with self._connection.lock:
+            self._connection.send(output_string)
+            wire_log.record('bellows', 'send', output_string, echo=self.verbose)
+            try:
+                reply = self._connection.read_until(_ETX, timeout=self.timeout)
+            except socket.timeout as err:
+                raise RuntimeError('bellows: no reply to %s, %s' % (command, err))
+        wire_log.record('bellows', 'recv', reply, echo=self.verbose)
+
+        status = parse_reply(reply)
+        if status.status != 'OK':
+            raise RuntimeError('bellows: %s failed with %s' % (command, status.status))
+        return status
+
+    def get_status(self):
+        """
+        Returns
+        -------
+        BellowsStatus
+            The current status, without changing anything
+        """
+        return self.query('Q')
+
+    def get_position(self):
+        """
+        Returns
+        -------
+        position: int
+            The current absolute position, in steps
+        """
+        return int(self.query('?0').data)
+
+    def _run_move(self, command, stops):
+        # runs in the move thread: send a move, and poll until it is done
+        if self._stops != stops:
+            raise RuntimeError('bellows: move %s cancelled by stop' % command)
+        self.query(command)
+        deadline = monotonic() + self.move_timeout
+        while not self.get_status().ready:
+            if self._stops != stops:
+                raise RuntimeError('bellows: move %s cancelled by stop' % command)
+            if monotonic() >= deadline:
+                raise TimeoutError('bellows: move %s did not finish in %s s'
+                                   % (command, self.move_timeout))
+            sleep(self.poll_interval)
+        if self._stops != stops:
+            # stopped just as it became ready, short of the target
+            raise RuntimeError('bellows: move %s cancelled by stop' % command)
+        return self.get_position()
+
+    def _queue_move(self, command, callback=None):
+        future = self._moves.submit(self._run_move, command, self._stops)
+        if callback is not None:
+            future.add_done_callback(callback)
+        return future
+
+    def move_to(self, position, callback=None):
+        """
+        Queue a move to an absolute position, and return without waiting.
+
+        Parameters
+        ----------
+        position: int
+            The target position, in steps
+        callback: callable, optional
+            Called with the future when the move has finished or failed
+
+        Returns
+        -------
+        move: concurrent.futures.Future
+            Resolves to the final position once the motor is ready again
+        """
+        return self._queue_move('A%iR' % position, callback)
+
+    def move_by(self, steps, callback=None):
+        """
+        Queue a move relative to where the previous move finished.
+
+        Parameters
+        ----------
+        steps: int
+            Steps to move, negative to move down
+        callback: callable, optional
+            Called with the future when the move has finished or failed
 
+        Returns
+        -------
+        move: concurrent.futures.Future
+            Resolves to the final position once the motor is ready again
+        """
+        if steps < 0:
+            return self._queue_move('D%iR' % -steps, callback)
+        return self._queue_move('P%iR' % steps, callback)
 
-def sendmsg(msg):
-    readyw = 0
-    while(port['ready'] == 0):
-        send_querymsg '/1?0'
-        position = readposition()
-        if port['status'] != 'OK':
-            # log an error
-        if port['ready'] == 0:
-            readyw += 1
-            if readyw >= 3:
-                # error code log here
-                rbuf = Timeout
-                pause(20)
-    # log message
-    # clear recieve buffers
-    # send message
-    # clear output buffer?
-    return
+    def home(self, max_steps=100000, callback=None):
+        """
+        Queue a move down to the home switch, which sets position 0.
 
+        Parameters
+        ----------
+        max_steps: int, optional
+            Give up after this many steps without reaching the switch
+        callback: callable, optional
+            Called with the future when the move has finished or failed
 
+        Returns
+        -------
+        move: concurrent.futures.Future
+            Resolves to the final position once the motor is ready again
+        """
+        return self._queue_move('Z%iR' % max_steps, callback)
 
+    async def move_to_async(self, position):
+        """
+        Coroutine version of move_to, for use in an event loop.
 
+        Returns
+        -------
+        position: int
+            The final position
+        """
+        return await asyncio.wrap_future(self.move_to(position))
 
-bellows_port = ('128.114.17.188', 10001)
-setup_port = ('128.114.17.188', 9999)
+    def wait_until_ready(self, timeout=None):
+        """
+        Block until every queued move has finished.
 
-s = socket.socket(
-    socket.AF_INET,
-    socket.SOCK_STREAM
-)
+        Parameters
+        ----------
+        timeout: float, optional
+            Seconds to wait. None waits forever.
 
-# s.bind(('128.114.17.188', 10001))  # didn't work
-# bind() is for setting up server ports, not connecting
-# use telnet to test connections
+        Returns
+        -------
+        position: int
+            The position after the last move
+        """
+        # a move queued behind the others finishes last
+        return self._moves.submit(self.get_position).result(timeout=timeout)
 
-s.connect(('128.114.17.188', 10001))  # worked
-# for the above, will a list work?
-# need to test this
+    def stop(self):
+        """
+        Stop the motor now, and cancel the queued moves. The move in
+        progress fails with a RuntimeError.
 
+        Returns
+        -------
+        None
+        """
+        self._stops += 1
+        self.query('T')
 
-s.gettimeout()
+    def shutdown(self):
+        """
+        Stop the motor, and close the connection.
 
+        Returns
+        -------
+        None
+        """
+        try:
+            self.stop()
+        finally:
+            self._moves.shutdown(wait=True)
+            self._connection.close()
@@ -0,0 +1,309 @@
+"""
+A stand-in for the BK Precision 1697 power supply behind the Lantronix.
+
+BK1697Simulator is a localhost TCP server that speaks the part of the BK
+1697 command set used by TungstenLamp:
+
+    SESS00      disable the front panel, start a remote session
+    ENDS00      re-enable the front panel, end the remote session
+    VOLT00nnn   set the voltage, in tenths of a volt
+    CURR00nnn   set the current, in hundredths of an amp
+    SOUT00n     output on (n = 0) or off (n = 1)
+    GETS00      reply with the voltage and current settings, 'vvvccc\\r'
+    GETD00      reply with the measured voltage, current and regulation
+                mode, 'vvvvccccm\\r'
+
+Every command is answered with 'OK\\r', the same as the real power supply.
+Unknown commands get no reply at all, so the driver times out the same way
+it does when the BK is switched off.
+
+The simulator can misbehave the way the real hardware does: it can wait
+before replying, split replies into several TCP packets, and sprinkle null
+characters into the stream. This makes it possible to test and benchmark
+the lamp drivers without the lamp, e.g.
+
+>>> simulator = BK1697Simulator(latency=0.002, split_replies=True, noise=0.1)
+>>> simulator.start()
+>>> w_lamp = TungstenLamp(simulator.address, verbose=False)
+
+Run this module directly for a quick throughput benchmark of TungstenLamp:
+
+    python bk1697_simulator.py --commands 5000 --latency 0.0005
+"""
+
+
+import math
+import random
+import re
+import socket
+import socketserver
+import threading
+from time import monotonic, sleep
+
+
+class _BK1697Handler(socketserver.BaseRequestHandler):
+    # one handler runs per client connection, the power supply state is kept
+    # on the simulator so it survives reconnects, like the real BK
+    def setup(self):
+        # send split replies as separate packets, instead of letting Nagle's
+        # algorithm hold them back waiting for an ACK
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        simulator = self.server.simulator
+        buffer = b''
+        while True:
+            try:
+                chunk = self.request.recv(1024)
+            except OSError:
+                return
+            if not chunk:
+                return
+            buffer += chunk
+            # commands end with a carriage return
+            while b'\r' in buffer:
+                command, buffer = buffer.split(b'\r', 1)
+                reply = simulator.execute(command)
+                if reply is not None:
+                    simulator.send_reply(self.request, reply)
+
+
+class _BK1697Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class BK1697Simulator:
+    """
+    Localhost TCP server emulating a BK Precision 1697 on a Lantronix port.
+
+    Parameters
+    ----------
+    host: string, optional
+        The interface to listen on. Default is localhost.
+    port: int, optional
+        The port to listen on. Default is 0, which picks a free port. The
+        chosen port is in the address attribute after start.
+    latency: non-negative float, optional
+        Seconds to wait before sending each reply, to mimic the BK
+        turnaround time.
+    split_replies: bool, optional
+        If True, send each reply as several separate TCP packets, split at
+        random places, e.g. b'0904' then b'56\\rO' then b'K\\r'.
+    noise: float between 0 and 1, optional
+        The probability of inserting a null character, b'\\x00', before each
+        reply packet. The real BK/Lantronix emits these on power up/down.
+    seed: int, optional
+        Seed for the random number generator, for reproducible runs.
+    resistance: float, optional
+        The hot resistance of the simulated lamp filament, in ohms. The
+        measured output reported by GETD00 is worked out from it.
+    warmup_time: non-negative float, optional
+        Time constant of the filament warming up, in seconds. After the
+        output is turned on, the filament resistance rises from 90% of its
+        hot value with this time constant, so the measured current falls
+        and settles. 0 makes the lamp warm up instantly.
+
+    Attributes
+    ----------
+    volts: float
+        The voltage setting
+    curr: float
+        The current setting
+    output_on: bool
+        True while the output is on
+    remote: bool
+        True while a remote session is active, i.e. the front panel is
+        disabled
+    commands_received: int
+        The number of complete commands received
+    """
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, split_replies=False,
+                 noise=0.0, seed=None, resistance=2.0, warmup_time=0.0):
+        self.latency = latency
+        self.resistance = resistance
+        self.warmup_time = warmup_time
+        self.split_replies = split_replies
+        self.noise = noise
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+        self.volts = 0.0
+        self.curr = 0.0
+        self.output_on = False
+        self.remote = False
+        self.commands_received = 0
+        # monotonic time the output was last turned on
+        self._turned_on = None
+
+        self._server = _BK1697Server((host, port), _BK1697Handler, bind_and_activate=False)
+        self._server.simulator = self
+        self._thread = None
+
+    @property
+    def address(self):
+        """(<ip address>, <port number>) the simulator is listening on"""
+        return self._server.server_address[:2]
+
+    def start(self):
+        """
+        Start listening, and serve clients from a background thread.
+
+        Returns
+        -------
+        address: tuple
+            (<ip address>, <port number>)
+        """
+        self._server.server_bind()
+        self._server.server_activate()
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name='BK1697Simulator', daemon=True)
+        self._thread.start()
+        return self.address
+
+    def stop(self):
+        """
+        Stop the server, and close the listening socket.
+
+        Returns
+        -------
+        None
+        """
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
+
+    def measured_outputs(self):
+        """
+        The output the simulated lamp draws right now.
+
+        Returns
+        -------
+        voltage: float
+        current: float
+        constant_current: bool
+        """
+        if not self.output_on:
+            return 0.0, 0.0, False
+        resistance = self.resistance
+        if self.warmup_time:
+            elapsed = monotonic() - self._turned_on
+            resistance *= 1 - 0.1 * math.exp(-elapsed / self.warmup_time)
+        if self.volts / resistance > self.curr:
+            return self.curr * resistance, self.curr, True
+        return self.volts, self.volts / resistance, False
+
+    def execute(self, command):
+        """
+        Carry out a single command, without the trailing carriage return.
+
+        Parameters
+        ----------
+        command: bytes
+            e.g. b'VOLT00123'
+
+        Returns
+        -------
+        reply: bytes or None
+            The reply to send back, or None for unknown commands
+        """
+        with self._lock:
+            self.commands_received += 1
+
+            if command == b'SESS00':
+                self.remote = True
+            elif command == b'ENDS00':
+                self.remote = False
+            elif command == b'GETS00':
+                # e.g. 12.3 V and 4.56 A is '123456\rOK\r'
+                return b'%03d%03d\rOK\r' % (round(self.volts * 10), round(self.curr * 100))
+            elif command == b'GETD00':
+                # e.g. 12.30 V and 4.56 A in constant voltage is '123004560\rOK\r'
+                volts, amps, constant_current = self.measured_outputs()
+                return b'%04d%04d%d\rOK\r' % (round(volts * 100), round(amps * 100),
+                                               constant_current)
+            elif re.fullmatch(br'VOLT00\d{3}', command):
+                self.volts = int(command[6:]) / 10
+            elif re.fullmatch(br'CURR00\d{3}', command):
+                self.curr = int(command[6:]) / 100
+            elif re.fullmatch(br'SOUT00[01]', command):
+                # 0 turns the output on, 1 turns it off
+                if command[6:] == b'0' and not self.output_on:
+                    self._turned_on = monotonic()
+                self.output_on = command[6:] == b'0'
+            else:
+                return None
+
+        return b'OK\r'
+
+    def send_reply(self, connection, reply):
+        """
+        Send a reply, applying the configured latency, splitting and noise.
+
+        Parameters
+        ----------
+        connection: socket
+            The client connection
+        reply: bytes
+            The complete reply, ending in 'OK\\r'
+
+        Returns
+        -------
+        None
+        """
+        if self.latency:
+            sleep(self.latency)
+
+        if self.split_replies and len(reply) > 1:
+            cuts = sorted(self._random.sample(range(1, len(reply)),
+                                              self._random.randint(1, min(3, len(reply) - 1))))
+            pieces = [reply[start:end] for start, end in zip([0] + cuts, cuts + [len(reply)])]
+        else:
+            pieces = [reply]
+
+        try:
+            for piece in pieces:
+                if self.noise and self._random.random() < self.noise:
+                    piece = b'\x00' + piece
+                connection.sendall(piece)
+        except OSError:
+            # the client went away mid-reply
+            pass
+
+
+def _benchmark(commands, **kwargs):
+    # time set_volts round trips through TungstenLamp against the simulator
+    from time import perf_counter
+    from tungsten_lamp import TungstenLamp
+
+    simulator = BK1697Simulator(**kwargs)
+    simulator.start()
+    w_lamp = TungstenLamp(simulator.address, verbose=False)
+    try:
+        start = perf_counter()
+        for index in range(commands):
+            w_lamp.set_volts((index % 100) / 10)
+        elapsed = perf_counter() - start
+    finally:
+        w_lamp.shutdown()
+        simulator.stop()
+
+    print('%i commands in %.3f s: %.0f commands/s, %.3f ms per command'
+          % (commands, elapsed, commands / elapsed, 1000 * elapsed / commands))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark TungstenLamp against a simulated BK 1697')
+    parser.add_argument('--commands', type=int, default=2000)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--split-replies', action='store_true')
+    parser.add_argument('--noise', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    _benchmark(args.commands, latency=args.latency, split_replies=args.split_replies,
+               noise=args.noise, seed=args.seed)
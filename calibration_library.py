@@ -0,0 +1,462 @@
+"""
+A library of master bias and dark frames, reused for as long as the camera
+is set up the same way.
+
+Taking a fresh set of biases and darks before every QE run costs tens of
+minutes, even when nothing about the camera has changed since the last one.
+The library keeps a master frame for each camera setup, and a scan asks it
+for a match before taking new frames:
+
+>>> library = CalibrationLibrary('/data/qe/calibration')
+>>> bias = master_for(library, andorcam, 'bias', count=20).data
+>>> dark = master_for(library, andorcam, 'dark', count=10).data
+
+In a QE scan, run_qe_scan's calibration hook gets the master once the
+camera is set up for the scan, and hands it to reduce with every frame:
+
+>>> def reduce(wavelength, filename, bias):
+...     return (frame_ingest.map_fits_frame(filename).data - bias).mean()
+>>> run_qe_scan(wavelengths, andorcam, monochromator, reduce=reduce,
+...             calibration=lambda ccd: master_for(library, ccd, 'bias', count=20).data)
+
+master_for only takes frames when the library has no match. The same can
+be done by hand, e.g. to fold in frames taken some other way:
+
+>>> key = key_from_controller(andorcam, 'dark')
+>>> master = library.find(key) or library.master(key)
+>>> master.add('/data/qe/frame_0042.fits')
+>>> master.save()
+
+A master is kept for each kind ('bias' or 'dark'), exposure time,
+GAINMODE, READSPEED, BINNING, WINDOW and detector temperature. The readout
+settings have to match exactly. The exposure time and temperature only
+have to be within a tolerance, and a master older than max_age is never
+used, and is removed by evict.
+
+Masters are the mean of their frames, built up one frame at a time, so a
+frame is folded in as soon as it is read out and never needs to be kept.
+Adding frames to a saved master carries on where it left off. Each master
+is saved as float32 in a compressed .npz file, so it takes the space of
+about two raw frames however many frames went into it, and the library
+index is a JSON file next to them:
+
+/data/qe/calibration/index.json
+/data/qe/calibration/dark_20261018T120000_31337_1.npz
+"""
+
+
+import collections
+import itertools
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+import frame_ingest
+
+
+CalibrationKey = collections.namedtuple('CalibrationKey', ['kind', 'exposure_time', 'gainmode',
+                                                           'readspeed', 'binning', 'window',
+                                                           'temperature'])
+CalibrationKey.__doc__ = """
+The camera setup a master frame belongs to.
+
+kind: string
+    'bias' or 'dark'
+exposure_time: float
+    Seconds, 0 for a bias
+gainmode, readspeed, binning, window: string
+    The GAINMODE, READSPEED, BINNING and WINDOW keyword values
+temperature: float
+    Detector temperature, in degrees C
+"""
+
+_KINDS = ('bias', 'dark')
+
+
+def key_from_controller(ccd_controller, kind):
+    """
+    The calibration key of a camera's current setup.
+
+    Parameters
+    ----------
+    ccd_controller: AndorCameraController
+        The camera, read through keyword_state and get_curr_temp, so it
+        needs the GAINMODE, READSPEED, BINNING and WINDOW keywords
+    kind: string
+        'bias' or 'dark'
+
+    Returns
+    -------
+    CalibrationKey
+    """
+    if kind not in _KINDS:
+        raise ValueError('kind must be one of %s, got %r' % (_KINDS, kind))
+    state = ccd_controller.keyword_state()
+    exposure_time = 0.0 if kind == 'bias' else float(state['EXPOSURE'])
+    return CalibrationKey(kind, exposure_time, str(state['GAINMODE']),
+                          str(state['READSPEED']), str(state['BINNING']),
+                          str(state['WINDOW']), float(ccd_controller.get_curr_temp()))
+
+
+def _frame_data(frame):
+    # a frame as a numpy array: an array, a frame_ingest.Frame, or a FITS
+    # filename, with BZERO and BSCALE applied
+    if isinstance(frame, str):
+        frame = frame_ingest.map_fits_frame(frame)
+    if isinstance(frame, frame_ingest.Frame):
+        data = frame.data.astype(np.float64)
+        scale = frame.header.get('BSCALE', 1)
+        zero = frame.header.get('BZERO', 0)
+        if scale != 1:
+            data *= scale
+        if zero:
+            data += zero
+        return data
+    return np.asarray(frame, dtype=np.float64)
+
+
+class MasterFrame:
+    """
+    A master bias or dark, made by CalibrationLibrary.master or found by
+    CalibrationLibrary.find.
+
+    Attributes
+    ----------
+    key: CalibrationKey
+        The setup it belongs to. The temperature is the mean temperature of
+        its frames.
+    count: int
+        The number of frames averaged
+    created, updated: float
+        time.time() of the first and last frame
+    """
+    def __init__(self, library, entry):
+        self._library = library
+        self._entry = entry
+        self._sum = None
+        self._data = None
+
+    def __repr__(self):
+        return '<MasterFrame %s, %i frames>' % (self._entry['id'], self.count)
+
+    @property
+    def key(self):
+        return CalibrationKey(*(self._entry[field] for field in CalibrationKey._fields))
+
+    @property
+    def count(self):
+        return self._entry['count']
+
+    @property
+    def created(self):
+        return self._entry['created']
+
+    @property
+    def updated(self):
+        return self._entry['updated']
+
+    @property
+    def data(self):
+        """
+        The master frame, as a float32 array, loaded on first use.
+        """
+        if self._data is None:
+            if self._sum is not None:
+                self._data = (self._sum / self.count).astype(np.float32)
+            elif self._entry['file'] is not None:
+                path = os.path.join(self._library.directory, self._entry['file'])
+                with np.load(path) as saved:
+                    self._data = saved['data']
+        return self._data
+
+    def add(self, frame, temperature=None):
+        """
+        Fold one more frame into the master.
+
+        Parameters
+        ----------
+        frame: numpy.ndarray, frame_ingest.Frame or string
+            The frame, or the name of its FITS file
+        temperature: float, optional
+            The detector temperature of the frame. Defaults to the
+            temperature of the key.
+
+        Returns
+        -------
+        count: int
+            The number of frames in the master
+
+        Raises
+        ------
+        ValueError:
+            If the frame is not the same shape as the master
+        """
+        data = _frame_data(frame)
+        if self._sum is None:
+            if self.count:
+                # carry on from the saved master
+                self._sum = self.data.astype(np.float64) * self.count
+            else:
+                self._sum = np.zeros(data.shape)
+        if data.shape != self._sum.shape:
+            raise ValueError('frame is %s, the master is %s' % (data.shape, self._sum.shape))
+        self._sum += data
+
+        entry = self._entry
+        if temperature is None:
+            temperature = entry['temperature']
+        entry['temperature'] = ((entry['temperature'] * entry['count'] + temperature)
+                                / (entry['count'] + 1))
+        entry['count'] += 1
+        entry['updated'] = time.time()
+        self._data = None
+        return entry['count']
+
+    def save(self):
+        """
+        Write the master to the library, replacing any earlier version of
+        it.
+
+        Returns
+        -------
+        None
+        """
+        if not self.count:
+            raise ValueError('%s has no frames to save' % self._entry['id'])
+        filename = self._entry['id'] + '.npz'
+        path = os.path.join(self._library.directory, filename)
+        temporary = path + '.%i.npz' % os.getpid()
+        np.savez_compressed(temporary, data=self.data)
+        os.replace(temporary, path)
+        self._entry['file'] = filename
+        self._library._store(self._entry)
+
+
+class CalibrationLibrary:
+    """
+    Master bias and dark frames, kept on disk and matched to camera setups.
+
+    Parameters
+    ----------
+    directory: string
+        Where the masters and their index are kept. Made if it does not
+        exist.
+    exposure_tolerance: float, optional
+        The largest fraction a dark's exposure time can differ by and still
+        match
+    temperature_tolerance: float, optional
+        The largest difference, in degrees C, between the detector
+        temperatures of a master and a setup that match
+    max_age: float, optional
+        Seconds after its last frame that a master stops matching, and is
+        removed by evict. None keeps masters forever.
+    """
+    def __init__(self, directory, exposure_tolerance=0.01, temperature_tolerance=1.0,
+                 max_age=7 * 86400):
+        self.directory = directory
+        self.exposure_tolerance = exposure_tolerance
+        self.temperature_tolerance = temperature_tolerance
+        self.max_age = max_age
+        self._index_filename = os.path.join(directory, 'index.json')
+        self._lock = threading.Lock()
+        self._serial = itertools.count(1)
+        os.makedirs(directory, exist_ok=True)
+        # (mtime, size) of the index when it was last read or written
+        self._index_stamp = None
+        self._entries = self._load()
+
+    def _stamp(self):
+        try:
+            info = os.stat(self._index_filename)
+        except FileNotFoundError:
+            return None
+        return info.st_mtime_ns, info.st_size
+
+    def _load(self):
+        self._index_stamp = self._stamp()
+        try:
+            with open(self._index_filename) as file:
+                return {entry['id']: entry for entry in json.load(file)['masters']}
+        except (OSError, ValueError, KeyError):
+            return {}
+
+    def _refresh(self):
+        # call with the lock held, reread the index if another process, or
+        # another library on the same directory, has changed it
+        if self._stamp() != self._index_stamp:
+            self._entries = self._load()
+
+    def _save_index(self):
+        # call with the lock held, write to a temporary file and rename, so
+        # a concurrent reader never sees half an index
+        temporary = '%s.%i' % (self._index_filename, os.getpid())
+        with open(temporary, 'w') as file:
+            json.dump({'masters': list(self._entries.values())}, file, indent=1)
+        os.replace(temporary, self._index_filename)
+        self._index_stamp = self._stamp()
+
+    def _store(self, entry):
+        with self._lock:
+            # the index on disk may have been changed by another process
+            self._entries = self._load()
+            self._entries[entry['id']] = dict(entry)
+            self._save_index()
+
+    def _matches(self, entry, key, now):
+        if (entry['file'] is None or entry['kind'] != key.kind
+                or entry['gainmode'] != key.gainmode or entry['readspeed'] != key.readspeed
+                or entry['binning'] != key.binning or entry['window'] != key.window):
+            return False
+        if abs(entry['exposure_time'] - key.exposure_time) > (self.exposure_tolerance
+                                                                 * max(key.exposure_time, 0)):
+            return False
+        if abs(entry['temperature'] - key.temperature) > self.temperature_tolerance:
+            return False
+        return self.max_age is None or now - entry['updated'] <= self.max_age
+
+    def find(self, key, min_count=1):
+        """
+        Find a saved master that can be used for a camera setup.
+
+        Parameters
+        ----------
+        key: CalibrationKey
+            The setup, e.g. from key_from_controller
+        min_count: int, optional
+            Only use masters of at least this many frames
+
+        Returns
+        -------
+        MasterFrame or None
+            The closest match in temperature, then exposure time, newest
+            first, or None if nothing matches
+        """
+        now = time.time()
+        with self._lock:
+            self._refresh()
+            matches = [entry for entry in self._entries.values()
+                       if entry['count'] >= min_count and self._matches(entry, key, now)]
+        if not matches:
+            return None
+        best = min(matches, key=lambda entry: (abs(entry['temperature'] - key.temperature),
+                                               abs(entry['exposure_time'] - key.exposure_time),
+                                               -entry['updated']))
+        return MasterFrame(self, dict(best))
+
+    def master(self, key):
+        """
+        Start a new, empty master for a camera setup. Add frames to it, and
+        save it, to put it in the library.
+
+        Parameters
+        ----------
+        key: CalibrationKey
+
+        Returns
+        -------
+        MasterFrame
+        """
+        if key.kind not in _KINDS:
+            raise ValueError('kind must be one of %s, got %r' % (_KINDS, key.kind))
+        now = time.time()
+        entry = dict(key._asdict(), count=0, created=now, updated=now, file=None)
+        # the process id keeps masters started by different processes apart
+        entry['id'] = '%s_%s_%i_%i' % (key.kind, time.strftime('%Y%m%dT%H%M%S',
+                                                               time.localtime(now)),
+                                       os.getpid(), next(self._serial))
+        return MasterFrame(self, entry)
+
+    def evict(self, max_age=None):
+        """
+        Remove masters not updated for longer than max_age.
+
+        Parameters
+        ----------
+        max_age: float, optional
+            Seconds. Defaults to the library's max_age.
+
+        Returns
+        -------
+        removed: int
+            The number of masters removed
+        """
+        if max_age is None:
+            max_age = self.max_age
+        if max_age is None:
+            return 0
+        now = time.time()
+        with self._lock:
+            self._entries = self._load()
+            expired = [entry for entry in self._entries.values()
+                       if now - entry['updated'] > max_age]
+            for entry in expired:
+                del self._entries[entry['id']]
+                if entry['file'] is not None:
+                    try:
+                        os.remove(os.path.join(self.directory, entry['file']))
+                    except FileNotFoundError:
+                        pass
+            if expired:
+                self._save_index()
+        return len(expired)
+
+    def masters(self):
+        """
+        Returns
+        -------
+        list of MasterFrame
+            Every master in the library
+        """
+        with self._lock:
+            self._refresh()
+            return [MasterFrame(self, dict(entry)) for entry in self._entries.values()]
+
+
+def master_for(library, ccd_controller, kind, count=10, timeout=None):
+    """
+    Return a master bias or dark for a camera's current setup, from the
+    library if it has one, or else by taking and saving a new one.
+
+    New frames are taken with the shutter shut, and for a bias with zero
+    exposure time. The shutter and exposure time are put back afterwards.
+
+    Parameters
+    ----------
+    library: CalibrationLibrary
+    ccd_controller: AndorCameraController
+    kind: string
+        'bias' or 'dark'
+    count: int, optional
+        The number of frames a master needs, and the number taken for a new
+        one
+    timeout: float, optional
+        Seconds to wait for each frame to integrate and read out
+
+    Returns
+    -------
+    MasterFrame
+    """
+    key = key_from_controller(ccd_controller, kind)
+    master = library.find(key, min_count=count)
+    if master is not None:
+        return master
+
+    state = ccd_controller.keyword_state()
+    settings = {'SHUTTERMODE': 'shut'}
+    if kind == 'bias':
+        settings['EXPOSURE'] = 0
+    ccd_controller.configure(settings)
+    try:
+        master = library.master(key)
+        for _ in range(count):
+            ccd_controller.expose('Start')
+            ccd_controller.wait_for_readout(timeout=timeout)
+            filename = ccd_controller.wait_for_frame(timeout=timeout)
+            master.add(filename, temperature=float(ccd_controller.get_curr_temp()))
+        master.save()
+    finally:
+        ccd_controller.configure({keyword: state[keyword] for keyword in settings})
+    return master
@@ -10,13 +10,82 @@ Keywords can be array-likes, such as for binning.
 """
 
 
+import asyncio
+import collections
+import concurrent.futures
 import sys
+import threading
+from time import monotonic, perf_counter
+
+import ktl_metadata
+import metrics
+import wire_log
+
 # start by adding the ktl python module path
 sys.path.extend(['/opt/kroot/rel/default/lib/python',
                  '/opt/kroot/rel/default/lib',
                  '/usr/local/lick/lib/python',
                  '/usr/local/lick/lib'])
-import ktl
+try:
+    import ktl
+except ImportError:
+    # no kroot install on this machine, only the fake backend is available
+    ktl = None
+
+
+def get_ktl_backend(backend=None):
+    """
+    Return the module that provides ktl.Service for a controller.
+
+    Parameters
+    ----------
+    backend: string, module, or None
+        'ktl' or None for the real ktl module, 'fake' for the in-memory
+        fake_ktl stand-in. Anything else is assumed to be a module-like
+        object with a Service class, and is returned as is.
+
+    Returns
+    -------
+    module providing Service
+    """
+    if backend is None or backend == 'ktl':
+        if ktl is None:
+            raise ImportError('The ktl python module was not found under /opt/kroot. '
+                              "Use ktl_backend: 'fake' to run without a keyword server.")
+        return ktl
+    if backend == 'fake':
+        import fake_ktl
+        return fake_ktl
+    return backend
+
+
+# keywords used by AndorCameraController
+_ANDOR_KEYWORDS = ('EXPOSE', 'EXPMODE', 'EXPOSURE', 'COOLING', 'COOLTARG', 'CURRTEMP',
+                   'GAINMODE', 'READSPEED', 'BINNING', 'WINDOW', 'SHUTTERMODE',
+                   'ACQPHASE', 'ACQCOUNT', 'LASTFILE')
+# the subset read by the get methods, these are monitored in cached mode
+_ANDOR_CACHED_KEYWORDS = ('EXPOSURE', 'COOLING', 'COOLTARG', 'CURRTEMP', 'GAINMODE',
+                          'READSPEED', 'BINNING', 'WINDOW', 'SHUTTERMODE')
+# the settings returned by keyword_state, enough to put the camera back as it was
+_ANDOR_STATE_KEYWORDS = ('EXPOSURE', 'COOLTARG', 'GAINMODE', 'READSPEED', 'BINNING', 'WINDOW',
+                         'SHUTTERMODE')
+
+
+class KeywordWriteError(RuntimeError):
+    """
+    Raised when one or more keywords of a bulk write failed.
+
+    Every write is attempted, and all failures are reported together.
+
+    Attributes
+    ----------
+    failures: dict
+        keyword: exception pairs, one for each keyword that failed
+    """
+    def __init__(self, failures):
+        self.failures = failures
+        message = '; '.join('%s: %s' % (keyword, err) for keyword, err in failures.items())
+        super().__init__('%i keyword write(s) failed: %s' % (len(failures), message))
 
 
 class Controller:
@@ -32,10 +101,32 @@ class Controller:
     """
     # I need to carefully define the arguments for these functions.
     # I also need to add a way of handling multiple amps in the future
+    def configure(self, keyword_dict):
+        # apply several settings at once, as keyword: value pairs
+        pass
+
+    def keyword_state(self):
+        # the current settings, as keyword: value pairs that configure can
+        # restore
+        pass
+
     def expose(self):
         # start an exposure
         pass
 
+    def wait_for_readout(self, timeout=None):
+        # block until the current exposure has finished integrating, i.e. the
+        # light source and monochromator are free to change
+        pass
+
+    def wait_for_frame(self, timeout=None):
+        # block until the current frame has been read out, return its filename
+        pass
+
+    def stream_frames(self, count=None, timeout=None, start=True):
+        # expose continuously, and iterate over the frames as they are read out
+        pass
+
     def set_cooler(self, cooler_on):
         # turn the cooler on or off
         pass
@@ -56,6 +147,11 @@ class Controller:
         # retrieve the current temperature of the cooler
         pass
 
+    def wait_for_temperature(self, target=None, tolerance=0.5, stable_for=30.0, timeout=None,
+                             wait=True):
+        # block until the detector temperature has settled at the target
+        pass
+
     def set_exposure_mode(self, expmode):
         # set the exposure mode, e.g., single or continuous
         pass
@@ -121,19 +217,448 @@ class Controller:
         pass
 
 
+StreamedFrame = collections.namedtuple('StreamedFrame', ['sequence', 'filename', 'timestamp',
+                                                         'exposure_time', 'dropped'])
+StreamedFrame.__doc__ = """
+A frame from a continuous exposure, see FrameStream.
+
+sequence: int
+    The frame number, from ACQCOUNT
+filename: string
+    The file the frame was written to, from LASTFILE
+timestamp: float
+    Unix time the frame was announced by the keyword server
+exposure_time: string
+    EXPOSURE when the stream started
+dropped: int
+    How many frame numbers were skipped just before this frame, 0 if none
+"""
+
+
+class FrameStream:
+    """
+    Iterate over the frames of a continuous exposure as they are read out.
+
+    Built by AndorCameraController.stream_frames. Frames are announced by
+    the ACQCOUNT and LASTFILE keyword broadcasts, so nothing is written or
+    polled per frame. Works as an iterator, and as an async iterator in an
+    event loop:
+
+    >>> with andorcam.stream_frames(count=1000) as stream:
+    ...     for frame in stream:
+    ...         process(frame.filename)
+
+    >>> async with andorcam.stream_frames(count=1000) as stream:
+    ...     async for frame in stream:
+    ...         process(frame.filename)
+
+    Each LASTFILE is paired with the frame number ACQCOUNT had when it was
+    broadcast, so a missed or repeated broadcast of one keyword only loses
+    that frame, instead of shifting every later filename onto the wrong
+    frame. A jump of more than one in ACQCOUNT, or a frame whose file was
+    never announced, is reported in the dropped field of the next frame,
+    and counted in the dropped attribute.
+
+    Closing the stream, by leaving the with block, breaking out of the loop
+    and calling close, or after count frames, stops the exposure with
+    expose('Stop') if the stream started it.
+
+    Parameters
+    ----------
+    controller: AndorCameraController
+    count: int, optional
+        Stop after this many frames. None streams until closed.
+    timeout: float, optional
+        Seconds to wait for each frame before raising TimeoutError. None
+        waits forever.
+    start: bool, optional
+        If True, set EXPMODE to Continuous and start exposing. If False,
+        only watch for frames, e.g. of an exposure started elsewhere.
+
+    Attributes
+    ----------
+    received: int
+        Frames yielded so far
+    dropped: int
+        Frame numbers skipped so far
+    """
+    def __init__(self, controller, count=None, timeout=None, start=True):
+        self.controller = controller
+        self.count = count
+        self.timeout = timeout
+        self.received = 0
+        self.dropped = 0
+
+        self._started = start
+        self._closed = False
+        self._changed = threading.Condition()
+        # announced frame numbers, in order, and announced files by the
+        # frame number they were announced at
+        self._sequences = collections.deque()
+        self._filenames = {}
+        # event loops waiting in __anext__, as (loop, future) pairs
+        self._async_waiters = []
+
+        # the frame number of the newest frame yielded, the newest ACQCOUNT
+        # broadcast, and the newest file
+        self._last_sequence = 0
+        self._newest_sequence = 0
+        self._previous_file = None
+
+        self._acq_count = controller._keyword('ACQCOUNT')
+        self._last_file = controller._keyword('LASTFILE')
+        self._exposure_time = controller._read('EXPOSURE')
+        for ktl_keyword in (self._acq_count, self._last_file):
+            ktl_keyword.callback(self._broadcast)
+            ktl_keyword.monitor()
+        # count frames from the current values, and forget anything
+        # broadcast while monitoring was starting
+        last_sequence = int(self._acq_count.read())
+        previous_file = self._last_file.read()
+        with self._changed:
+            self._last_sequence = self._newest_sequence = last_sequence
+            self._previous_file = previous_file
+            self._sequences.clear()
+            self._filenames.clear()
+
+        if start:
+            controller.set_exposure_mode('Continuous')
+            controller.expose('Start')
+
+    def _broadcast(self, ktl_keyword):
+        # ktl callback for ACQCOUNT and LASTFILE, must not block
+        name = ktl_keyword['name'].upper()
+        value = ktl_keyword['ascii']
+        with self._changed:
+            if name == 'ACQCOUNT':
+                sequence = int(value)
+                self._sequences.append((sequence, ktl_keyword['timestamp']))
+                self._newest_sequence = max(self._newest_sequence, sequence)
+            elif value != self._previous_file:
+                # the service sets ACQCOUNT before it writes LASTFILE, so the
+                # file belongs to the newest frame number
+                self._previous_file = value
+                self._filenames[self._newest_sequence] = value
+            self._changed.notify_all()
+            waiters, self._async_waiters = self._async_waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_resolve, future)
+
+    def _pop_frame(self):
+        # the next complete frame, or None. Call with _changed held
+        while self._sequences:
+            sequence, timestamp = self._sequences[0]
+            if sequence <= self._last_sequence:
+                # an old broadcast, e.g. the value when monitoring started
+                self._sequences.popleft()
+            elif sequence in self._filenames:
+                break
+            elif any(announced > sequence for announced in self._filenames):
+                # a later frame has its file, this frame's was never
+                # announced, count it as dropped
+                self._sequences.popleft()
+            else:
+                return None
+        else:
+            return None
+        self._sequences.popleft()
+        filename = self._filenames.pop(sequence)
+        for announced in [announced for announced in self._filenames if announced < sequence]:
+            # files of frames that were never announced by ACQCOUNT
+            del self._filenames[announced]
+        dropped = sequence - self._last_sequence - 1
+        self._last_sequence = sequence
+        self.dropped += dropped
+        self.received += 1
+        return StreamedFrame(sequence, filename, timestamp, self._exposure_time, dropped)
+
+    def _finished(self):
+        return self._closed or (self.count is not None and self.received >= self.count)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._finished():
+            self.close()
+            raise StopIteration
+        deadline = None if self.timeout is None else monotonic() + self.timeout
+        with self._changed:
+            frame = self._pop_frame()
+            while frame is None:
+                wait_time = None if deadline is None else deadline - monotonic()
+                if wait_time is not None and wait_time <= 0:
+                    raise TimeoutError('no frame after %s in %s s' % (self._last_sequence,
+                                                                      self.timeout))
+                self._changed.wait(wait_time)
+                if self._closed:
+                    raise StopIteration
+                frame = self._pop_frame()
+        return frame
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._finished():
+            self.close()
+            raise StopAsyncIteration
+        loop = asyncio.get_event_loop()
+        deadline = None if self.timeout is None else loop.time() + self.timeout
+        while True:
+            with self._changed:
+                frame = self._pop_frame()
+                if frame is not None:
+                    return frame
+                if self._closed:
+                    raise StopAsyncIteration
+                future = loop.create_future()
+                self._async_waiters.append((loop, future))
+            wait_time = None if deadline is None else deadline - loop.time()
+            if wait_time is not None and wait_time <= 0:
+                raise TimeoutError('no frame after %s in %s s' % (self._last_sequence,
+                                                                  self.timeout))
+            try:
+                await asyncio.wait_for(future, wait_time)
+            except asyncio.TimeoutError:
+                pass
+
+    def close(self):
+        """
+        Stop watching for frames, and stop the exposure with expose('Stop')
+        if the stream started it. Safe to call more than once.
+
+        Returns
+        -------
+        None
+        """
+        with self._changed:
+            if self._closed:
+                return
+            self._closed = True
+            self._changed.notify_all()
+            waiters, self._async_waiters = self._async_waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_resolve, future)
+        try:
+            if self._started:
+                self.controller.expose('Stop')
+        finally:
+            for ktl_keyword in (self._acq_count, self._last_file):
+                ktl_keyword.callback(self._broadcast, remove=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+
+def _resolve(future):
+    # wake an async waiter, from its own event loop
+    if not future.done():
+        future.set_result(None)
+
+
 class AndorCameraController(Controller):
     """
     Wrapper class for the iXon 888 ktl keyword service.
 
+    Parameters
+    ----------
+    service_name: string
+        The name of the ktl keyword service, e.g. 'shanegcam'
+    service_config_dict: dict
+        ktl keyword: value pairs written to the service at startup
+    verbose: bool, optional
+        Set to False to turn off print outputs
+    ktl_backend: string or module, optional
+        Which ktl implementation to use, see get_ktl_backend. Use 'fake' to
+        run against the in-memory fake_ktl service.
+    cached: bool, optional
+        If True, monitor the keywords used by the get methods, and serve the
+        get methods from the latest broadcast values instead of reading the
+        keyword server every time. Default is False.
+    max_staleness: float or None, optional
+        Only used if cached is True. A cached value older than this many
+        seconds is read from the keyword server again. None trusts the
+        broadcasts indefinitely, since keywords only broadcast on change.
+    metadata_dir: string, optional
+        Where to keep the keyword metadata file, see ktl_metadata. Defaults
+        to ~/.cache/qemachine.
+
     Notes
     -----
     The behavior of taking an exposure with ktl keywords needs to be tested.
+
+    The keyword handles are looked up once, when the class instance is
+    created. Writing a keyword through this class drops its cached value, so
+    a get right after a set always sees the new value.
+
+    Every value is checked against the keyword's type, enumerators and range
+    before it is written, and a bad value raises a ValueError without a
+    round trip to the keyword server. The metadata is asked from the service
+    the first time the service is used, and saved for later startups.
     """
-    def __init__(self, service_name, service_config_dict, verbose=True):
+    def __init__(self, service_name, service_config_dict, verbose=True, ktl_backend=None,
+                 cached=False, max_staleness=None, metadata_dir=None):
+
+        self.verbose = verbose
+        self.service_name = service_name
+        self.andor_service = get_ktl_backend(ktl_backend).Service(service_name)
+
+        # resolve the keyword handles once, instead of on every call
+        self._keywords = {}
+        for keyword in _ANDOR_KEYWORDS:
+            try:
+                self._keywords[keyword] = self.andor_service[keyword]
+            except KeyError:
+                # not every service has every keyword, only fail if it is used
+                pass
+
+        # keyword types, enumerators and ranges, to check values locally
+        self.metadata = ktl_metadata.KeywordMetadata(self.andor_service, service_name,
+                                                     metadata_dir)
+        self.metadata.fetch(_ANDOR_KEYWORDS)
+
+        # frame count and file when the latest exposure was started
+        self._start_count = 0
+        self._start_file = None
+
+        # keyword: (ascii value, monotonic time received), or None if not cached
+        self.max_staleness = max_staleness
+        self._cache = None
+        if cached:
+            self._cache = {}
+            for keyword in _ANDOR_CACHED_KEYWORDS:
+                if keyword in self._keywords:
+                    self._keywords[keyword].callback(self._keyword_broadcast)
+                    self._keywords[keyword].monitor()
+
+        if verbose:
+            print('Setting up initial configuration ')
+        self.configure(service_config_dict)
+
+    def _keyword(self, keyword):
+        # the keyword handle, looked up in the service only if it wasn't
+        # resolved at construction
+        ktl_keyword = self._keywords.get(keyword)
+        if ktl_keyword is None:
+            ktl_keyword = self._keywords[keyword] = self.andor_service[keyword]
+        return ktl_keyword
+
+    def _keyword_broadcast(self, ktl_keyword):
+        # ktl callback, runs whenever a monitored keyword broadcasts a new value
+        self._cache[ktl_keyword['name'].upper()] = (ktl_keyword['ascii'], monotonic())
+
+    def _read(self, keyword):
+        # read a keyword, from the cache if it is fresh enough
+        if self._cache is not None:
+            entry = self._cache.get(keyword)
+            if entry is not None and (self.max_staleness is None
+                                      or monotonic() - entry[1] <= self.max_staleness):
+                if metrics.registry.enabled:
+                    metrics.registry.increment('ktl_cache_hits_total', service=self.service_name,
+                                               keyword=keyword)
+                return entry[0]
+
+        if metrics.registry.enabled:
+            start = perf_counter()
+            value = self._keyword(keyword).read()
+            metrics.registry.observe('ktl_read_seconds', perf_counter() - start,
+                                     service=self.service_name, keyword=keyword)
+        else:
+            value = self._keyword(keyword).read()
+        if self._cache is not None and keyword in _ANDOR_CACHED_KEYWORDS:
+            self._cache[keyword] = (value, monotonic())
+        return value
+
+    def _write(self, keyword, value):
+        # check the value, write the keyword, and forget the cached value
+        # until the new one arrives
+        value = self.metadata.validate(keyword, value)
+        if self._cache is not None:
+            self._cache.pop(keyword, None)
+        wire_log.record(self.service_name, 'write', value, keyword=keyword)
+        if metrics.registry.enabled:
+            start = perf_counter()
+            seq_number = self._keyword(keyword).write(value)
+            metrics.registry.observe('ktl_write_seconds', perf_counter() - start,
+                                     service=self.service_name, keyword=keyword)
+            return seq_number
+        return self._keyword(keyword).write(value)
+
+    def cached_value(self, keyword):
+        """
+        Return the cached value of a monitored keyword, and how old it is.
+
+        Parameters
+        ----------
+        keyword: string
+            e.g. 'CURRTEMP'
+
+        Returns
+        -------
+        value: string or None
+            The latest broadcast value, or None if there is none
+        age: float or None
+            Seconds since the value was received, or None if there is none
+        """
+        entry = None if self._cache is None else self._cache.get(keyword.upper())
+        if entry is None:
+            return None, None
+        return entry[0], monotonic() - entry[1]
+
+    def configure(self, keyword_dict, timeout=None):
+        """
+        Write several ktl keywords at once, e.g. to reconfigure the camera
+        between exposures.
+
+        All the writes are sent before waiting on any of them, so this costs
+        about one round trip to the keyword server regardless of how many
+        keywords are written.
+
+        Parameters
+        ----------
+        keyword_dict: dict
+            ktl keyword: value pairs
+        timeout: float, optional
+            Seconds to wait for the writes to complete
+
+        Returns
+        -------
+        None
 
-        self.andor_service = ktl.Service(service_name)
-        # _write_keywords(self.andor_service, service_config_dict)
-        _write_keywords(self.andor_service, service_config_dict, verbose=verbose)
+        Raises
+        ------
+        KeywordWriteError:
+            If any of the writes failed. Every write is still attempted, and
+            the failures are listed together.
+        """
+        # check every value before writing any of them
+        checked = {}
+        failures = {}
+        for keyword, value in keyword_dict.items():
+            try:
+                checked[keyword] = self.metadata.validate(keyword, value)
+            except KeyError:
+                # not a keyword of this service, _write_keywords reports it
+                checked[keyword] = value
+            except ValueError as err:
+                failures[keyword] = err
+        if failures:
+            raise KeywordWriteError(failures)
+
+        if self._cache is not None:
+            for keyword in checked:
+                self._cache.pop(keyword.upper(), None)
+        _write_keywords(self.andor_service, checked, verbose=self.verbose, timeout=timeout)
 
     def expose(self, command):
         # start an exposure
@@ -141,19 +666,130 @@ class AndorCameraController(Controller):
         # None, Abort, Stop, Start
         # python doesn't have enums in the C sense. Instead, pass matching strings
         # alternetely, passing the enum value is possible, enable this
-        # casefold generates all lowercase, useful for case insensitive validation
-        valid = {string.casefold() for string in {'None', 'Abort', 'Stop', 'Start'}}
-        if command.casefold() not in valid:
-            raise ValueError('expose: command must be one of %s' % valid)
-        self.andor_service['EXPOSE'].write(command)
+        # the valid values come from the keyword metadata, matched case insensitively
+        command = self.metadata.validate('EXPOSE', command)
+        if str(command).casefold() == 'start':
+            # remember the frame count and file, to tell when this exposure's
+            # frame is done
+            self._start_count = int(self._keyword('ACQCOUNT').read())
+            self._start_file = self._keyword('LASTFILE').read()
+        self._write('EXPOSE', command)
+
+    def _wait_for_keywords(self, keywords, condition, timeout=None):
+        # block until condition(values) is True, where values is a dict of
+        # the latest ascii value of each keyword. The condition is checked
+        # on every broadcast, so no transition is missed between polls
+        # returns the values, or raises TimeoutError
+        values = {}
+        ready = threading.Event()
+
+        def broadcast(ktl_keyword):
+            values[ktl_keyword['name'].upper()] = ktl_keyword['ascii']
+            if condition(values):
+                ready.set()
+
+        handles = [self._keyword(keyword) for keyword in keywords]
+        for ktl_keyword in handles:
+            ktl_keyword.callback(broadcast)
+            ktl_keyword.monitor()
+        try:
+            for keyword, ktl_keyword in zip(keywords, handles):
+                values.setdefault(keyword, ktl_keyword.read())
+            if condition(values):
+                ready.set()
+            if not ready.wait(timeout):
+                raise TimeoutError('timed out after %s s waiting on %s, last values %s'
+                                   % (timeout, ', '.join(keywords), values))
+        finally:
+            for ktl_keyword in handles:
+                ktl_keyword.callback(broadcast, remove=True)
+        return values
+
+    def wait_for_readout(self, timeout=None):
+        """
+        Block until the exposure started by expose('Start') has finished
+        integrating, and the frame is reading out or done.
+
+        After this returns, the lamp and monochromator can be changed
+        without affecting the frame.
+
+        Parameters
+        ----------
+        timeout: float, optional
+            Seconds to wait. None waits forever.
+
+        Returns
+        -------
+        None
+        """
+        start_count = self._start_count
+
+        def integrated(values):
+            return (values.get('ACQPHASE', '').casefold() == 'readout'
+                    or int(values.get('ACQCOUNT', start_count)) > start_count)
+
+        self._wait_for_keywords(('ACQPHASE', 'ACQCOUNT'), integrated, timeout=timeout)
+
+    def wait_for_frame(self, timeout=None):
+        """
+        Block until the frame of the exposure started by expose('Start') has
+        been read out.
+
+        Parameters
+        ----------
+        timeout: float, optional
+            Seconds to wait. None waits forever.
+
+        Returns
+        -------
+        filename: string
+            The file the frame was written to, from LASTFILE
+
+        Notes
+        -----
+        The service updates ACQCOUNT and LASTFILE one after the other, so
+        both are waited on together: the frame is only done once ACQCOUNT
+        has gone up and LASTFILE has changed, and the filename returned is
+        the LASTFILE that satisfied the wait, never the previous frame's.
+        """
+        start_count = self._start_count
+        start_file = self._start_file
+
+        def read_out(values):
+            # a broadcast can arrive before both keywords have been read
+            return (int(values.get('ACQCOUNT', start_count)) > start_count
+                    and values.get('LASTFILE', start_file) != start_file)
+
+        values = self._wait_for_keywords(('ACQCOUNT', 'LASTFILE'), read_out, timeout=timeout)
+        return values['LASTFILE']
+
+    def stream_frames(self, count=None, timeout=None, start=True):
+        """
+        Expose continuously, and iterate over the frames as they are read
+        out, without any per-frame setup.
+
+        Parameters
+        ----------
+        count: int, optional
+            Stop after this many frames. None streams until the stream is
+            closed.
+        timeout: float, optional
+            Seconds to wait for each frame before raising TimeoutError
+        start: bool, optional
+            If True, set EXPMODE to Continuous and start exposing
+
+        Returns
+        -------
+        instance of class FrameStream
+            An iterator and async iterator of StreamedFrame, which stops the
+            exposure with expose('Stop') when it is closed, if it started it
+        """
+        return FrameStream(self, count=count, timeout=timeout, start=start)
 
     def set_exposure_mode(self, expmode):
         # set the exposure mode, e.g., single or continuous
-        # use matching strings instead of enum
-        valid = {string.casefold() for string in {'Single', 'Continuous'}}
-        if expmode.casefold() not in valid:
-            raise ValueError('set_exposure_mode: expmode must be one of %s' % valid)
-        self.andor_service['EXPMODE'].write(expmode)
+        # use matching strings instead of enum, e.g. 'Single' or 'Continuous'
+        self._write('EXPMODE', expmode)
 
     def get_exposure_mode(self):
         # retrieve the exposure mode setting
@@ -161,11 +797,11 @@ class AndorCameraController(Controller):
 
     def set_exposure_time(self, new_exposure_time):
         # set the exposure time
-        self.andor_service['EXPOSURE'].write(new_exposure_time)
+        self._write('EXPOSURE', new_exposure_time)
 
     def get_exposure_time(self):
         # retrieve the current exposure time setting
-        return self.andor_service['EXPOSURE'].read()
+        return self._read('EXPOSURE')
 
     def set_cooler(self, cooler_on):
         # turn the cooler on or off
@@ -180,29 +816,140 @@ class AndorCameraController(Controller):
         -------
 
         """
-        self.andor_service['COOLING'].write(cooler_on)
+        self._write('COOLING', cooler_on)
         # cooler_on possibly needs to be stringified
 
     def get_cooler(self):
         # retrieve the current cooler setting
-        return self.andor_service['COOLING'].read()
+        return self._read('COOLING')
 
     def set_temp(self, target_temp):
         # set the target temperature of the cooler
 
         # pass the target temperature to the ktl service
-        ktl_function_code = self.andor_service['COOLTARG'].write(target_temp)
+        ktl_function_code = self._write('COOLTARG', target_temp)
 
         # to check what the current target temp is
         # current_target = keyword.read()
 
     def get_targ_temp(self):
         # retrieve the target temperature of the cooler
-        return self.andor_service['COOLTARG'].read()
+        return self._read('COOLTARG')
 
     def get_curr_temp(self):
         # retrieve the current temperature of the cooler
-        return self.andor_service['CURRTEMP'].read()
+        return self._read('CURRTEMP')
+
+    def wait_for_temperature(self, target=None, tolerance=0.5, stable_for=30.0, timeout=None,
+                             wait=True):
+        """
+        Wait until the detector temperature has settled at the target.
+
+        The temperature counts as settled once CURRTEMP has stayed within
+        tolerance of the target for stable_for seconds. CURRTEMP is watched
+        through its broadcasts, so waiting does not cost any keyword reads
+        beyond the first.
+
+        Parameters
+        ----------
+        target: float, optional
+            Target temperature, in degrees C. Defaults to the cooler target
+            temperature, COOLTARG.
+        tolerance: float, optional
+            Allowed difference from the target, in degrees C
+        stable_for: float, optional
+            Seconds the temperature has to stay within tolerance
+        timeout: float, optional
+            Seconds to wait before giving up. None waits forever.
+        wait: bool, optional
+            If True, block until the temperature has settled. If False,
+            wait in a background thread, and return immediately with a
+            concurrent.futures.Future, so the rest of the setup can carry on.
+
+        Returns
+        -------
+        temperature: float
+            The settled temperature. If wait is False, a Future that
+            resolves to it instead.
+
+        Raises
+        ------
+        TimeoutError:
+            If the temperature has not settled after timeout seconds. If wait
+            is False, the Future raises it instead.
+        """
+        if not wait:
+            future = concurrent.futures.Future()
+
+            def run():
+                if not future.set_running_or_notify_cancel():
+                    return
+                try:
+                    future.set_result(self.wait_for_temperature(target, tolerance, stable_for,
+                                                                timeout))
+                except BaseException as err:
+                    future.set_exception(err)
+
+            threading.Thread(target=run, name='wait_for_temperature', daemon=True).start()
+            return future
+
+        if target is None:
+            target = float(self.get_targ_temp())
+        deadline = None if timeout is None else monotonic() + timeout
+
+        changed = threading.Condition()
+        # latest temperature, and when it last came within tolerance
+        state = {'temperature': None, 'since': None}
+
+        def record(temperature):
+            with changed:
+                state['temperature'] = temperature
+                if abs(temperature - target) > tolerance:
+                    state['since'] = None
+                elif state['since'] is None:
+                    state['since'] = monotonic()
+                changed.notify_all()
+
+        def broadcast(ktl_keyword):
+            record(float(ktl_keyword['ascii']))
+
+        curr_temp = self._keyword('CURRTEMP')
+        curr_temp.callback(broadcast)
+        curr_temp.monitor()
+        try:
+            record(float(curr_temp.read()))
+            with changed:
+                while True:
+                    now = monotonic()
+                    if state['since'] is not None and now - state['since'] >= stable_for:
+                        return state['temperature']
+                    if deadline is not None and now >= deadline:
+                        raise TimeoutError('CURRTEMP %s did not settle at %s +/- %s within %s s'
+                                           % (state['temperature'], target, tolerance, timeout))
+                    # sleep until the next broadcast, or until the temperature
+                    # has been stable long enough, or the timeout
+                    wake = deadline
+                    if state['since'] is not None:
+                        stable_at = state['since'] + stable_for
+                        wake = stable_at if wake is None else min(wake, stable_at)
+                    changed.wait(None if wake is None else wake - now)
+        finally:
+            curr_temp.callback(broadcast, remove=True)
+
+    async def wait_for_temperature_async(self, target=None, tolerance=0.5, stable_for=30.0,
+                                         timeout=None):
+        """
+        Coroutine version of wait_for_temperature, for use in an event loop.
+
+        Parameters are the same as wait_for_temperature.
+
+        Returns
+        -------
+        temperature: float
+            The settled temperature
+        """
+        return await asyncio.wrap_future(self.wait_for_temperature(target, tolerance, stable_for,
+                                                                   timeout, wait=False))
 
     def set_amp(self):
         # select the readout amplifier
@@ -215,38 +962,29 @@ class AndorCameraController(Controller):
 
     def set_gain(self, gainmode):
         # select the gain
-        # use matching strings to replace enums
-        valid = {string.casefold() for string in {'Gain1', 'Gain2'}}
-        if gainmode.casefold() not in valid:
-            raise ValueError('set_gain: gainmode must be one of %s' % valid)
-        self.andor_service['GAINMODE'].write(gainmode)
+        # use matching strings to replace enums, e.g. 'Gain1'
+        self._write('GAINMODE', gainmode)
 
     def get_gain(self):
         # retrieve the current gain
-        return self.andor_service['GAINMODE'].read()
+        return self._read('GAINMODE')
 
     def set_read_speed(self, readmode):
         # select the readout speed
-        # use matching strings to replace enums
-        valid = {string.casefold() for string in {'1.0MHz', '0.1MHz'}}
-        if readmode.casefold() not in valid:
-            raise ValueError('set_read_speed: readmode must be one of %s' % valid)
-        self.andor_service['READMODE'].write(readmode)
+        # use matching strings to replace enums, e.g. '1.0MHz'
+        self._write('READSPEED', readmode)
 
     def get_read_speed(self):
         # retrieve the current readout speed
-        return self.andor_service['READSPEED'].read()
+        return self._read('READSPEED')
 
     def set_binning(self, new_bins):
-        # use matching strings to replace enums
-        valid = {string.casefold() for string in {'1,1', '2,2', '4,4'}}
-        if new_bins.casefold() not in valid:
-            raise ValueError('set_binning: new_bins must be one of %s' % valid)
-        self.andor_service['BINNING'].write(new_bins)
+        # use matching strings to replace enums, e.g. '2,2'
+        self._write('BINNING', new_bins)
 
     def get_binning(self):
         # retrieve the current pixel binning
-        return self.andor_service['BINNING'].read()
+        return self._read('BINNING')
 
     def set_window(self, window_array):
         # define a window, i.e., a region of interest or subsection of the CCD
@@ -273,27 +1011,37 @@ class AndorCameraController(Controller):
         -------
 
         """
-        self.andor_service['WINDOW'].write(window_array)
+        self._write('WINDOW', window_array)
 
     def get_window(self):
         # retrieve the current image window
-        return self.andor_service['WINDOW'].read()
+        return self._read('WINDOW')
 
     def set_shutter(self, shuttermode):
         # open or close the camera shutter
         # possible values
         # 'auto', 'open', 'shut'
         # use matching strings instead of enums
-        valid = {string.casefold() for string in {'auto', 'open', 'shut'}}
-        if shuttermode.casefold() not in valid:
-            raise ValueError('set_shutter: shuttermode must be one of %s' % valid)
-        self.andor_service['SHUTTERMODE'].write(shuttermode)
+        self._write('SHUTTERMODE', shuttermode)
 
     def get_shutter(self):
         # retrieve the current shutter mode
-        return self.andor_service['SHUTTERMODE'].read()
+        return self._read('SHUTTERMODE')
 
+    def keyword_state(self):
+        """
+        Return the camera settings, e.g. to journal them with each point of a
+        scan and put the camera back the same way after a restart.
 
+        In cached mode this is read from the keyword cache, without a round
+        trip to the keyword server.
+
+        Returns
+        -------
+        state: dict
+            keyword: value pairs, that configure accepts
+        """
+        return {keyword: self._read(keyword) for keyword in _ANDOR_STATE_KEYWORDS}
 
 
 def _read_keywords(ktl_service, keyword_dict):
@@ -305,14 +1053,46 @@ def _read_keywords(ktl_service, keyword_dict):
         keyword_dict[keyword] = value
 
 
-def _write_keywords(ktl_service, keyword_dict, verbose=False):
+def _write_keywords(ktl_service, keyword_dict, verbose=False, timeout=None):
     # writes multiple ktl keywords
+    # every write is sent without waiting for it to finish, then all of them
+    # are waited on together, so the whole dict costs about one round trip
+    # to the keyword server instead of one per keyword
     if verbose:
-        print('Setting up initial configuration \n'
-              'Writing keywords...')
+        print('Writing keywords...')
+
+    timed = metrics.registry.enabled
+    service_name = getattr(ktl_service, 'name', '')
+    start = perf_counter()
+
+    failures = {}
+    in_flight = []
     for keyword, value in keyword_dict.items():
-        ktl_keyword = ktl_service[keyword]
-        seq_number = ktl_keyword.write(value)  # value possibly requires a string
-        if verbose:
-            # print the keyword value pairs
-            print(keyword, value)
+        try:
+            ktl_keyword = ktl_service[keyword]
+            # value possibly requires a string
+            seq_number = ktl_keyword.write(value, wait=False)
+        except Exception as err:
+            failures[keyword] = err
+            continue
+        in_flight.append((keyword, value, ktl_keyword, seq_number))
+
+    for keyword, value, ktl_keyword, seq_number in in_flight:
+        try:
+            if not ktl_keyword.wait(timeout=timeout, sequence=seq_number):
+                failures[keyword] = TimeoutError('write did not complete in %s s' % timeout)
+                continue
+        except Exception as err:
+            failures[keyword] = err
+            continue
+        if timed:
+            # time from the start of the bulk write to this write completing,
+            # kept apart from single writes, which it would skew
+            metrics.registry.observe('ktl_bulk_write_seconds', perf_counter() - start,
+                                     service=service_name, keyword=keyword)
+        # log, and if verbose print, the keyword value pairs
+        wire_log.record(service_name, 'write', value, echo=verbose, keyword=keyword)
+
+    if failures:
+        raise KeywordWriteError(failures)
+
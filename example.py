@@ -21,6 +21,8 @@ w_lamp.set_curr(4.56)  # set to limit of 4.56 amps
 
 w_lamp.on()  # turn on the lamp
 # the lamp has a warm-up period, unknown length
+# wait until the measured lamp power stops drifting, instead of a fixed sleep
+w_lamp.wait_for_warmup(tolerance=1e-3, timeout=900)
 
 andorcam.set_exposure_time(0.5)  # set exposure time to .5 seconds
 
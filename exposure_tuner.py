@@ -0,0 +1,319 @@
+"""
+Predicting the exposure time each point of a QE scan needs.
+
+The signal of a QE scan changes by orders of magnitude across the
+wavelength range, with the lamp spectrum, the grating efficiency and the
+detector QE. With a fixed or hand picked exposure time, points come out
+underexposed or saturated, and have to be taken again.
+
+ExposureTuner predicts the exposure time that gives a target signal at
+each wavelength, from
+
+- the count rate measured at the previous point of the scan
+- the shape of the response from an earlier scan, e.g. of the same
+  camera, saved with save_response
+- the lamp power the BK actually puts out, from
+  TungstenLamp.get_measured_outputs, so a lamp change between points, or
+  the lamp drifting in constant current mode, is allowed for
+
+and clamps it to what the detector can do. It plugs into run_qe_scan as
+the exposure time function, and is told the counts of each frame as soon as
+the frame is read out, before the next exposure time is asked for:
+
+>>> tuner = ExposureTuner(target_counts=30000, min_exposure=0.05, max_exposure=300,
+...                       saturation=60000, prior='response_2026-10-11.json',
+...                       w_lamp=w_lamp, bias=1000)
+>>> run_qe_scan(wavelengths, andorcam, monochromator, w_lamp, lamp_settings=settings_for,
+...             exposure_time=tuner, measure=tuner.measure)
+>>> tuner.save_response('response_2026-10-18.json')
+
+With a prior curve, the previous point sets the scale and the prior the
+shape, so a lamp that has dimmed with age, or a different bellows height,
+does not throw the prediction off. Without one, the previous point's rate
+is used as it is, which is close enough for the small steps of a scan.
+
+A saturated frame only shows the rate is at least saturation counts over
+its exposure time. The tuner uses that as a lower bound, so the next
+prediction is never longer than the saturating exposure scaled by
+target_counts / saturation.
+"""
+
+
+import json
+
+import numpy as np
+
+import frame_ingest
+
+
+class ExposureTuner:
+    """
+    Predicts per-wavelength exposure times for a target signal.
+
+    Parameters
+    ----------
+    target_counts: float
+        The signal to aim for, in counts above bias
+    min_exposure, max_exposure: float
+        The shortest and longest exposure times, in seconds, e.g. the
+        range of the EXPOSURE keyword, or the shortest time the shutter
+        gives an even exposure in
+    saturation: float, optional
+        Counts above bias at which the detector saturates. A measurement
+        this high only gives a lower limit on the count rate.
+    prior: string or tuple, optional
+        A response curve from an earlier scan, as the filename written by
+        save_response, or (wavelengths, rates) with rates in counts per
+        second per unit lamp power, i.e. per watt to the lamp_exponent.
+        (wavelengths, rates, lamp_exponent) is checked against
+        lamp_exponent.
+    w_lamp: TungstenLamp, optional
+        The lamp, asked for its measured output with get_measured_outputs
+        whenever a prediction is made. If None, and no lamp_power is given
+        to exposure_time, the lamp power is taken to be constant.
+    lamp_exponent: float, optional
+        The count rate is modeled as proportional to lamp power to this
+        power. Near the lamp's operating point, 1 is a fair approximation
+        in the red; blue wavelengths change faster.
+    bias: float or numpy.ndarray, optional
+        Subtracted from frames before measuring them, a level or a master
+        bias frame
+    region: tuple of slices, optional
+        The part of the frame to measure, e.g. (slice(200, 800),
+        slice(200, 800)). Defaults to the whole frame.
+    default_exposure: float, optional
+        Used when there is nothing to predict from, i.e. for the first
+        point of a scan with no prior
+    """
+    def __init__(self, target_counts, min_exposure, max_exposure, saturation=None, prior=None,
+                 w_lamp=None, lamp_exponent=1.0, bias=0.0, region=None, default_exposure=1.0):
+        if not 0 < min_exposure <= max_exposure:
+            raise ValueError('need 0 < min_exposure <= max_exposure, got %s and %s'
+                             % (min_exposure, max_exposure))
+        self.target_counts = target_counts
+        self.min_exposure = min_exposure
+        self.max_exposure = max_exposure
+        self.saturation = saturation
+        self.w_lamp = w_lamp
+        self.lamp_exponent = lamp_exponent
+        self.bias = bias
+        self.region = region
+        self.default_exposure = default_exposure
+
+        self.prior = None
+        if isinstance(prior, str):
+            prior = load_response(prior)
+        if prior is not None:
+            if len(prior) == 3:
+                if prior[2] != lamp_exponent:
+                    # the rates are per watt to a different power, they
+                    # would scale wrongly with the lamp
+                    raise ValueError('prior response has lamp_exponent %s, the tuner %s'
+                                     % (prior[2], lamp_exponent))
+                prior = prior[:2]
+            wavelengths, rates = (np.asarray(values, dtype=float) for values in prior)
+            order = np.argsort(wavelengths)
+            self.prior = (wavelengths[order], rates[order])
+
+        # wavelength: count rate per unit lamp power, measured this scan
+        self.rates = {}
+        # the wavelength measured most recently, normally the previous point
+        self._last_wavelength = None
+        # the lamp power each prediction was made with, for measure
+        self._lamp_power = {}
+        # wavelength: (exposure time, lamp power) of frames that saturated
+        self._saturated = {}
+
+    def _power(self, lamp_power=None):
+        if lamp_power is None:
+            if self.w_lamp is None:
+                return 1.0
+            volts, amps, _ = self.w_lamp.get_measured_outputs()
+            lamp_power = volts * amps
+        return max(lamp_power, 1e-6) ** self.lamp_exponent
+
+    def _prior_rate(self, wavelength):
+        wavelengths, rates = self.prior
+        return float(np.interp(wavelength, wavelengths, rates))
+
+    def predict_rate(self, wavelength):
+        """
+        The predicted count rate per unit lamp power at a wavelength.
+
+        Parameters
+        ----------
+        wavelength: float
+
+        Returns
+        -------
+        rate: float or None
+            Counts per second per unit lamp power, or None if there is
+            nothing to predict from
+        """
+        if self._last_wavelength is not None:
+            measured_wavelength = self._last_wavelength
+            measured_rate = self.rates[measured_wavelength]
+            if self.prior is not None:
+                prior_rate = self._prior_rate(measured_wavelength)
+                if prior_rate > 0:
+                    return measured_rate * self._prior_rate(wavelength) / prior_rate
+            return measured_rate
+        if self.prior is not None:
+            return self._prior_rate(wavelength)
+        return None
+
+    def exposure_time(self, wavelength, lamp_power=None):
+        """
+        Predict the exposure time for the target signal at a wavelength.
+
+        Parameters
+        ----------
+        wavelength: float
+        lamp_power: float, optional
+            The lamp power, in watts. Defaults to the measured output of
+            w_lamp.
+
+        Returns
+        -------
+        exposure_time: float
+            Seconds, clamped to min_exposure and max_exposure
+        """
+        power = self._power(lamp_power)
+        self._lamp_power[wavelength] = power
+        rate = self.predict_rate(wavelength)
+        if rate is None or rate <= 0:
+            exposure_time = self.default_exposure
+        else:
+            exposure_time = self.target_counts / (rate * power)
+        if wavelength in self._saturated:
+            # taking a saturated point again, stay below the exposure that
+            # saturated, scaled to the target and the lamp power now
+            saturated_exposure, saturated_power = self._saturated[wavelength]
+            exposure_time = min(exposure_time, saturated_exposure * saturated_power / power
+                                * self.target_counts / self.saturation)
+        return min(max(exposure_time, self.min_exposure), self.max_exposure)
+
+    # so the tuner can be passed as run_qe_scan's exposure_time
+    __call__ = exposure_time
+
+    def counts(self, frame):
+        """
+        The signal of a frame: the median of the region, above bias.
+
+        Parameters
+        ----------
+        frame: numpy.ndarray or string
+            The frame, or the name of its FITS file
+
+        Returns
+        -------
+        counts: float
+        """
+        if isinstance(frame, str):
+            fits_frame = frame_ingest.map_fits_frame(frame)
+            scale = float(fits_frame.header.get('BSCALE', 1))
+            zero = float(fits_frame.header.get('BZERO', 0))
+            data = fits_frame.data * scale + zero
+        else:
+            data = np.asarray(frame, dtype=float)
+        data = data - self.bias
+        if self.region is not None:
+            data = data[self.region]
+        return float(np.median(data))
+
+    def record(self, wavelength, exposure_time, counts, lamp_power=None):
+        """
+        Add a measurement to predict the following points from.
+
+        Parameters
+        ----------
+        wavelength: float
+        exposure_time: float
+            Seconds
+        counts: float
+            The signal, above bias
+        lamp_power: float, optional
+            The lamp power, in watts, the frame was taken with. Defaults to
+            the power of the last prediction at this wavelength.
+
+        Returns
+        -------
+        rate: float
+            The count rate per unit lamp power
+        """
+        if lamp_power is None:
+            lamp_power = self._lamp_power.get(wavelength, 1.0)
+        else:
+            lamp_power = self._power(lamp_power)
+        if self.saturation is not None and counts >= self.saturation:
+            # the true rate is higher, by an unknown amount, this is a lower
+            # bound on it
+            counts = self.saturation
+            self._saturated[wavelength] = (exposure_time, lamp_power)
+        else:
+            self._saturated.pop(wavelength, None)
+        rate = max(counts, 0.0) / (exposure_time * lamp_power)
+        self.rates[wavelength] = rate
+        self._last_wavelength = wavelength
+        return rate
+
+    def measure(self, wavelength, exposure_time, frame):
+        """
+        Measure a frame and record it, e.g. as run_qe_scan's measure.
+
+        Parameters
+        ----------
+        wavelength: float
+        exposure_time: float
+            Seconds
+        frame: numpy.ndarray or string
+            The frame, or the name of its FITS file
+
+        Returns
+        -------
+        counts: float
+            The signal of the frame, above bias
+        """
+        counts = self.counts(frame)
+        self.record(wavelength, exposure_time, counts)
+        return counts
+
+    def save_response(self, filename):
+        """
+        Save the count rates measured in this scan, as a prior for the next.
+
+        Parameters
+        ----------
+        filename: string
+
+        Returns
+        -------
+        None
+        """
+        wavelengths = sorted(self.rates)
+        with open(filename, 'w') as file:
+            json.dump({'wavelengths': wavelengths,
+                       'rates': [self.rates[wavelength] for wavelength in wavelengths],
+                       'lamp_exponent': self.lamp_exponent}, file, indent=1)
+
+
+def load_response(filename):
+    """
+    Read a response curve written by ExposureTuner.save_response.
+
+    Parameters
+    ----------
+    filename: string
+
+    Returns
+    -------
+    wavelengths: list of floats
+    rates: list of floats
+        Counts per second per unit lamp power
+    lamp_exponent: float
+        The lamp_exponent of the tuner that saved it, which sets the unit
+        of lamp power
+    """
+    with open(filename) as file:
+        response = json.load(file)
+    return response['wavelengths'], response['rates'], response.get('lamp_exponent', 1.0)
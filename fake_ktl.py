@@ -0,0 +1,484 @@
+"""
+An in-memory stand-in for the ktl python module.
+
+The real ktl module only exists on machines with a kroot install, see
+HowTo_ktl_python. This module provides the parts of the ktl interface the
+QE machine uses, backed by a simulated iXon 888 keyword service instead of
+a keyword server, so controller code can be imported, run, and profiled
+anywhere. Select it with 'ktl_backend' in a ccd_controller section of
+config.yaml:
+
+ccd_controller0:
+    ktl_service_name : 'shanegcam'
+    controller_type : 'andorcam'
+    ktl_backend : 'fake'
+
+The interface follows ktl:
+
+>>> import fake_ktl as ktl
+>>> service = ktl.Service('shanegcam')
+>>> keyword = service['EXPOSURE']     # keywords are case insensitive
+>>> keyword.write(0.5)                # waits, returns a sequence number
+>>> keyword.read()
+'0.500'
+>>> sequence = keyword.write(1.0, wait=False)
+>>> keyword.wait(sequence=sequence)
+True
+>>> keyword['binary']
+1.0
+
+Reads and writes take read_latency and write_latency seconds, like a round
+trip to a remote keyword server. Writing EXPOSE = 'Start' runs a simulated
+exposure in a background thread: ACQPHASE steps through 'expose',
+'readout' and 'done', taking EXPOSURE seconds plus a readout time worked
+out from READSPEED, BINNING and WINDOW, and ACQCOUNT counts the frames.
+CURRTEMP relaxes towards COOLTARG while COOLING is on. Keywords that are
+monitored get broadcasts, and their callbacks are called, whenever their
+value changes.
+"""
+
+
+import threading
+from time import monotonic, sleep, time
+
+
+class ktlError(Exception):
+    """Raised for failed keyword reads and writes, like ktl.ktlError"""
+    pass
+
+
+# the keywords of the simulated iXon 888 service
+# name: (type, initial value, options)
+# enumerated keywords accept either the enumerator string, in any case, or
+# its index, the same as ktl
+_ANDOR_KEYWORDS = {
+    'EXPOSE': ('KTL_ENUM', 'None', {'enumerators': ['None', 'Abort', 'Stop', 'Start']}),
+    'EXPOSURE': ('KTL_DOUBLE', 1.0, {'range': (0.0, 3600.0), 'units': 's'}),
+    'EXPMODE': ('KTL_ENUM', 'Single', {'enumerators': ['Single', 'Continuous']}),
+    'KINTIME': ('KTL_DOUBLE', 0.0, {'units': 's', 'writable': False}),
+    'ACCTIME': ('KTL_DOUBLE', 0.0, {'units': 's', 'writable': False}),
+    'ACQCOUNT': ('KTL_INT', 0, {'writable': False}),
+    'ACQPHASE': ('KTL_ENUM', 'done', {'enumerators': ['done', 'expose', 'readout'],
+                                      'writable': False}),
+    'CAMSTATUS': ('KTL_INT', 20073, {'writable': False}),
+    'COOLING': ('KTL_BOOLEAN', 'Off', {'enumerators': ['Off', 'On']}),
+    'COOLTARG': ('KTL_DOUBLE', -60.0, {'range': (-100.0, 20.0), 'units': 'degC'}),
+    'CURRTEMP': ('KTL_DOUBLE', 20.0, {'units': 'degC', 'writable': False}),
+    'GAINMODE': ('KTL_ENUM', 'Gain1', {'enumerators': ['Gain1', 'Gain2']}),
+    'READSPEED': ('KTL_ENUM', '1.0MHz', {'enumerators': ['1.0MHz', '0.1MHz']}),
+    'BINNING': ('KTL_ENUM', '1,1', {'enumerators': ['1,1', '2,2', '4,4']}),
+    'WINDOW': ('KTL_INT_ARRAY', [0, 1023, 0, 1023], {'range': (0, 1023)}),
+    'SHUTTERMODE': ('KTL_ENUM', 'auto', {'enumerators': ['auto', 'open', 'shut']}),
+    'OBSMODE': ('KTL_ENUM', 'Other', {'enumerators': ['Other', 'Bias', 'Dark', 'Flat', 'Object']}),
+    'FILENAME': ('KTL_STRING', 'frame', {}),
+    'LASTFILE': ('KTL_STRING', '', {'writable': False}),
+}
+
+# 1024 x 1024 pixel detector
+_DETECTOR_SHAPE = (1024, 1024)
+
+
+class Keyword:
+    """
+    A single simulated ktl keyword.
+
+    Keywords are not built directly, ask the Service for them, e.g.
+    service['CURRTEMP'].
+
+    Item access returns keyword metadata and the cached value, the same as
+    ktl: 'name', 'type', 'ascii', 'binary', 'timestamp', 'populated',
+    'monitored', 'enumerators', 'range', 'units', 'writable'.
+    """
+    def __init__(self, service, name, ktl_type, value, options):
+        self.service = service
+        self.name = name
+        self._type = ktl_type
+        self._options = options
+        self._callbacks = []
+        self._monitored = False
+        self._populated = False
+
+        self._binary = self._convert(value)
+        self._timestamp = time()
+
+        # sequence numbers of writes still in progress
+        self._pending = {}
+
+    def __repr__(self):
+        return '<fake_ktl.Keyword %s.%s>' % (self.service.name, self.name)
+
+    def __getitem__(self, item):
+        item = item.lower()
+        if item == 'name':
+            return self.name
+        if item == 'type':
+            return self._type
+        if item == 'ascii':
+            return self._ascii()
+        if item == 'binary':
+            return self._binary
+        if item == 'timestamp':
+            return self._timestamp
+        if item == 'populated':
+            return self._populated
+        if item == 'monitored':
+            return self._monitored
+        if item == 'writable':
+            return self._options.get('writable', True)
+        if item in ('enumerators', 'range', 'units'):
+            return self._options.get(item)
+        raise KeyError(item)
+
+    def _ascii(self):
+        if self._type == 'KTL_DOUBLE':
+            return '%.3f' % self._binary
+        if self._type == 'KTL_INT_ARRAY':
+            return ' '.join(str(number) for number in self._binary)
+        return str(self._binary)
+
+    def _convert(self, value):
+        # turn a written value into the stored value, or raise ktlError
+        try:
+            if self._type in ('KTL_ENUM', 'KTL_BOOLEAN'):
+                enumerators = self._options['enumerators']
+                if self._type == 'KTL_BOOLEAN' and isinstance(value, bool):
+                    return enumerators[int(value)]
+                if isinstance(value, int):
+                    return enumerators[value]
+                folded = {enumerator.casefold(): enumerator for enumerator in enumerators}
+                value = str(value)
+                if value.casefold() in folded:
+                    return folded[value.casefold()]
+                if value.isdigit():
+                    return enumerators[int(value)]
+                raise ValueError('must be one of %s' % enumerators)
+
+            if self._type == 'KTL_INT_ARRAY':
+                if isinstance(value, str):
+                    value = value.replace(',', ' ').split()
+                value = [int(number) for number in value]
+                numbers = value
+            elif self._type == 'KTL_DOUBLE':
+                value = float(value)
+                numbers = [value]
+            elif self._type == 'KTL_INT':
+                value = int(value)
+                numbers = [value]
+            else:
+                return str(value)
+
+            value_range = self._options.get('range')
+            if value_range is not None:
+                for number in numbers:
+                    if not value_range[0] <= number <= value_range[1]:
+                        raise ValueError('must be between %s and %s' % tuple(value_range))
+            return value
+
+        except (ValueError, TypeError, IndexError) as err:
+            raise ktlError('%s.%s: bad value %r, %s' % (self.service.name, self.name, value, err))
+
+    def _update(self, binary):
+        # store a new value, and broadcast it to any monitors
+        changed = binary != self._binary
+        self._binary = binary
+        self._timestamp = time()
+        self._populated = True
+        if changed and self._monitored:
+            for callback in list(self._callbacks):
+                callback(self)
+
+    def read(self, binary=False, timeout=None):
+        """
+        Read the keyword from the service.
+
+        Parameters
+        ----------
+        binary: bool, optional
+            If True, return the binary value instead of the ascii string
+        timeout: float, optional
+            Ignored, reads of the simulated service don't time out
+
+        Returns
+        -------
+        value: string, or the binary value
+        """
+        sleep(self.service.read_latency)
+        self.service._refresh(self.name)
+        self._populated = True
+        if binary:
+            return self._binary
+        return self._ascii()
+
+    def write(self, value, wait=True, timeout=None, binary=False):
+        """
+        Write a new value to the keyword.
+
+        Parameters
+        ----------
+        value:
+            The new value, as the keyword type or its string equivalent
+        wait: bool, optional
+            If True, block until the write completes. If False, return
+            immediately, and use wait(sequence=...) to wait for completion.
+        timeout: float, optional
+            The number of seconds to wait, if wait is True
+        binary: bool, optional
+            Ignored, both forms are accepted
+
+        Returns
+        -------
+        sequence: int
+            The sequence number of the write
+        """
+        if not self['writable']:
+            raise ktlError('%s.%s is read-only' % (self.service.name, self.name))
+        converted = self._convert(value)
+
+        sequence = self.service._next_sequence()
+        done = threading.Event()
+        self._pending[sequence] = done
+
+        def complete():
+            sleep(self.service.write_latency)
+            self.service._apply(self.name, converted)
+            done.set()
+
+        if wait:
+            complete()
+            del self._pending[sequence]
+        else:
+            threading.Thread(target=complete, daemon=True).start()
+        return sequence
+
+    def wait(self, timeout=None, sequence=None):
+        """
+        Wait for a write to complete.
+
+        Parameters
+        ----------
+        timeout: float, optional
+            Seconds to wait. None waits forever.
+        sequence: int, optional
+            The sequence number returned by write. If None, wait for every
+            write in progress.
+
+        Returns
+        -------
+        bool
+            True if the write completed, False if the timeout ran out
+        """
+        if sequence is None:
+            sequences = list(self._pending)
+        else:
+            sequences = [sequence]
+
+        deadline = None if timeout is None else monotonic() + timeout
+        for sequence in sequences:
+            done = self._pending.get(sequence)
+            if done is None:
+                continue
+            remaining = None if deadline is None else max(deadline - monotonic(), 0)
+            if not done.wait(remaining):
+                return False
+            self._pending.pop(sequence, None)
+        return True
+
+    def monitor(self, start=True, prime=True, wait=True):
+        """
+        Start, or stop, receiving broadcasts of new values.
+
+        Parameters
+        ----------
+        start: bool, optional
+            False stops monitoring
+        prime: bool, optional
+            If True, read the current value when monitoring starts
+        wait: bool, optional
+            Ignored, priming the simulated service is immediate
+
+        Returns
+        -------
+        None
+        """
+        self._monitored = start
+        if start and prime:
+            self.service._refresh(self.name)
+            self._populated = True
+
+    def callback(self, function, remove=False, preferred=False):
+        """
+        Register a function to call with this keyword on each broadcast.
+
+        Parameters
+        ----------
+        function: callable
+            Called as function(keyword)
+        remove: bool, optional
+            If True, remove the function instead
+        preferred: bool, optional
+            If True, call this function before the others
+
+        Returns
+        -------
+        None
+        """
+        if remove:
+            if function in self._callbacks:
+                self._callbacks.remove(function)
+        elif preferred:
+            self._callbacks.insert(0, function)
+        else:
+            self._callbacks.append(function)
+
+
+class Service:
+    """
+    A simulated iXon 888 ktl keyword service.
+
+    Parameters
+    ----------
+    name: string
+        The service name, e.g. 'shanegcam'
+    populate: bool, optional
+        Ignored, the keyword list is always available
+    read_latency: float, optional
+        Seconds each keyword read takes
+    write_latency: float, optional
+        Seconds each keyword write takes to complete
+    readout_time: float, optional
+        Seconds each frame takes to read out. If None, it is worked out from
+        READSPEED, BINNING and WINDOW.
+    cooling_rate: float, optional
+        Time constant, in seconds, of CURRTEMP relaxing to COOLTARG
+    update_interval: float, optional
+        Seconds between CURRTEMP broadcasts to monitored keywords
+    """
+    def __init__(self, name, populate=False, read_latency=0.005, write_latency=0.02,
+                 readout_time=None, cooling_rate=60.0, update_interval=0.5):
+        self.name = name
+        self.read_latency = read_latency
+        self.write_latency = write_latency
+        self.readout_time = readout_time
+        self.cooling_rate = cooling_rate
+        self.update_interval = update_interval
+
+        self._lock = threading.RLock()
+        self._sequence = 0
+        self._keywords = {keyword: Keyword(self, keyword, *definition)
+                          for keyword, definition in _ANDOR_KEYWORDS.items()}
+        self._last_temp_update = monotonic()
+
+        self._exposure_thread = None
+        self._stop_exposure = threading.Event()
+        self._abort_exposure = threading.Event()
+
+        # broadcast CURRTEMP changes in the background, like the real service
+        ticker = threading.Thread(target=self._tick, name='fake_ktl.%s' % name, daemon=True)
+        ticker.start()
+
+    def __repr__(self):
+        return "<fake_ktl.Service '%s'>" % self.name
+
+    def __getitem__(self, keyword):
+        try:
+            return self._keywords[keyword.upper()]
+        except KeyError:
+            raise KeyError('%s has no keyword %s' % (self.name, keyword))
+
+    def __contains__(self, keyword):
+        return keyword.upper() in self._keywords
+
+    def keywords(self):
+        """Return a list of all keyword names in the service"""
+        return list(self._keywords)
+
+    def _next_sequence(self):
+        with self._lock:
+            self._sequence += 1
+            return self._sequence
+
+    def _set(self, keyword, value):
+        with self._lock:
+            self._keywords[keyword]._update(value)
+
+    def _get(self, keyword):
+        return self._keywords[keyword]['binary']
+
+    def _refresh(self, keyword):
+        # bring time dependent keywords up to date
+        if keyword == 'CURRTEMP':
+            self._update_temperature()
+
+    def _update_temperature(self):
+        with self._lock:
+            now = monotonic()
+            elapsed = now - self._last_temp_update
+            self._last_temp_update = now
+
+            # relax towards the target while cooling, towards ambient if not
+            if self._get('COOLING') == 'On':
+                target = self._get('COOLTARG')
+            else:
+                target = 20.0
+            current = self._get('CURRTEMP')
+            fraction = min(elapsed / self.cooling_rate, 1.0)
+            self._set('CURRTEMP', round(current + (target - current) * fraction, 2))
+
+    def _tick(self):
+        while True:
+            sleep(self.update_interval)
+            self._update_temperature()
+
+    def _frame_readout_time(self):
+        if self.readout_time is not None:
+            return self.readout_time
+        hbeg, hend, vbeg, vend = self._get('WINDOW')
+        binning = int(self._get('BINNING').split(',')[0])
+        pixels = (hend - hbeg + 1) * (vend - vbeg + 1) / binning ** 2
+        pixel_rate = 1.0e6 if self._get('READSPEED') == '1.0MHz' else 1.0e5
+        return pixels / pixel_rate
+
+    def _apply(self, keyword, value):
+        # carry out a completed write
+        self._set(keyword, value)
+
+        if keyword == 'EXPOSURE':
+            self._set('KINTIME', value + self._frame_readout_time())
+        elif keyword == 'EXPOSE':
+            if value == 'Start':
+                self._start_exposure()
+            elif value == 'Stop':
+                self._stop_exposure.set()
+            elif value == 'Abort':
+                self._abort_exposure.set()
+                self._stop_exposure.set()
+
+    def _start_exposure(self):
+        if self._exposure_thread is not None and self._exposure_thread.is_alive():
+            return
+        self._stop_exposure.clear()
+        self._abort_exposure.clear()
+        self._exposure_thread = threading.Thread(target=self._run_exposures, daemon=True)
+        self._exposure_thread.start()
+
+    def _run_exposures(self):
+        # take frames until done, like the camera in Single or Continuous mode
+        while True:
+            self._set('ACQPHASE', 'expose')
+            start = monotonic()
+            if self._abort_exposure.wait(self._get('EXPOSURE')):
+                break
+            self._set('ACCTIME', round(monotonic() - start, 3))
+
+            self._set('ACQPHASE', 'readout')
+            if self._abort_exposure.wait(self._frame_readout_time()):
+                break
+            count = self._get('ACQCOUNT') + 1
+            self._set('ACQCOUNT', count)
+            self._set('LASTFILE', '%s_%04d.fits' % (self._get('FILENAME'), count))
+
+            if self._get('EXPMODE') == 'Single' or self._stop_exposure.is_set():
+                break
+
+        self._set('ACQPHASE', 'done')
+        self._set('EXPOSE', 'None')
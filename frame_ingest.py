@@ -0,0 +1,445 @@
+"""
+Streaming ingest of the FITS frames written by the CCD controller.
+
+FrameIngest watches the directory the controller writes its frames to, and
+yields each new frame as a numpy array that is memory mapped from the file,
+instead of being read into memory. The pixel data is only paged in from
+disk when it is used, and is never copied, so a long continuous-mode run
+uses the same amount of memory on the first frame as on the ten thousandth.
+
+New files are handed from a background watcher thread to the consumer
+through a bounded queue. If the consumer falls behind, the queue fills up
+and the watcher stops looking for files until the consumer catches up, so
+frames pile up on disk rather than in memory.
+
+>>> ingest = FrameIngest('/data/qe', pattern='frame_*.fits', max_queued=4)
+>>> ingest.start()
+>>> for frame in ingest:
+...     signal = frame.data[200:800, 200:800].mean()
+
+Only simple, single image FITS files are handled, which is what the Andor
+service writes. The data is returned exactly as stored: big-endian, with
+BZERO and BSCALE left in the header rather than applied, since applying
+them would copy the frame. E.g. unsigned 16 bit frames are stored as
+signed 16 bit integers with BZERO = 32768, and unsigned 32 bit frames as
+signed 32 bit integers with BZERO = 2147483648.
+"""
+
+
+import collections
+import fnmatch
+import os
+import queue
+import re
+import threading
+import time
+
+import numpy as np
+
+
+# FITS files are made of 2880 byte blocks, headers of 80 character cards
+_BLOCK_SIZE = 2880
+_CARD_SIZE = 80
+
+# FITS BITPIX to big-endian numpy dtype
+_BITPIX_DTYPES = {8: 'u1', 16: '>i2', 32: '>i4', 64: '>i8', -32: '>f4', -64: '>f8'}
+
+
+class IncompleteFrameError(ValueError):
+    """
+    A FITS file that is shorter than its header says, e.g. because the
+    controller has not finished writing it yet.
+    """
+
+
+Frame = collections.namedtuple('Frame', ['filename', 'header', 'data'])
+Frame.__doc__ = """
+A memory mapped FITS frame.
+
+filename: string
+    The file the frame was mapped from
+header: dict
+    FITS keyword: value pairs from the primary header
+data: numpy.memmap
+    The pixel data, read-only, shape (NAXIS2, NAXIS1)
+"""
+
+
+def _parse_card_value(raw_value):
+    # turn the value part of a FITS header card into a python value
+    string_value = re.match(r"\s*'((?:[^']|'')*)'", raw_value)
+    if string_value:
+        # strings are quoted, with '' for a literal quote
+        return string_value.group(1).replace("''", "'").rstrip()
+    # anything after a / is a comment
+    raw_value = raw_value.split('/')[0].strip()
+    if raw_value == 'T':
+        return True
+    if raw_value == 'F':
+        return False
+    for convert in (int, float):
+        try:
+            return convert(raw_value)
+        except ValueError:
+            pass
+    return raw_value
+
+
+def read_fits_header(file):
+    """
+    Read the primary header of a FITS file.
+
+    Parameters
+    ----------
+    file: file object
+        An open binary file, positioned at the start
+
+    Returns
+    -------
+    header: dict
+        FITS keyword: value pairs
+    data_offset: int
+        The byte offset of the start of the pixel data
+
+    Raises
+    ------
+    IncompleteFrameError:
+        If the file ends before the header does, e.g. because the
+        controller has not finished writing it yet
+    ValueError:
+        If the file is not a FITS file
+    """
+    header = {}
+    offset = 0
+    while True:
+        block = file.read(_BLOCK_SIZE)
+        if len(block) < _BLOCK_SIZE:
+            raise IncompleteFrameError('incomplete FITS header')
+        offset += _BLOCK_SIZE
+        for start in range(0, _BLOCK_SIZE, _CARD_SIZE):
+            card = block[start:start + _CARD_SIZE].decode('ascii', errors='replace')
+            keyword = card[:8].strip()
+            if keyword == 'END':
+                if 'SIMPLE' not in header:
+                    raise ValueError('not a FITS file')
+                return header, offset
+            if card[8:10] == '= ':
+                header[keyword] = _parse_card_value(card[10:])
+
+
+def map_fits_frame(filename):
+    """
+    Memory map the image in a FITS file.
+
+    Parameters
+    ----------
+    filename: string
+        Path of the FITS file
+
+    Returns
+    -------
+    Frame
+        The frame, with a read-only memory mapped data array
+
+    Raises
+    ------
+    IncompleteFrameError:
+        If the file is not completely written
+    ValueError:
+        If the file is not a 2D FITS image
+    """
+    with open(filename, 'rb') as file:
+        header, data_offset = read_fits_header(file)
+        file_size = os.fstat(file.fileno()).st_size
+
+    if header.get('NAXIS') != 2:
+        raise ValueError('%s: only 2D images are supported, NAXIS = %s'
+                         % (filename, header.get('NAXIS')))
+    if header.get('BITPIX') not in _BITPIX_DTYPES:
+        raise ValueError('%s: unsupported BITPIX %s' % (filename, header.get('BITPIX')))
+    if not all(isinstance(header.get(key), int) for key in ('NAXIS1', 'NAXIS2')):
+        raise ValueError('%s: bad NAXIS1, NAXIS2 %s, %s'
+                         % (filename, header.get('NAXIS1'), header.get('NAXIS2')))
+    dtype = np.dtype(_BITPIX_DTYPES[header['BITPIX']])
+    shape = (header['NAXIS2'], header['NAXIS1'])
+    if file_size < data_offset + dtype.itemsize * shape[0] * shape[1]:
+        raise IncompleteFrameError('%s: incomplete FITS data' % filename)
+
+    data = np.memmap(filename, dtype=dtype, mode='r', offset=data_offset, shape=shape)
+    return Frame(filename, header, data)
+
+
+def _format_card(keyword, value):
+    # one 80 character FITS header card
+    if isinstance(value, bool):
+        value = 'T' if value else 'F'
+    elif isinstance(value, str):
+        value = "'%-8s'" % value.replace("'", "''")
+    else:
+        value = repr(value)
+    return ('%-8s= %20s' % (keyword[:8].upper(), value)).ljust(_CARD_SIZE)[:_CARD_SIZE]
+
+
+def write_fits_frame(filename, data, header=None):
+    """
+    Write a 2D image to a simple FITS file.
+
+    The file is written under a temporary name and renamed into place, so a
+    FrameIngest watching the directory never sees it half written.
+
+    Parameters
+    ----------
+    filename: string
+    data: numpy.ndarray
+        The image, shape (height, width). Unsigned 16 and 32 bit data are
+        stored the FITS way, as signed integers of the same size with
+        BZERO = 32768 and 2147483648 respectively.
+    header: dict, optional
+        Extra keyword: value pairs, e.g. {'EXPTIME': 1.0}
+
+    Returns
+    -------
+    None
+    """
+    data = np.asarray(data)
+    if data.ndim != 2:
+        raise ValueError('only 2D images can be written, got shape %s' % (data.shape,))
+    zero = None
+    if data.dtype == np.uint16:
+        data = (data.astype(np.int32) - 32768).astype('>i2')
+        zero = 32768
+    elif data.dtype == np.uint32:
+        data = (data.astype(np.int64) - 2**31).astype('>i4')
+        zero = 2147483648
+    bitpix = {np.dtype(dtype): bitpix for bitpix, dtype in _BITPIX_DTYPES.items()}
+    dtype = data.dtype.newbyteorder('>') if data.dtype.itemsize > 1 else data.dtype
+    if dtype not in bitpix:
+        raise ValueError('can not write %s data to FITS' % data.dtype)
+
+    cards = [_format_card('SIMPLE', True), _format_card('BITPIX', bitpix[dtype]),
+             _format_card('NAXIS', 2), _format_card('NAXIS1', data.shape[1]),
+             _format_card('NAXIS2', data.shape[0])]
+    if zero is not None:
+        cards += [_format_card('BZERO', zero), _format_card('BSCALE', 1)]
+    for keyword, value in (header or {}).items():
+        cards.append(_format_card(keyword, value))
+    cards.append('END'.ljust(_CARD_SIZE))
+    header_bytes = ''.join(cards).encode('ascii')
+    header_bytes += b' ' * (-len(header_bytes) % _BLOCK_SIZE)
+    data_bytes = np.ascontiguousarray(data, dtype=dtype).tobytes()
+
+    temporary = '%s.%i.tmp' % (filename, os.getpid())
+    with open(temporary, 'wb') as file:
+        file.write(header_bytes)
+        file.write(data_bytes)
+        file.write(b'\0' * (-len(data_bytes) % _BLOCK_SIZE))
+    os.replace(temporary, filename)
+
+
+def _sort_key(name):
+    # compare the numbers in filenames as numbers, e.g. frame_9999.fits
+    # before frame_10000.fits
+    return [int(part) if index % 2 else part
+            for index, part in enumerate(re.split(r'(\d+)', name))]
+
+
+class FrameIngest:
+    """
+    Watch a directory for new FITS frames, and yield them memory mapped.
+
+    Parameters
+    ----------
+    directory: string
+        The directory the controller writes frames to
+    pattern: string, optional
+        Shell-style pattern of the frame filenames, e.g. 'frame_*.fits'
+    max_queued: int, optional
+        The most frames that can wait for the consumer. When the queue is
+        full, the watcher blocks until the consumer takes a frame.
+    poll_interval: float, optional
+        Seconds between directory scans
+    include_existing: bool, optional
+        If False, files already in the directory when start is called are
+        ignored. Default is False.
+    incomplete_timeout: float, optional
+        Seconds a file can stay incompletely written, without growing,
+        before it is given up on and skipped
+    verbose: bool, optional
+        Print the files that are skipped
+
+    Attributes
+    ----------
+    skipped: list
+        (filename, reason) of the files that were skipped, because they are
+        not readable frames or never finished being written
+
+    Notes
+    -----
+    A file is only yielded once it is completely written, i.e. its size
+    covers the header and all the pixel data the header describes. Files
+    are yielded in order of name, with the numbers in names compared as
+    numbers, which for the controller's numbered filenames is the order
+    they were taken, even past frame_9999.fits. Only files after the newest
+    one yielded are looked at, so a file that turns up with an older name
+    is ignored.
+
+    The directory is only listed again when its modification time changes,
+    and only the new files are sorted, so watching a directory of
+    thousands of frames costs the same as watching an empty one.
+    """
+    def __init__(self, directory, pattern='*.fits', max_queued=4, poll_interval=0.1,
+                 include_existing=False, incomplete_timeout=60.0, verbose=True):
+        self.directory = directory
+        self.pattern = pattern
+        self.poll_interval = poll_interval
+        self.include_existing = include_existing
+        self.incomplete_timeout = incomplete_timeout
+        self.verbose = verbose
+        self.skipped = []
+
+        self._queue = queue.Queue(maxsize=max_queued)
+        # sort key of the newest file yielded or skipped, later files only
+        # are looked at
+        self._newest = None
+        # new files in order, waiting to be yielded
+        self._pending = []
+        # modification time of the directory when it was last listed
+        self._listed_mtime = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._error = None
+
+    def start(self):
+        """
+        Start watching for new frames in a background thread.
+
+        Returns
+        -------
+        None
+        """
+        if not self.include_existing:
+            existing = self._list_frames()
+            if existing:
+                self._newest = _sort_key(existing[-1])
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._watch, name='FrameIngest', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop watching. Iteration ends once the frames already queued have
+        been yielded.
+
+        Returns
+        -------
+        None
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _list_frames(self):
+        # the matching files after the newest one so far, in order
+        names = [entry.name for entry in os.scandir(self.directory)
+                 if fnmatch.fnmatch(entry.name, self.pattern)
+                 and (self._newest is None or _sort_key(entry.name) > self._newest)
+                 and entry.is_file()]
+        return sorted(names, key=_sort_key)
+
+    def _update_pending(self):
+        # list the directory only if a file has been added or renamed since
+        # the last time. Timestamps can be as coarse as a second, so keep
+        # listing for a second after a change
+        mtime = os.stat(self.directory).st_mtime
+        if mtime == self._listed_mtime and time.time() - mtime > 1.0:
+            return
+        self._listed_mtime = mtime
+        pending = set(self._pending)
+        self._pending.extend(name for name in self._list_frames() if name not in pending)
+        self._pending.sort(key=_sort_key)
+
+    def _skip(self, name, reason):
+        self.skipped.append((name, str(reason)))
+        if self.verbose:
+            print('FrameIngest skipped %s: %s' % (name, reason))
+
+    def _put(self, item):
+        # block while the queue is full, but give up if stop is called
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=self.poll_interval)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _watch(self):
+        try:
+            while not self._stop.is_set():
+                self._update_pending()
+                while self._pending:
+                    name = self._pending[0]
+                    filename = os.path.join(self.directory, name)
+                    try:
+                        frame = map_fits_frame(filename)
+                    except IncompleteFrameError as err:
+                        # still being written, try again on the next scan
+                        # later files wait for it, to keep the frames in
+                        # order, unless it has stopped growing
+                        try:
+                            stalled = time.time() - os.stat(filename).st_mtime
+                        except FileNotFoundError:
+                            stalled = None
+                        if stalled is not None and stalled < self.incomplete_timeout:
+                            break
+                        frame = None
+                        self._skip(name, err if stalled is not None else 'deleted')
+                    except (ValueError, OSError) as err:
+                        # not a frame, or deleted, it will never be readable
+                        frame = None
+                        self._skip(name, err)
+                    if frame is not None and not self._put(frame):
+                        return
+                    self._pending.pop(0)
+                    self._newest = _sort_key(name)
+                self._stop.wait(self.poll_interval)
+        except Exception as err:
+            self._error = err
+        finally:
+            # tell the consumer there is nothing more coming
+            self._stop.set()
+
+    def __iter__(self):
+        return self.frames()
+
+    def frames(self, timeout=None):
+        """
+        Yield frames as they arrive, until stop is called.
+
+        Parameters
+        ----------
+        timeout: float, optional
+            Stop iterating if no new frame arrives for this many seconds.
+            None waits indefinitely.
+
+        Yields
+        ------
+        Frame
+            Each new frame, with memory mapped, read-only data
+        """
+        waited = 0.0
+        while True:
+            try:
+                frame = self._queue.get(timeout=self.poll_interval)
+            except queue.Empty:
+                if self._stop.is_set():
+                    if self._error is not None:
+                        raise self._error
+                    return
+                waited += self.poll_interval
+                if timeout is not None and waited >= timeout:
+                    return
+                continue
+            waited = 0.0
+            yield frame
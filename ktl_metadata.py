@@ -0,0 +1,287 @@
+"""
+Cached ktl keyword metadata, for checking values before they are written.
+
+A ktl keyword knows its own type, enumerators and range, so there is no
+need to keep hand written lists of valid values next to every setter. The
+metadata of each keyword is asked from the service once, and saved to a
+JSON file per service, so later startups do not have to ask again:
+
+~/.cache/qemachine/ktl_metadata_shanegcam.json
+
+{"service": "shanegcam",
+ "keywords": {"GAINMODE": {"type": "KTL_ENUM", "enumerators": ["Gain1", "Gain2"],
+                           "range": null, "units": null, "writable": true},
+              ...}}
+
+Values are then checked locally, so a bad value is rejected without a
+round trip to the keyword server.
+
+If the service has changed since the metadata was saved, e.g. a new
+readout speed was added, a value rejected by metadata loaded from disk
+makes the metadata of that keyword be fetched again, once, before the value
+is rejected for good.
+"""
+
+
+import json
+import os
+import threading
+
+
+# the metadata items asked from every keyword
+_ITEMS = ('type', 'enumerators', 'range', 'units', 'writable')
+
+_ENUM_TYPES = ('KTL_ENUM', 'KTL_ENUMM', 'KTL_BOOLEAN', 'KTL_MASK')
+_NUMBER_TYPES = {'KTL_DOUBLE': float, 'KTL_FLOAT': float, 'KTL_INT': int}
+_ARRAY_TYPES = {'KTL_DOUBLE_ARRAY': float, 'KTL_FLOAT_ARRAY': float, 'KTL_INT_ARRAY': int}
+
+
+def default_directory():
+    """
+    The directory metadata files are kept in, under XDG_CACHE_HOME or
+    ~/.cache.
+
+    Returns
+    -------
+    string
+    """
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'),
+                                                                  '.cache')
+    return os.path.join(cache_home, 'qemachine')
+
+
+def _fetch(ktl_keyword):
+    # ask a keyword for its metadata, as plain json-able types
+    metadata = {}
+    for item in _ITEMS:
+        try:
+            value = ktl_keyword[item]
+        except (KeyError, ValueError, TypeError):
+            value = None
+        if item == 'range' and isinstance(value, dict):
+            # ktl can give the range as {'minimum': ..., 'maximum': ...}
+            value = [value.get('minimum'), value.get('maximum')]
+        elif item in ('enumerators', 'range') and value is not None:
+            value = list(value)
+        metadata[item] = value
+    if metadata['writable'] is None:
+        metadata['writable'] = True
+    return metadata
+
+
+class KeywordMetadata:
+    """
+    The metadata of the keywords of one ktl service, kept in memory and on
+    disk.
+
+    Parameters
+    ----------
+    service: ktl.Service
+        The service to ask for metadata the cache does not have yet
+    service_name: string
+        The name of the service, used to name the metadata file
+    directory: string or None, optional
+        Where to keep the metadata file. Defaults to default_directory().
+        False keeps the metadata in memory only.
+    """
+    def __init__(self, service, service_name, directory=None):
+        self.service = service
+        self.service_name = service_name
+        if directory is None:
+            directory = default_directory()
+        self.filename = None
+        if directory is not False:
+            self.filename = os.path.join(directory, 'ktl_metadata_%s.json' % service_name)
+
+        self._lock = threading.Lock()
+        self._metadata = {}
+        # keywords whose metadata came from disk and has not been fetched
+        # from the service by this process
+        self._from_disk = set()
+        self._load()
+
+    def _load(self):
+        if self.filename is None:
+            return
+        try:
+            with open(self.filename) as file:
+                saved = json.load(file)
+        except (OSError, ValueError):
+            return
+        if saved.get('service') != self.service_name:
+            return
+        self._metadata.update(saved.get('keywords', {}))
+        self._from_disk.update(self._metadata)
+
+    def save(self):
+        """
+        Write the metadata file. Failing to write it is not an error, the
+        metadata will be fetched again next time.
+
+        Returns
+        -------
+        None
+        """
+        if self.filename is None:
+            return
+        with self._lock:
+            saved = {'service': self.service_name, 'keywords': dict(self._metadata)}
+        # write to a temporary file and rename, so a concurrent startup never
+        # reads half a file
+        temporary = '%s.%i' % (self.filename, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            with open(temporary, 'w') as file:
+                json.dump(saved, file, indent=1, sort_keys=True)
+            os.replace(temporary, self.filename)
+        except OSError:
+            try:
+                os.remove(temporary)
+            except OSError:
+                pass
+
+    def fetch(self, keywords, save=True):
+        """
+        Make sure the metadata of several keywords is cached, asking the
+        service only for the ones that are not.
+
+        Parameters
+        ----------
+        keywords: iterable of strings
+        save: bool, optional
+            If True, and anything was fetched, write the metadata file
+
+        Returns
+        -------
+        None
+        """
+        fetched = False
+        for keyword in keywords:
+            keyword = keyword.upper()
+            if keyword in self._metadata:
+                continue
+            try:
+                ktl_keyword = self.service[keyword]
+            except KeyError:
+                # not every service has every keyword, only fail if it is used
+                continue
+            self._store(keyword, _fetch(ktl_keyword))
+            fetched = True
+        if fetched and save:
+            self.save()
+
+    def refresh(self, keyword):
+        """
+        Fetch the metadata of a keyword from the service again.
+
+        Parameters
+        ----------
+        keyword: string
+
+        Returns
+        -------
+        metadata: dict
+        """
+        keyword = keyword.upper()
+        metadata = _fetch(self.service[keyword])
+        self._store(keyword, metadata)
+        self.save()
+        return metadata
+
+    def _store(self, keyword, metadata):
+        with self._lock:
+            self._metadata[keyword] = metadata
+            self._from_disk.discard(keyword)
+
+    def get(self, keyword):
+        """
+        Return the metadata of a keyword, fetching it if it is not cached.
+
+        Parameters
+        ----------
+        keyword: string
+
+        Returns
+        -------
+        metadata: dict
+            'type', 'enumerators', 'range', 'units' and 'writable'
+        """
+        keyword = keyword.upper()
+        metadata = self._metadata.get(keyword)
+        if metadata is None:
+            metadata = self.refresh(keyword)
+        return metadata
+
+    def validate(self, keyword, value):
+        """
+        Check a value against the metadata of a keyword, without asking the
+        keyword server.
+
+        Parameters
+        ----------
+        keyword: string
+            e.g. 'GAINMODE'
+        value: any
+            The value about to be written
+
+        Returns
+        -------
+        value:
+            The value to write. Enumerators are matched case insensitively,
+            and returned spelled the way the service spells them.
+
+        Raises
+        ------
+        ValueError:
+            If the value is not valid for the keyword
+        """
+        keyword = keyword.upper()
+        try:
+            return _check(keyword, self.get(keyword), value)
+        except ValueError:
+            if keyword not in self._from_disk:
+                raise
+        # the saved metadata may be out of date, check once more against
+        # what the service says now
+        return _check(keyword, self.refresh(keyword), value)
+
+
+def _check(keyword, metadata, value):
+    # check a value against keyword metadata, return the value to write
+    if not metadata['writable']:
+        raise ValueError('%s is read only' % keyword)
+
+    ktl_type = metadata['type']
+    enumerators = metadata['enumerators']
+    if ktl_type in _ENUM_TYPES and enumerators:
+        if isinstance(value, bool) and ktl_type == 'KTL_BOOLEAN':
+            return enumerators[int(value)]
+        if isinstance(value, int) and 0 <= value < len(enumerators):
+            return enumerators[value]
+        folded = {enumerator.casefold(): enumerator for enumerator in enumerators}
+        if str(value).casefold() in folded:
+            return folded[str(value).casefold()]
+        raise ValueError('%s must be one of %s, got %r' % (keyword, enumerators, value))
+
+    if ktl_type in _NUMBER_TYPES:
+        numbers = [value]
+        convert = _NUMBER_TYPES[ktl_type]
+    elif ktl_type in _ARRAY_TYPES:
+        numbers = value.replace(',', ' ').split() if isinstance(value, str) else value
+        convert = _ARRAY_TYPES[ktl_type]
+    else:
+        # strings and anything unknown are left to the service
+        return value
+
+    try:
+        numbers = [convert(number) for number in numbers]
+    except (ValueError, TypeError):
+        raise ValueError('%s must be %s, got %r' % (keyword, ktl_type, value))
+    value_range = metadata['range']
+    if value_range:
+        low, high = value_range
+        for number in numbers:
+            if (low is not None and number < low) or (high is not None and number > high):
+                raise ValueError('%s must be between %s and %s, got %r'
+                                 % (keyword, low, high, value))
+    return value
@@ -0,0 +1,343 @@
+"""
+Shared serial-over-TCP transport for the devices behind the Lantronix.
+
+The Lantronix turns each of its serial ports into a TCP port. The BK
+Precision 1697 lamp power supply, the IMC17 bellows lifter, and the
+Cornerstone 130 monochromator all talk ASCII over these ports, so the
+connect, timeout, and read handling lives here instead of in every device
+driver.
+
+Connections are pooled by address. Asking for the same address twice
+returns the same LantronixConnection, so every driver on a port shares one
+socket and one buffered reader. A connection that breaks is reopened on the
+next send, instead of waiting for a read to time out.
+
+The addresses are kept in the 'lantronix' section of config.yaml:
+
+lantronix :
+    bellows :
+        ip : '128.114.17.188'
+        port : 10001
+    w_lamp :
+        ip : '128.114.17.186'
+        port : 10002
+"""
+
+
+import select
+import socket
+import threading
+from time import monotonic
+
+import metrics
+
+
+class LantronixConnection:
+    """
+    A persistent connection to a single Lantronix serial port.
+
+    Received characters are collected in a buffer, and read_until splits them
+    into replies on a device-specific terminator, e.g. b'OK\\r' for the BK
+    power supply. Characters past the terminator are kept for the next reply.
+    Waiting for a reply uses select with a deadline, not fixed sleeps.
+
+    The socket is opened lazily, and reopened on the next send after the
+    Lantronix closes it or a send fails with a BrokenPipeError.
+
+    Parameters
+    ----------
+    ip_port: tuple
+        the ip address and port of the Lantronix serial port, in the format
+        (<ip address>, <port number>).
+    timeout: non-negative float or None, optional
+        The number of seconds to wait when connecting and when waiting for a
+        reply. None means wait forever, which is not recommended.
+    message_size: int, optional
+        The maximum number of characters requested from the socket in a
+        single read.
+    noise: bytes, optional
+        Characters to discard as they are read. The BK and the Lantronix
+        emit null characters on power up and power down.
+
+    Notes
+    -----
+    Use get_connection rather than building instances directly, so that
+    drivers sharing a port also share the connection.
+
+    The lock attribute is a reentrant lock. Hold it around a send and the
+    matching read_until so that a reply is not taken by another thread.
+    """
+    def __init__(self, ip_port, timeout=8, message_size=1024, noise=b'\x00'):
+        self.ip_address = ip_port[0]
+        self.port_number = int(ip_port[1])
+        self.timeout = timeout
+        self.message_size = message_size
+        self.noise = noise
+
+        self.lock = threading.RLock()
+
+        self._socket = None
+        self._buffer = bytearray()
+        # label for this port in the metrics registry
+        self._metrics_port = '%s:%s' % (self.ip_address, self.port_number)
+
+    def __repr__(self):
+        return 'LantronixConnection((%r, %r))' % (self.ip_address, self.port_number)
+
+    @property
+    def connected(self):
+        return self._socket is not None
+
+    def connect(self):
+        """
+        Open the socket, if it is not open already.
+
+        Returns
+        -------
+        None
+        """
+        with self.lock:
+            if self._socket is not None:
+                return
+            self._socket = socket.create_connection((self.ip_address, self.port_number),
+                                                    timeout=self.timeout)
+            self._buffer.clear()
+
+    def close(self):
+        """
+        Close the socket. The connection stays in the pool, and is reopened
+        by the next send.
+
+        Returns
+        -------
+        None
+        """
+        with self.lock:
+            if self._socket is not None:
+                self._socket.close()
+            self._socket = None
+            self._buffer.clear()
+
+    def _fill_buffer(self, wait_time):
+        # wait up to wait_time seconds for the socket to become readable, then
+        # read whatever is available into the buffer
+        # returns False if nothing arrived before wait_time ran out
+        readable, _, _ = select.select([self._socket], [], [], wait_time)
+        if not readable:
+            return False
+
+        try:
+            chunk = self._socket.recv(self.message_size)
+        except ConnectionResetError:
+            chunk = b''
+        if chunk == b'':
+            # this means the lantronix closed the socket for some reason
+            # close this end, so the next send reconnects, and raise error
+            self.close()
+            raise BrokenPipeError('%s:%s closed connection' % (self.ip_address, self.port_number))
+
+        if metrics.registry.enabled:
+            metrics.registry.increment('lantronix_bytes_received_total', len(chunk),
+                                       port=self._metrics_port)
+        for character in self.noise:
+            chunk = chunk.replace(bytes([character]), b'')
+        self._buffer += chunk
+        return True
+
+    def discard_input(self):
+        """
+        Throw away everything that has already been received, e.g. noise or
+        replies that nobody waited for. Never waits for more input.
+
+        Returns
+        -------
+        None
+        """
+        with self.lock:
+            if self._socket is None:
+                return
+            while self._fill_buffer(0):
+                pass
+            self._buffer.clear()
+
+    def send(self, output_string, empty=True):
+        """
+        Send a byte-string to the device.
+
+        If the socket is closed, or the send fails because the Lantronix
+        dropped the connection, the socket is reopened and the byte-string is
+        sent again, once.
+
+        Parameters
+        ----------
+        output_string: bytes
+            The complete command, including any terminator the device expects
+        empty: bool, optional
+            If True, discard stale input before sending, so the next
+            read_until returns the reply to this command.
+
+        Returns
+        -------
+        None
+        """
+        with self.lock:
+            for attempt in range(2):
+                try:
+                    if attempt and metrics.registry.enabled:
+                        metrics.registry.increment('lantronix_reconnects_total',
+                                                   port=self._metrics_port)
+                    self.connect()
+                    if empty:
+                        self.discard_input()
+                    self._socket.sendall(output_string)
+                    break
+                except (BrokenPipeError, ConnectionResetError):
+                    self.close()
+                    if attempt:
+                        raise
+
+            if metrics.registry.enabled:
+                metrics.registry.increment('lantronix_bytes_sent_total', len(output_string),
+                                           port=self._metrics_port)
+
+    def read_until(self, terminator, timeout=None):
+        """
+        Wait for and return the next reply ending in terminator.
+
+        Parameters
+        ----------
+        terminator: bytes
+            The characters that end a reply, e.g. b'OK\\r' or b'\\r\\n'
+        timeout: non-negative float, optional
+            Seconds to wait for the reply. Defaults to the connection timeout.
+
+        Returns
+        -------
+        reply: bytes
+            The reply, including the terminator
+
+        Raises
+        ------
+        socket.timeout:
+            If no complete reply arrives in time. Any partial reply is kept
+            in the buffer.
+        BrokenPipeError:
+            If the Lantronix closes the connection.
+        """
+        if timeout is None:
+            timeout = self.timeout
+
+        with self.lock:
+            if self._socket is None:
+                raise BrokenPipeError('%s:%s is not connected' % (self.ip_address, self.port_number))
+
+            deadline = None if timeout is None else monotonic() + timeout
+            reads = 0
+            end = self._buffer.find(terminator)
+            while end < 0:
+                wait_time = None if deadline is None else max(deadline - monotonic(), 0)
+                if self._fill_buffer(wait_time):
+                    reads += 1
+                elif wait_time == 0:
+                    raise socket.timeout('no reply from %s:%s, received %r'
+                                         % (self.ip_address, self.port_number, bytes(self._buffer)))
+                end = self._buffer.find(terminator)
+
+            if metrics.registry.enabled:
+                # more than one read means the reply arrived in pieces
+                metrics.registry.observe('lantronix_reply_reads', reads, port=self._metrics_port)
+
+            # split the reply off the front of the buffer, anything after it
+            # belongs to the next reply
+            end += len(terminator)
+            reply = bytes(self._buffer[:end])
+            del self._buffer[:end]
+
+        return reply
+
+    def query(self, output_string, terminator, timeout=None):
+        """
+        Send a byte-string and return the reply, holding the lock for both.
+
+        Parameters
+        ----------
+        output_string: bytes
+            The complete command
+        terminator: bytes
+            The characters that end the reply
+        timeout: non-negative float, optional
+            Seconds to wait for the reply
+
+        Returns
+        -------
+        reply: bytes
+        """
+        with self.lock:
+            self.send(output_string)
+            return self.read_until(terminator, timeout=timeout)
+
+
+_pool = {}
+_pool_lock = threading.Lock()
+
+
+def get_connection(ip_port, **kwargs):
+    """
+    Return the shared LantronixConnection for an address, building it the
+    first time the address is asked for.
+
+    Parameters
+    ----------
+    ip_port: tuple
+        (<ip address>, <port number>)
+    kwargs: optional
+        Pass-through keyword arguments for LantronixConnection. These only
+        take effect when the connection is first built.
+
+    Returns
+    -------
+    instance of class LantronixConnection
+    """
+    key = (ip_port[0], int(ip_port[1]))
+    with _pool_lock:
+        connection = _pool.get(key)
+        if connection is None:
+            connection = LantronixConnection(key, **kwargs)
+            _pool[key] = connection
+    return connection
+
+
+def lantronix_address(config_dict, device_name):
+    """
+    Look up a device address in the 'lantronix' section of the config.
+
+    Parameters
+    ----------
+    config_dict: dict
+        A dictionary containing configuration information, typically
+        loaded from config.yaml
+    device_name: string
+        The device entry under 'lantronix', e.g. 'w_lamp' or 'bellows'
+
+    Returns
+    -------
+    ip_port: tuple
+        (<ip address>, <port number>)
+    """
+    # carefully unpack the lan address into a tuple
+    device_config = config_dict['lantronix'][device_name]
+    return device_config['ip'], device_config['port']
+
+
+def close_all():
+    """
+    Close every pooled connection.
+
+    Returns
+    -------
+    None
+    """
+    with _pool_lock:
+        connections = list(_pool.values())
+    for connection in connections:
+        connection.close()
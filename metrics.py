@@ -0,0 +1,305 @@
+"""
+In-process metrics for the QE machine hardware I/O.
+
+The device drivers record how long their commands take, how many bytes go
+over the wire, and how many reads each reply needs, into a single
+registry. The registry can be dumped as JSON, or as Prometheus text format
+for scraping.
+
+Metrics are off by default. While they are off, the drivers skip the
+timing calls entirely, so the cost is one attribute check per command.
+
+>>> import metrics
+>>> metrics.enable()
+>>> # ... run a scan ...
+>>> print(metrics.registry.to_prometheus())
+>>> metrics.registry.dump_json('scan_metrics.json')
+
+Metrics recorded by the drivers:
+
+lamp_command_seconds{command}
+    histogram of TungstenLamp command round trip times, by BK command,
+    e.g. command="VOLT"
+lantronix_reply_reads{port}
+    histogram of socket reads needed to complete one reply, in
+    READ_BUCKETS rather than the time buckets
+lantronix_bytes_sent_total{port}, lantronix_bytes_received_total{port}
+    counters of bytes on the wire
+lantronix_reconnects_total{port}
+    counter of reconnects after the Lantronix dropped the connection
+ktl_read_seconds{service, keyword}, ktl_write_seconds{service, keyword}
+    histograms of ktl keyword read and write times
+ktl_bulk_write_seconds{service, keyword}
+    histogram of the keyword writes of a configure, each from the start of
+    the batch to that write completing, since they are all sent at once
+ktl_cache_hits_total{service, keyword}
+    counter of get calls served from the monitored keyword cache
+monochromator_move_seconds
+    histogram of Monochromator moves, from the first command sent to the
+    motion being complete
+archon_fetch_seconds{service}, archon_bytes_fetched_total{service}
+    histogram of Archon frame FETCH times, and counter of bytes fetched
+"""
+
+
+import bisect
+import contextlib
+import json
+import threading
+from time import perf_counter
+
+
+# histogram bucket upper bounds, log spaced from 10 us to 100 s. These cover
+# everything from a cached keyword read to a slow exposure readout
+DEFAULT_BUCKETS = tuple(scale * 10.0 ** exponent
+                        for exponent in range(-5, 2)
+                        for scale in (1, 2.5, 5)) + (100.0,)
+# bucket upper bounds for histograms of counts of socket reads
+READ_BUCKETS = (1, 2, 3, 4, 6, 8, 16)
+# histogram name: bucket upper bounds, for histograms that aren't times
+HISTOGRAM_BUCKETS = {'lantronix_reply_reads': READ_BUCKETS}
+
+
+class Histogram:
+    """
+    Counts of observed values in fixed buckets, plus their sum, count,
+    minimum and maximum.
+
+    Parameters
+    ----------
+    buckets: sequence of floats
+        Upper bounds of the buckets, in increasing order. Values above the
+        last bound go in an overflow bucket.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def to_dict(self):
+        return {'count': self.count, 'sum': self.sum, 'min': self.min, 'max': self.max,
+                'buckets': {str(bound): count
+                            for bound, count in zip(self.buckets + ('+Inf',), self.counts)}}
+
+
+def _label_key(labels):
+    # a hashable, order independent key for a set of labels
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(label_key, extra=()):
+    labels = label_key + tuple(extra)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                                          .replace('"', '\\"'))
+                             for name, value in labels)
+
+
+class MetricsRegistry:
+    """
+    A collection of named histograms and counters, each split by labels.
+
+    Parameters
+    ----------
+    enabled: bool, optional
+        Whether the drivers should record metrics. Recording methods work
+        either way, the flag is for callers to check before timing
+        anything.
+    buckets: sequence of floats, optional
+        Bucket upper bounds for new histograms.
+    histogram_buckets: dict, optional
+        Histogram name: bucket upper bounds, overriding buckets for those
+        histograms. Default is HISTOGRAM_BUCKETS.
+    """
+    def __init__(self, enabled=False, buckets=DEFAULT_BUCKETS, histogram_buckets=None):
+        self.enabled = enabled
+        self.buckets = tuple(buckets)
+        if histogram_buckets is None:
+            histogram_buckets = HISTOGRAM_BUCKETS
+        self.histogram_buckets = {name: tuple(bounds)
+                                  for name, bounds in histogram_buckets.items()}
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+
+    def observe(self, name, value, **labels):
+        """
+        Add a value to a histogram.
+
+        Parameters
+        ----------
+        name: string
+            The histogram name, e.g. 'lamp_command_seconds'
+        value: float
+            The observed value
+        labels: optional
+            Label name=value pairs, e.g. command='VOLT'
+
+        Returns
+        -------
+        None
+        """
+        key = (name, _label_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                buckets = self.histogram_buckets.get(name, self.buckets)
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def increment(self, name, amount=1, **labels):
+        """
+        Add to a counter.
+
+        Parameters
+        ----------
+        name: string
+            The counter name, e.g. 'lantronix_bytes_sent_total'
+        amount: number, optional
+            How much to add, default 1
+        labels: optional
+            Label name=value pairs
+
+        Returns
+        -------
+        None
+        """
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """
+        Context manager that observes the time spent inside it, in seconds.
+        Does nothing if the registry is not enabled.
+
+        >>> with registry.timer('scan_point_seconds', wavelength=500):
+        ...     take_frame()
+        """
+        if not self.enabled:
+            yield
+            return
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start, **labels)
+
+    def reset(self):
+        """
+        Forget every recorded metric.
+
+        Returns
+        -------
+        None
+        """
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+    def to_dict(self):
+        """
+        Return every metric as plain python types.
+
+        Returns
+        -------
+        metrics: dict
+            {'histograms': [...], 'counters': [...]}, each entry a dict with
+            'name', 'labels' and the values
+        """
+        with self._lock:
+            histograms = [dict(name=name, labels=dict(labels), **histogram.to_dict())
+                          for (name, labels), histogram in sorted(self._histograms.items())]
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self._counters.items())]
+        return {'histograms': histograms, 'counters': counters}
+
+    def to_json(self, **kwargs):
+        """
+        Return every metric as a JSON string.
+
+        Parameters
+        ----------
+        kwargs: optional
+            Keyword arguments for json.dumps, e.g. indent=2
+
+        Returns
+        -------
+        string
+        """
+        return json.dumps(self.to_dict(), **kwargs)
+
+    def dump_json(self, filename, **kwargs):
+        """
+        Write every metric to a JSON file.
+
+        Parameters
+        ----------
+        filename: string
+            The file to write
+        kwargs: optional
+            Keyword arguments for json.dump
+
+        Returns
+        -------
+        None
+        """
+        with open(filename, 'w') as file:
+            json.dump(self.to_dict(), file, **kwargs)
+
+    def to_prometheus(self):
+        """
+        Return every metric in the Prometheus text exposition format.
+
+        Returns
+        -------
+        string
+        """
+        lines = []
+        with self._lock:
+            typed = set()
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                if name not in typed:
+                    lines.append('# TYPE %s histogram' % name)
+                    typed.add(name)
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d'
+                                 % (name, _format_labels(labels, [('le', bound)]), cumulative))
+                lines.append('%s_sum%s %r' % (name, _format_labels(labels), histogram.sum))
+                lines.append('%s_count%s %d' % (name, _format_labels(labels), histogram.count))
+            for (name, labels), value in sorted(self._counters.items()):
+                if name not in typed:
+                    lines.append('# TYPE %s counter' % name)
+                    typed.add(name)
+                lines.append('%s%s %r' % (name, _format_labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+
+# the registry the device drivers record to
+registry = MetricsRegistry()
+
+
+def enable():
+    """Start recording metrics from the device drivers"""
+    registry.enabled = True
+
+
+def disable():
+    """Stop recording metrics. Metrics already recorded are kept."""
+    registry.enabled = False
@@ -11,54 +11,301 @@ confirmed.
 
 The monochromator can use either the IEEE-488 or RS-232 standard. This doc
 assumes RS-232 serial port communication is being used. This interface is
-similar to the tungsten lamp serial interface. Refer to tungsten_lamp for
-an example of serial port interface control in python.
+similar to the tungsten lamp serial interface, and uses the shared
+Lantronix transport in lantronix.py rather than opening its own socket.
 
 All messages sent to the monochromator must end in a linefeed character,
-'\n'. Responses from the monochromater end with carriage return and
-newline characters, '\r\n' in python.
+'\\n'. Responses from the monochromater end with carriage return and
+newline characters, '\\r\\n' in python. Over RS-232 every command is echoed
+back, and a query is answered on the line after its echo.
 
+The Cornerstone carries out commands one at a time, in the order they
+arrive, and does not start reading the next command until a move has
+finished. So several commands can be sent back to back in one write, and
+the answer to a query sent after them arrives exactly when the last move
+has finished. Monochromator.move uses this to detect motion completion
+without sleeping or polling: it sends GRAT, GOWAVE, FILTER and SLIT
+commands in one go, followed by 'STB?', and the move is done when the
+status byte comes back.
 
+Error codes, from ERROR?:
+0 system error
+1 command not understood
+2 bad parameter
+3 destination position for wavelength motion not allowed
+6 accessory not present
+7 accessory already in specified position
+8 could not home wavelength drive
+9 label too long
 """
 
 
+import socket
+from time import perf_counter
+
+import lantronix
+import metrics
+import wire_log
+
+
+# the error bit of the status byte returned by STB?
+_STATUS_ERROR = 0x20
+
+_ERRORS = {
+    0: 'SYSTEM_ERROR',
+    1: 'COMMAND_NOT_UNDERSTOOD',
+    2: 'BAD_PARAMETER',
+    3: 'WAVELENGTH_NOT_ALLOWED',
+    6: 'ACCESSORY_NOT_PRESENT',
+    7: 'ACCESSORY_ALREADY_IN_POSITION',
+    8: 'COULD_NOT_HOME',
+    9: 'LABEL_TOO_LONG',
+}
+
+
 class Monochromator:
     """
     Class for controlling the Newport Cornerstone 130 model 70000 monochromator.
 
+    Parameters
+    ----------
+    ip_port: tuple
+        the ip address and port of the Lantronix serial port, in the format
+        (<ip address>, <port number>).
+    timeout: float, optional
+        Seconds to wait for the echo of a command, or the answer to a query
+    move_timeout: float, optional
+        Seconds to wait for a move to finish. Changing grating takes the
+        longest, around 10 seconds.
+    echo: bool, optional
+        Whether the Cornerstone echoes commands, which it does over RS-232
+    verbose: bool, optional
+        If True, print every command sent and reply received
 
+    Notes
+    -----
+    The grating, filter and wavelength are read once, when the class
+    instance is created, and tracked from then on. Moves to where the
+    monochromator already is are left out, so e.g. a wavelength change
+    never sends a FILTER command for the filter already in place.
     """
-    def __init__(self):
+    def __init__(self, ip_port, timeout=5, move_timeout=30, echo=True, verbose=True):
+        self.timeout = timeout
+        self.move_timeout = move_timeout
+        self.echo = echo
+        self.verbose = verbose
+
+        self._connection = lantronix.get_connection(ip_port, timeout=timeout)
+        self._connection.connect()
+        # commands sent by move(wait=False) whose replies have not been read
+        self._pending = []
+        self._move_started = None
+
+        self._send(['UNITS NM'])
+        self._pending.append('UNITS NM')
+        self.wait_for_motion()
+        self.read_state()
+
+    def read_state(self):
         """
-        read in config file
+        Ask the monochromator where it is, instead of trusting the tracked
+        grating, filter and wavelength.
 
+        Returns
+        -------
+        None
+        """
+        self.grating = int(self.query('GRAT?').split(',')[0])
+        self.filter_index = int(self.query('FILTER?'))
+        self.wavelength = float(self.query('WAVE?'))
 
-        Stub, too tired to think
+    def _read_line(self, timeout):
+        reply = self._connection.read_until(b'\r\n', timeout=timeout)
+        wire_log.record('monochromator', 'recv', reply, echo=self.verbose)
+        return reply[:-2].decode('ascii', errors='replace').strip()
+
+    def _send(self, commands):
+        # send commands back to back, in a single write, without discarding
+        # replies still to come from earlier commands
+        output_string = ''.join(command + '\n' for command in commands).encode('ascii')
+        self._connection.send(output_string, empty=False)
+        wire_log.record('monochromator', 'send', output_string, echo=self.verbose)
+
+    def wait_for_motion(self, timeout=None):
         """
-        pass
+        Block until every command sent by move(wait=False) has finished.
+
+        Parameters
+        ----------
+        timeout: float, optional
+            Seconds to wait. Defaults to move_timeout.
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        RuntimeError:
+            If the monochromator reported an error for any of the commands
+        """
+        if not self._pending:
+            return
+        if timeout is None:
+            timeout = self.move_timeout
+
+        with self._connection.lock:
+            pending, self._pending = self._pending, []
+            # the status byte is only sent once every command before it is done
+            self._send(['STB?'])
+            try:
+                if self.echo:
+                    for command in pending + ['STB?']:
+                        self._read_line(timeout)
+                status = int(self._read_line(timeout))
+            except socket.timeout as err:
+                # the replies are out of step now, throw away whatever arrives
+                self._connection.discard_input()
+                raise RuntimeError('monochromator: %s did not finish, %s'
+                                   % (', '.join(pending), err))
+
+            if metrics.registry.enabled and self._move_started is not None:
+                metrics.registry.observe('monochromator_move_seconds',
+                                         perf_counter() - self._move_started)
+            self._move_started = None
+
+            if status & _STATUS_ERROR:
+                code = int(self.query('ERROR?'))
+                # some of the moves may not have happened
+                self.read_state()
+                raise RuntimeError('monochromator: %s failed with %s'
+                                   % (', '.join(pending),
+                                      _ERRORS.get(code, 'UNKNOWN_ERROR_%i' % code)))
 
-    def filter_wheel(self, filter_index):
+    def query(self, command):
+        """
+        Send a query and return the answer.
+
+        Parameters
+        ----------
+        command: string
+            e.g. 'WAVE?'
+
+        Returns
+        -------
+        answer: string
+        """
+        self.wait_for_motion()
+        with self._connection.lock:
+            self._send([command])
+            if self.echo:
+                self._read_line(self.timeout)
+            return self._read_line(self.timeout)
+
+    def move(self, wavelength=None, grating=None, filter_index=None, slits=None, shutter=None,
+             wait=True):
+        """
+        Move any combination of grating, wavelength, filter and slits at
+        once.
+
+        All the commands are sent back to back, so the Cornerstone goes
+        straight from one move to the next. Moves to where the
+        monochromator already is are skipped.
+
+        Parameters
+        ----------
+        wavelength: float, optional
+            Center wavelength, in nm
+        grating: int, optional
+            Grating 1, 2 or 3. Changed before the wavelength is set.
+        filter_index: int, optional
+            Filter wheel position 1 to 6
+        slits: sequence of floats, optional
+            Widths of slits 1, 2 and 3, in microns. None leaves a slit as is.
+        shutter: bool, optional
+            True opens the shutter, False closes it
+        wait: bool, optional
+            If True, block until the moves have finished. If False, return
+            as soon as the commands are sent, e.g. to set up the lamp while
+            the monochromator moves, then call wait_for_motion.
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        RuntimeError:
+            If the monochromator reported an error
+        """
+        commands = []
+        if grating is not None and grating != self.grating:
+            commands.append('GRAT %i' % grating)
+            self.grating = grating
+            # the wavelength is kept through a grating change
+        if wavelength is not None and (wavelength != self.wavelength or commands):
+            commands.append('GOWAVE %.3f' % wavelength)
+            self.wavelength = wavelength
+        if filter_index is not None and filter_index != self.filter_index:
+            commands.append('FILTER %i' % filter_index)
+            self.filter_index = filter_index
+        for slit, width in enumerate(slits or (), start=1):
+            if width is not None:
+                commands.append('SLIT%iMICRONS %g' % (slit, width))
+        if shutter is not None:
+            commands.append('SHUTTER %s' % ('O' if shutter else 'C'))
+
+        if commands:
+            with self._connection.lock:
+                if self._move_started is None:
+                    self._move_started = perf_counter()
+                self._send(commands)
+                self._pending.extend(commands)
+        if wait:
+            self.wait_for_motion()
+
+    def filter_wheel(self, filter_index, wait=True):
         # sent a rotate command to the filter wheel
-        pass
+        self.move(filter_index=filter_index, wait=wait)
 
-    def select_wavelength(self, center_wavelength):
+    def select_wavelength(self, center_wavelength, grating=None, wait=True):
         # there are two ways of selecting the wavelength:
         # center wavelength
         # or the upper and lower wavelength on a bandpass
         # the bandpass is so narrow it's effectively monochromatic
+        # only the center wavelength is used here
 
         # there are two diffraction gratings, for red or blue regimes
-        # Not sure if grating selection should be automatic, based on the
-        # current wavelength, or user controlled
-        pass
+        # the grating is user controlled, pass it to change grating on the way
+        self.move(wavelength=center_wavelength, grating=grating, wait=wait)
 
-    def set_slit_width(self, input_width, output_width, some_middle_slit):
-        # the width of the monochromator slits
+    def set_slit_width(self, input_width, output_width, some_middle_slit=None, wait=True):
+        # the width of the monochromator slits, in microns
         # there are three slits:
         # one on the input to the monochromator
         # another on the output of the monochromator
         # I don't know what the 3rd, internal slit does
         # block higher order refractions? But that's what the filter wheel is for
         # I want an optical diagram of the monochromator
+        self.move(slits=(input_width, output_width, some_middle_slit), wait=wait)
+
+    def set_shutter(self, open_shutter, wait=True):
+        # open or close the monochromator shutter
+        self.move(shutter=open_shutter, wait=wait)
 
-        pass
\ No newline at end of file
+    def get_wavelength(self):
+        # the current center wavelength, in nm, as reported by the monochromator
+        return float(self.query('WAVE?'))
+
+    def shutdown(self):
+        """
+        Wait for any move to finish, and close the connection.
+
+        Returns
+        -------
+        None
+        """
+        try:
+            self.wait_for_motion()
+        finally:
+            self._connection.close()
@@ -50,6 +50,10 @@ export PATH=/opt/kroot/bin:$PATH
 
 
 # import sys
+import re
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep
+
 import yaml
 
 
@@ -62,10 +66,36 @@ import yaml
 # import ktl
 
 # local imports
+import bellowslifter
 import controller
+import lantronix
+import monochromator as monochromator_driver
+import qe_config
+import scan_journal
 import tungsten_lamp
 
 
+class ControllerStartupError(RuntimeError):
+    """
+    Raised by start_all_controllers when one or more controllers failed to
+    start.
+
+    Every controller is attempted, and all failures are reported together.
+
+    Attributes
+    ----------
+    controllers: dict
+        config key: controller pairs, for the controllers that did start
+    failures: dict
+        config key: exception pairs, one for each controller that failed
+    """
+    def __init__(self, controllers, failures):
+        self.controllers = controllers
+        self.failures = failures
+        message = '; '.join('%s: %s' % (key, err) for key, err in failures.items())
+        super().__init__('%i controller(s) failed to start: %s' % (len(failures), message))
+
+
 def _connect_ktl_service(service_config, verbose=True):
     # unpack the type of the service
     service_type = service_config['controller_type']
@@ -74,39 +104,65 @@ def _connect_ktl_service(service_config, verbose=True):
         # build and return an andorcam ktl service
         return controller.AndorCameraController(service_config['ktl_service_name'],
                                                 service_config['startup_config'],
-                                                verbose=verbose)
+                                                verbose=verbose,
+                                                ktl_backend=service_config.get('ktl_backend'),
+                                                cached=service_config.get('cached', False),
+                                                max_staleness=service_config.get('max_staleness'),
+                                                metadata_dir=service_config.get('metadata_dir'))
 
     if service_type == 'archon':
-        # return an archon controller class
-        pass
-    else:
-        # raise an error if no matching controller type is found
-        # fill in the error type later
-        raise
-
-
-def open_config(config_filename, **kwargs):
+        # build and return an archon controller, which talks to the archon
+        # directly instead of through a ktl keyword service
+        # imported here, so numpy is only needed when there is an archon
+        import archon
+        return archon.ArchonController((service_config['ip'], service_config['port']),
+                                       service_config.get('startup_config'),
+                                       verbose=verbose,
+                                       parameters=service_config.get('parameters'),
+                                       output_directory=service_config.get('output_directory',
+                                                                           '.'))
+
+    # raise an error if no matching controller type is found
+    raise RuntimeError('unknown controller_type %r, expected andorcam or archon'
+                       % service_type)
+
+
+def open_config(config_filename, validate=True, cache=True, **kwargs):
     """
     Opens a yaml file, and returns it as a dictionary.
 
-    This is a simple wrapper for yaml.load()
+    The file is parsed with the C yaml loader, checked against the schema in
+    qe_config before anything is returned, and cached, so repeated script
+    launches skip parsing as long as the file is unchanged. See qe_config
+    for details.
 
     Parameters
     ----------
     config_filename: string
         Name of the configuration file, typicall 'config.yaml'
+    validate: bool, optional
+        If True, check the whole config up front, and raise a
+        qe_config.ConfigError listing every problem. Default is True.
+    cache: bool, optional
+        If True, use the cached config when the file is unchanged. Default
+        is True.
     kwargs
-        Keyword arguments for yaml.load.
+        Keyword arguments for yaml.load, e.g. Loader. If given, the file is
+        parsed with them directly, and the cache is not used.
 
     Returns
     -------
     config_dict: dictionary
         A dictionary containing the QE machine configuration
     """
-    with open(config_filename) as file:
-        config_dict = yaml.load(file, **kwargs)
+    if kwargs:
+        with open(config_filename) as file:
+            config_dict = yaml.load(file, **kwargs)
+        if validate:
+            qe_config.validate_config(config_dict, config_filename)
+        return config_dict
 
-    return config_dict
+    return qe_config.load_config(config_filename, validate=validate, cache=cache)
 
 
 def start_controller(config_dict, config_key='ccd_controller0', verbose=True):
@@ -141,7 +197,18 @@ def start_controller(config_dict, config_key='ccd_controller0', verbose=True):
             # put whatever keywords that have a controller function here
             OBSMODE : 'Other'
 
+    An optional 'ktl_backend' key selects the ktl implementation. Set it to
+    'fake' to use the in-memory fake_ktl service instead of a keyword
+    server, e.g. to run scripts away from the observatory machines.
+    Optional 'cached' and 'max_staleness' keys turn on the monitored keyword
+    cache of AndorCameraController, and 'metadata_dir' sets where its keyword
+    metadata is saved.
 
+    An Archon controller is not a ktl service. It needs 'controller_type' set
+    to 'archon', and its network address under 'ip' and 'port'. Its
+    startup_config is interpreted as timing script parameter: value pairs,
+    and an optional 'parameters' section renames the timing script
+    parameters ArchonController uses, see ArchonController.
 
     Parameters
     ----------
@@ -165,12 +232,12 @@ def start_controller(config_dict, config_key='ccd_controller0', verbose=True):
     controllers, but it is easily extended by adding new keyword names and
     defining corresponding constructor helper functions.
     """
-    # I should figure out a way of parsing raw_config, and pulling
-    # everything that matches the pattern 'ccd_controller\d'. Then each
-    # matching instance will get it's own ktl service connection
+    # to start every section matching 'ccd_controller\d', each with its own
+    # ktl service connection, use start_all_controllers
     controller_config = config_dict[config_key]
 
-    if controller_config['ktl_service_name']:
+    if (controller_config.get('ktl_service_name')
+            or controller_config.get('controller_type') == 'archon'):
         ccd_controller = _connect_ktl_service(config_dict[config_key], verbose=verbose)
 
     # This is meant to be extendable
@@ -185,6 +252,80 @@ def start_controller(config_dict, config_key='ccd_controller0', verbose=True):
     return ccd_controller
 
 
+def start_all_controllers(config_dict, pattern=r'ccd_controller\d+', keys=None,
+                          verbose=True):
+    """
+    Constructs a CCD controller object for every controller section of the
+    configuration, connecting them all at the same time.
+
+    Each section is built by start_controller in its own thread, which
+    connects the ktl service and writes its startup_config. Since the
+    controllers start concurrently, a bench with several cameras starts in
+    the time of the slowest controller, not the sum of all of them.
+
+    Parameters
+    ----------
+    config_dict: dict
+        A dictionary containing configuration information. Typically,
+        but not necessarily, loaded from a config file.
+    pattern: string, optional
+        Regular expression the section names must match in full. Default
+        matches ccd_controller0, ccd_controller1, ...
+    keys: iterable of strings, optional
+        Start exactly these sections instead of searching with pattern
+    verbose: bool, optional
+        Set to False to turn off print outputs
+
+    Returns
+    -------
+    ccd_controllers: dict
+        config key: controller pairs, ordered by controller number, e.g.
+        {'ccd_controller0': <AndorCameraController>, ...}
+
+    Raises
+    ------
+    ControllerStartupError:
+        If any controller failed to start. The ones that did start are in
+        its controllers attribute.
+    """
+    if keys is None:
+        keys = [key for key in config_dict if re.fullmatch(pattern, str(key))]
+    # natural order, so ccd_controller10 comes after ccd_controller9
+    keys = sorted(keys, key=lambda key: [int(part) if part.isdigit() else part
+                                         for part in re.split(r'(\d+)', str(key))])
+    if not keys:
+        return {}
+
+    with ThreadPoolExecutor(max_workers=len(keys)) as executor:
+        futures = {key: executor.submit(start_controller, config_dict, config_key=key,
+                                        verbose=verbose)
+                   for key in keys}
+
+    ccd_controllers = {}
+    failures = {}
+    for key, future in futures.items():
+        try:
+            ccd_controllers[key] = future.result()
+        except Exception as err:
+            failures[key] = err
+
+    if failures:
+        raise ControllerStartupError(ccd_controllers, failures)
+
+    return ccd_controllers
+
+
+def _lantronix_address(config_dict, device_name):
+    # the device's entry of the lantronix section, or a ConfigError naming
+    # what is missing, since the schema can't know which devices a script
+    # will start
+    lantronix_section = config_dict.get('lantronix')
+    if not isinstance(lantronix_section, dict) or device_name not in lantronix_section:
+        raise qe_config.ConfigError('config', ['lantronix.%s: missing, start_%s needs its ip '
+                                               'and port' % (device_name, device_name)])
+    return lantronix.lantronix_address(config_dict, device_name)
+
+
 def start_w_lamp(config_dict, **kwargs):
     """
     A TungstenLamp constructor function for starting a class instance
@@ -207,19 +348,297 @@ def start_w_lamp(config_dict, **kwargs):
     -------
     instance of class TungstenLamp
 
+    Raises
+    ------
+    qe_config.ConfigError:
+        If the lantronix section has no w_lamp entry
     """
     # carefully unpack the lan address into a tuple
-    lan_address = (config_dict['lantronix']['w_lamp']['ip'],
-                   config_dict['lantronix']['w_lamp']['port'])
+    lan_address = _lantronix_address(config_dict, 'w_lamp')
 
-    if config_dict['tungsten_lamp']:
+    if config_dict.get('tungsten_lamp'):
         # if there is a provided configuration entry, pass it using the double-splat operator
-        return tungsten_lamp.TungstenLamp(lan_address, config_dict['tungsten_lamp'], **kwargs)
+        # explicit keyword arguments take precedence over the config entry
+        lamp_kwargs = dict(config_dict['tungsten_lamp'], **kwargs)
+        return tungsten_lamp.TungstenLamp(lan_address, **lamp_kwargs)
     else:
         return tungsten_lamp.TungstenLamp(lan_address, **kwargs)
 
 
+def start_bellows(config_dict, **kwargs):
+    """
+    A BellowsLifter constructor function for starting a class instance
+    using a configuration file.
+
+    The address is the 'bellows' entry of the lantronix section, and an
+    optional 'bellows' section holds BellowsLifter options, in the same way
+    as for start_w_lamp.
+
+    Parameters
+    ----------
+    config_dict: dict
+        A dictionary containing configuration information. Typically,
+        but not necessarily, loaded from a config file.
+    kwargs: optional
+        Pass-through keyword arguments for the BellowsLifter class
+
+    Returns
+    -------
+    instance of class BellowsLifter
+
+    Raises
+    ------
+    qe_config.ConfigError:
+        If the lantronix section has no bellows entry
+    """
+    lan_address = _lantronix_address(config_dict, 'bellows')
+    # explicit keyword arguments take precedence over the config entry
+    bellows_kwargs = dict(config_dict.get('bellows') or {}, **kwargs)
+    return bellowslifter.BellowsLifter(lan_address, **bellows_kwargs)
+
 
+def start_monochromator(config_dict, **kwargs):
+    """
+    A Monochromator constructor function for starting a class instance
+    using a configuration file.
 
+    The address is the 'monochromator' entry of the lantronix section, and
+    an optional 'monochromator' section holds Monochromator options, in the
+    same way as for start_w_lamp.
 
+    Parameters
+    ----------
+    config_dict: dict
+        A dictionary containing configuration information. Typically,
+        but not necessarily, loaded from a config file.
+    kwargs: optional
+        Pass-through keyword arguments for the Monochromator class
+
+    Returns
+    -------
+    instance of class Monochromator
+
+    Raises
+    ------
+    qe_config.ConfigError:
+        If the lantronix section has no monochromator entry
+    """
+    lan_address = _lantronix_address(config_dict, 'monochromator')
+    # explicit keyword arguments take precedence over the config entry
+    monochromator_kwargs = dict(config_dict.get('monochromator') or {}, **kwargs)
+    return monochromator_driver.Monochromator(lan_address, **monochromator_kwargs)
+
+
+def run_qe_scan(wavelengths, ccd_controller, monochromator=None, w_lamp=None,
+                exposure_time=None, lamp_settings=None, filter_for=None,
+                grating_for=None, settle_time=0.0, reduce=None, measure=None, timeout=None,
+                journal=None, calibration=None, verbose=True):
+    """
+    Take one frame at each wavelength of a QE scan, overlapping the slow
+    steps of neighbouring points.
+
+    Each point goes through three stages:
+
+    prepare: move the monochromator to the wavelength and filter, set the
+        lamp, and wait for it to settle
+    expose: set the exposure time and take the frame
+    reduce: hand the finished frame to the reduce function
+
+    The stages run as a pipeline. As soon as a frame has finished
+    integrating, the next point is prepared while that frame reads out, and
+    each frame is reduced in the background while the following frames are
+    taken. Only the exposures themselves run one after another.
+
+    Parameters
+    ----------
+    wavelengths: iterable of floats
+        The wavelengths to visit, in the order given
+    ccd_controller: Controller
+        The camera, e.g. from start_controller
+    monochromator: Monochromator, optional
+        If given, it is moved to every wavelength, and to the grating and
+        filter given by grating_for and filter_for. The lamp is set while it
+        moves.
+    w_lamp: TungstenLamp, optional
+        If given together with lamp_settings, the lamp is set for every point
+    exposure_time: float or callable, optional
+        Exposure time in seconds, or a function of wavelength returning one,
+        e.g. an exposure_tuner.ExposureTuner. If None, the controller's
+        current exposure time is used.
+    lamp_settings: tuple or callable, optional
+        (volts, amps) for the lamp, or a function of wavelength returning
+        them. The lamp is only reprogrammed when the settings change.
+    filter_for: callable, optional
+        A function of wavelength returning the filter wheel position
+    grating_for: callable, optional
+        A function of wavelength returning the grating. A ScanPlan from
+        scan_planner.plan_scan provides grating_for, filter_for and the
+        wavelengths in the order that needs the least monochromator motion.
+    settle_time: float, optional
+        Seconds to wait after the lamp settings change
+    reduce: callable, optional
+        Called as reduce(wavelength, filename) for every frame, in a
+        background thread, or reduce(wavelength, filename, calibration)
+        with a calibration hook. Its return value is kept in the results.
+    measure: callable, optional
+        Called as measure(wavelength, exposure_time, filename) for every
+        frame, in the calling thread, as soon as the frame is read out and
+        before the next exposure time is asked for, e.g.
+        ExposureTuner.measure
+    timeout: float, optional
+        Seconds to wait for each exposure to integrate and read out
+    journal: ScanJournal or string, optional
+        A scan_journal.ScanJournal, or the name of its file. Every finished
+        point is journaled, with its lamp settings, camera settings and
+        file, and the reduce result of every point that can be written as
+        JSON. If the journal already holds points of this scan, e.g. from a
+        run that died, the camera is restored to its settings at the last
+        good point and the scan carries on from the next one.
+    calibration: callable, optional
+        Called as calibration(ccd_controller) once, before the first
+        exposure, with the camera set up for the scan. Its return value is
+        passed to reduce with every frame, e.g. a master bias from
+        calibration_library.master_for:
+        calibration=lambda ccd: master_for(library, ccd, 'bias').data
+    verbose: bool, optional
+        Set to False to turn off print outputs
+
+    Returns
+    -------
+    results: list of dicts
+        One dict per point, in scan order, with keys 'wavelength',
+        'filename' and 'reduced'. Points taken from the journal are
+        included, with their journaled reduce results. Only those whose
+        result could not be journaled are reduced again.
+
+    Notes
+    -----
+    The monochromator and lamp are only ever touched from the prepare stage,
+    and the camera only from the calling thread, so the device drivers do
+    not need to be thread safe.
+    """
+    wavelengths = list(wavelengths)
+    # the state of the devices, as left by the last prepare stage
+    state = {'filter': None, 'lamp': None}
+
+    first = 0
+    if journal is not None:
+        if not isinstance(journal, scan_journal.ScanJournal):
+            journal = scan_journal.ScanJournal(journal)
+        journal.start(wavelengths)
+        first = journal.next_index
+        last = journal.last_point()
+        if last is not None:
+            if verbose:
+                print('Resuming at point %i of %i' % (first, len(wavelengths)))
+            if last['camera']:
+                ccd_controller.configure(last['camera'])
+            if last.get('exposure_time') is not None:
+                ccd_controller.set_exposure_time(last['exposure_time'])
+        # the camera settings are only read once, the scan itself only
+        # changes the exposure time, which is journaled on its own
+        camera_state = ccd_controller.keyword_state()
+
+    # the camera is in its scan setup, from the caller or the journal
+    calibrated = () if calibration is None else (calibration(ccd_controller),)
+
+    def reduce_point(index, wavelength, filename):
+        # reduce a frame, in the reduce stage, and journal the result
+        value = reduce(wavelength, filename, *calibrated)
+        if journal is not None:
+            journal.record_reduced(index, value)
+        return value
+
+    def prepare(wavelength):
+        if monochromator is not None:
+            filter_index = None
+            if filter_for is not None:
+                filter_index = filter_for(wavelength)
+                if filter_index == state['filter']:
+                    filter_index = None
+                else:
+                    state['filter'] = filter_index
+            grating = grating_for(wavelength) if grating_for is not None else None
+            # start the grating, filter and wavelength moves together, and
+            # set the lamp while they happen
+            monochromator.move(wavelength=wavelength, grating=grating, filter_index=filter_index,
+                               wait=False)
+
+        if w_lamp is not None and lamp_settings is not None:
+            settings = lamp_settings(wavelength) if callable(lamp_settings) else lamp_settings
+            if settings != state['lamp']:
+                volts, amps = settings
+                w_lamp.set_volts(volts)
+                w_lamp.set_curr(amps)
+                state['lamp'] = settings
+                sleep(settle_time)
+
+        if monochromator is not None:
+            monochromator.wait_for_motion()
+
+    results = []
+    reduced = []
+    # one worker each, so points are prepared and reduced in scan order
+    prepare_stage = ThreadPoolExecutor(max_workers=1)
+    reduce_stage = ThreadPoolExecutor(max_workers=1)
+    try:
+        for index in range(first):
+            entry = journal.points[index]
+            results.append({'wavelength': wavelengths[index], 'filename': entry['filename'],
+                            'reduced': entry.get('reduced')})
+            if reduce is not None and 'reduced' not in entry:
+                reduced.append((index, reduce_stage.submit(reduce_point, index,
+                                                           wavelengths[index],
+                                                           entry['filename'])))
+
+        if first < len(wavelengths):
+            next_prepared = prepare_stage.submit(prepare, wavelengths[first])
+
+        for index in range(first, len(wavelengths)):
+            wavelength = wavelengths[index]
+            # wait for the monochromator and lamp to be ready for this point
+            next_prepared.result()
+            lamp_used = state['lamp']
+
+            exposure = exposure_time
+            if exposure_time is not None:
+                if callable(exposure_time):
+                    exposure = exposure_time(wavelength)
+                ccd_controller.set_exposure_time(exposure)
+            elif measure is not None:
+                exposure = float(ccd_controller.get_exposure_time())
+
+            if verbose:
+                print('Exposing at', wavelength)
+            ccd_controller.expose('Start')
+            ccd_controller.wait_for_readout(timeout=timeout)
+
+            # the frame no longer needs light, get the next point ready
+            # while it reads out
+            if index + 1 < len(wavelengths):
+                next_prepared = prepare_stage.submit(prepare, wavelengths[index + 1])
+
+            filename = ccd_controller.wait_for_frame(timeout=timeout)
+            if measure is not None:
+                measure(wavelength, exposure, filename)
+            if journal is not None:
+                # the lamp and monochromator are already on the next point,
+                # the camera settings are still this point's
+                journal.record(index, wavelength, lamp=lamp_used, camera=camera_state,
+                               exposure_time=exposure if exposure_time is not None else None,
+                               filename=filename)
+            results.append({'wavelength': wavelength, 'filename': filename, 'reduced': None})
+            if reduce is not None:
+                reduced.append((index, reduce_stage.submit(reduce_point, index, wavelength,
+                                                           filename)))
+
+        for index, future in reduced:
+            results[index]['reduced'] = future.result()
+    finally:
+        prepare_stage.shutdown(wait=True)
+        reduce_stage.shutdown(wait=True)
+        if journal is not None:
+            journal.close()
+
+    return results
 
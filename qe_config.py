@@ -0,0 +1,389 @@
+"""
+Loading, validating and caching the QE machine configuration.
+
+config.yaml is parsed with the libyaml C loader when PyYAML was built with
+it, and the whole tree is checked against SCHEMA before anything is
+returned, so a misconfiguration fails straight away with a list of every
+problem, instead of as a KeyError halfway through connecting hardware.
+
+The validated config is cached, pickled, in the __pycache__ directory next
+to the config file, the same way python caches compiled modules. The cache
+entry records the modification time, size and SHA-256 hash of the file:
+
+- if the modification time and size match, the cached config is used
+  without reading the file
+- if they do not match but the hash does, e.g. after a touch or a
+  checkout, the cached config is used without parsing
+- otherwise the file is parsed and validated again, and the cache updated
+
+The cache is only an optimization. If it cannot be read or written, the
+file is simply parsed every time.
+
+>>> import qe_config
+>>> config = qe_config.load_config('config.yaml')
+"""
+
+
+import hashlib
+import numbers
+import os
+import pickle
+import re
+import threading
+
+import yaml
+
+
+# prefer the C loader, it is several times faster than the pure python one
+try:
+    _Loader = yaml.CSafeLoader
+except AttributeError:
+    _Loader = yaml.SafeLoader
+
+# bump this when the schema changes, so old cache entries are not trusted
+_CACHE_VERSION = 7
+
+
+class ConfigError(ValueError):
+    """
+    Raised when a configuration file does not match the schema.
+
+    Attributes
+    ----------
+    problems: list of strings
+        Every problem found, each starting with the path of the offending
+        entry, e.g. 'lantronix.w_lamp.port: expected int, got str'
+    """
+    def __init__(self, filename, problems):
+        self.filename = filename
+        self.problems = list(problems)
+        super().__init__('%s has %i configuration problem(s):\n    %s'
+                         % (filename, len(self.problems), '\n    '.join(self.problems)))
+
+
+# Schema building blocks. Each checker takes a value and returns an error
+# message, or None if the value is fine.
+
+def _type_name(value):
+    return type(value).__name__
+
+
+def _string(value):
+    if not isinstance(value, str):
+        return 'expected string, got %s' % _type_name(value)
+
+
+def _boolean(value):
+    if not isinstance(value, bool):
+        return 'expected bool, got %s' % _type_name(value)
+
+
+def _integer(low=None, high=None):
+    def check(value):
+        if isinstance(value, bool) or not isinstance(value, numbers.Integral):
+            return 'expected int, got %s' % _type_name(value)
+        if (low is not None and value < low) or (high is not None and value > high):
+            return 'expected int in [%s, %s], got %r' % (low, high, value)
+    return check
+
+
+def _number(low=None):
+    def check(value):
+        if isinstance(value, bool) or not isinstance(value, numbers.Real):
+            return 'expected number, got %s' % _type_name(value)
+        if low is not None and value < low:
+            return 'expected number >= %s, got %r' % (low, value)
+    return check
+
+
+def _optional(checker):
+    # allow an empty entry, e.g. 'max_staleness :'
+    def check(value):
+        if value is not None:
+            return checker(value)
+    return check
+
+
+def _one_of(*choices):
+    def check(value):
+        if value not in choices:
+            return 'expected one of %s, got %r' % (', '.join(map(repr, choices)), value)
+    return check
+
+
+def _mapping(value):
+    if not isinstance(value, dict):
+        return 'expected a section of key : value pairs, got %s' % _type_name(value)
+
+
+def _ranges(value):
+    # position -> [low, high] wavelength range, e.g. '2 : [590, 1100]'
+    error = _mapping(value)
+    if error:
+        return error
+    for key, value_range in value.items():
+        error = _integer(1)(key)
+        if error:
+            return 'position %r: %s' % (key, error)
+        if (not isinstance(value_range, list) or len(value_range) != 2
+                or any(_number(0)(limit) for limit in value_range)):
+            return 'position %r: expected [low, high], got %r' % (key, value_range)
+        if value_range[0] > value_range[1]:
+            return 'position %r: low is above high in %r' % (key, value_range)
+
+
+# A section schema maps key -> (checker, required). Keys not in a section
+# schema are allowed, unless the section is marked closed, e.g. because its
+# entries are passed straight to a constructor as keyword arguments.
+
+_LANTRONIX_DEVICE = {
+    'ip': (_string, True),
+    'port': (_integer(1, 65535), True),
+}
+
+_TUNGSTEN_LAMP = {
+    'timeout': (_optional(_number(0)), False),
+    'message_size': (_integer(1), False),
+    'verbose': (_boolean, False),
+}
+
+_BELLOWS = {
+    'timeout': (_optional(_number(0)), False),
+    'move_timeout': (_number(0), False),
+    'poll_interval': (_number(0), False),
+    'address': (_integer(1), False),
+    'verbose': (_boolean, False),
+}
+
+_MONOCHROMATOR = {
+    'timeout': (_optional(_number(0)), False),
+    'move_timeout': (_number(0), False),
+    'echo': (_boolean, False),
+    'verbose': (_boolean, False),
+}
+
+_SCAN_PLAN = {
+    'gratings': (_ranges, True),
+    'filters': (_ranges, True),
+    'grating_change_time': (_number(0), False),
+    'filter_change_time': (_number(0), False),
+    'slew_rate': (_number(0), False),
+    'filter_positions': (_integer(1), False),
+}
+
+_CCD_CONTROLLER = {
+    'ktl_service_name': (_string, False),
+    'controller_type': (_one_of('andorcam', 'archon'), True),
+    'ktl_backend': (_optional(_string), False),
+    'cached': (_boolean, False),
+    'max_staleness': (_optional(_number(0)), False),
+    'metadata_dir': (_optional(_string), False),
+    'startup_config': (_optional(_mapping), False),
+    'ip': (_string, False),
+    'port': (_integer(1, 65535), False),
+    'parameters': (_optional(_mapping), False),
+    'output_directory': (_string, False),
+}
+
+# keys each controller_type needs on top of _CCD_CONTROLLER
+_CONTROLLER_TYPE_KEYS = {
+    'andorcam': ('ktl_service_name',),
+    'archon': ('ip', 'port'),
+}
+
+
+def _check_section(path, section, schema, closed, problems):
+    error = _mapping(section)
+    if error:
+        problems.append('%s: %s' % (path, error))
+        return
+    for key, (checker, required) in schema.items():
+        if key not in section:
+            if required:
+                problems.append('%s.%s: missing' % (path, key))
+            continue
+        error = checker(section[key])
+        if error:
+            problems.append('%s.%s: %s' % (path, key, error))
+    if closed:
+        for key in section:
+            if key not in schema:
+                problems.append('%s.%s: unknown key' % (path, key))
+
+
+def _check_ccd_controller(path, section, problems):
+    _check_section(path, section, _CCD_CONTROLLER, False, problems)
+    if isinstance(section, dict):
+        for key in _CONTROLLER_TYPE_KEYS.get(section.get('controller_type'), ()):
+            if key not in section:
+                problems.append('%s.%s: missing, needed by controller_type %s'
+                                % (path, key, section['controller_type']))
+
+
+def _check_lantronix(path, section, problems):
+    error = _mapping(section)
+    if error:
+        problems.append('%s: %s' % (path, error))
+        return
+    for device, device_config in section.items():
+        _check_section('%s.%s' % (path, device), device_config, _LANTRONIX_DEVICE, False,
+                       problems)
+
+
+# top level sections: name pattern -> (section schema, required, closed)
+# a section schema can also be a function, called as
+# check(path, section, problems), for sections that need more than key checks
+SCHEMA = {
+    r'lantronix': (_check_lantronix, True, False),
+    r'tungsten_lamp': (_TUNGSTEN_LAMP, False, True),
+    r'bellows': (_BELLOWS, False, True),
+    r'monochromator': (_MONOCHROMATOR, False, True),
+    r'scan_plan': (_SCAN_PLAN, False, True),
+    r'ccd_controller\d+': (_check_ccd_controller, False, False),
+}
+
+
+def validate_config(config_dict, filename='config'):
+    """
+    Check a configuration dictionary against SCHEMA.
+
+    Every problem is collected before raising, so one run lists everything
+    that needs fixing.
+
+    Parameters
+    ----------
+    config_dict: dict
+        A dictionary containing configuration information
+    filename: string, optional
+        Used in the error message
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    ConfigError:
+        If anything does not match the schema
+    """
+    problems = []
+    error = _mapping(config_dict)
+    if error:
+        raise ConfigError(filename, ['top level: %s' % error])
+
+    for pattern, (schema, required, closed) in SCHEMA.items():
+        matches = [key for key in config_dict if re.fullmatch(pattern, str(key))]
+        if required and not matches:
+            problems.append('%s: missing section' % pattern)
+        for key in matches:
+            if callable(schema):
+                schema(key, config_dict[key], problems)
+            else:
+                _check_section(key, config_dict[key], schema, closed, problems)
+
+    if problems:
+        raise ConfigError(filename, problems)
+
+
+def _cache_filename(config_filename):
+    directory, name = os.path.split(os.path.abspath(config_filename))
+    return os.path.join(directory, '__pycache__', name + '.pickle')
+
+
+def _read_cache(cache_filename):
+    try:
+        with open(cache_filename, 'rb') as file:
+            entry = pickle.load(file)
+    except (OSError, pickle.PickleError, EOFError, AttributeError, ValueError):
+        return None
+    if not isinstance(entry, dict) or entry.get('version') != _CACHE_VERSION:
+        return None
+    return entry
+
+
+def _write_cache(cache_filename, entry):
+    # write to a temporary file and rename, so a concurrent launch never
+    # sees half a cache entry
+    temporary = '%s.%i' % (cache_filename, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(cache_filename), exist_ok=True)
+        with open(temporary, 'wb') as file:
+            pickle.dump(entry, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, cache_filename)
+    except OSError:
+        try:
+            os.remove(temporary)
+        except OSError:
+            pass
+
+
+# cache entries already loaded by this process, by cache filename
+_memory_cache = {}
+_memory_lock = threading.Lock()
+
+
+def load_config(config_filename, validate=True, cache=True):
+    """
+    Load, validate and cache a yaml configuration file.
+
+    Parameters
+    ----------
+    config_filename: string
+        Name of the configuration file, typically 'config.yaml'
+    validate: bool, optional
+        If True, check the config against SCHEMA. Default is True.
+    cache: bool, optional
+        If True, use and update the cache in __pycache__. Default is True.
+
+    Returns
+    -------
+    config_dict: dictionary
+        A dictionary containing the QE machine configuration. Every call
+        returns a new dictionary, so it is safe to modify.
+
+    Raises
+    ------
+    ConfigError:
+        If validate is True and the config does not match the schema
+    """
+    if not cache:
+        with open(config_filename, 'rb') as file:
+            config_dict = yaml.load(file, Loader=_Loader)
+        if validate:
+            validate_config(config_dict, config_filename)
+        return config_dict
+
+    cache_filename = _cache_filename(config_filename)
+    stat = os.stat(config_filename)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+
+    with _memory_lock:
+        entry = _memory_cache.get(cache_filename)
+    if entry is None:
+        entry = _read_cache(cache_filename)
+
+    if entry is not None and entry['stamp'] == stamp and (entry['validated'] or not validate):
+        # unchanged since it was cached, no need to even read it
+        with _memory_lock:
+            _memory_cache[cache_filename] = entry
+        return pickle.loads(entry['config'])
+
+    with open(config_filename, 'rb') as file:
+        text = file.read()
+    digest = hashlib.sha256(text).hexdigest()
+
+    if entry is not None and entry['hash'] == digest and (entry['validated'] or not validate):
+        # touched but not changed, no need to parse it
+        entry = dict(entry, stamp=stamp)
+    else:
+        config_dict = yaml.load(text, Loader=_Loader)
+        if validate:
+            validate_config(config_dict, config_filename)
+        entry = {'version': _CACHE_VERSION, 'stamp': stamp, 'hash': digest,
+                 'validated': validate,
+                 'config': pickle.dumps(config_dict, protocol=pickle.HIGHEST_PROTOCOL)}
+    _write_cache(cache_filename, entry)
+
+    with _memory_lock:
+        _memory_cache[cache_filename] = entry
+    return pickle.loads(entry['config'])
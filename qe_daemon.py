@@ -0,0 +1,522 @@
+"""
+A long running daemon that owns the QE machine hardware, and an RPC client
+for scripts to use it through.
+
+Starting a script the usual way costs seconds before it does anything:
+importing ktl, parsing the config, connecting the Lantronix, starting a
+remote session on the lamp and writing the whole startup_config to the
+camera, only to shut it all down again at the end. The daemon does all of
+that once, keeps the connections open, and serves calls on the devices over
+a Unix socket, so back to back scripts start in milliseconds:
+
+    python qe_daemon.py config.yaml
+
+>>> import qe_daemon
+>>> qe = qe_daemon.connect()
+>>> qe.w_lamp.set_volts(9.0)
+>>> qe.ccd_controller0.set_exposure_time(0.5)
+>>> qe.monochromator.move(wavelength=550.0, filter_index=1)
+
+The devices are 'w_lamp', 'monochromator' and 'bellows', if they have an
+entry in the lantronix section of the config, and every ccd_controllerN
+section. Each is started by the matching qe_api start function the first
+time it is used, and kept until the daemon stops.
+
+The daemon holds the only TungstenLamp, so the one instance rule of the
+lamp holds however many scripts run, and only one daemon can run on a
+socket. A daemon also takes a machine-wide lock on the lamp's Lantronix
+address before starting it, so two daemons on different sockets, e.g. of
+different users, can't both drive the lamp. Calls to a device are made one
+at a time, in the order they arrive; calls to different devices run side
+by side. A device's shutdown method can not be called through the
+daemon, the devices are shut down when the daemon stops:
+
+>>> qe.stop_daemon()
+
+Arguments and results are pickled, so anything a method takes or returns
+that can be pickled goes through, e.g. the numpy arrays of a reduce. A
+concurrent.futures.Future, like a bellows move, is waited for in the daemon
+and its result returned. An exception raised in the daemon is raised again
+in the script.
+
+The socket is made in a directory only its owner can open, under
+XDG_RUNTIME_DIR or ~/.cache. The daemon creates that directory itself, and
+refuses to use one that is a symlink, is owned by someone else, or can be
+opened by anyone but its owner. Connections are also authenticated: the
+daemon writes a random key next to the socket, readable only by its owner,
+and a client must prove it knows the key. So only the user running the
+daemon can send it calls.
+"""
+
+
+import concurrent.futures
+import fcntl
+import os
+import pickle
+import re
+import signal
+import stat
+import tempfile
+import threading
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+import lantronix
+import qe_api
+import qe_config
+
+
+# devices with a lantronix entry, and the qe_api functions that start them
+_LANTRONIX_DEVICES = {
+    'w_lamp': qe_api.start_w_lamp,
+    'monochromator': qe_api.start_monochromator,
+    'bellows': qe_api.start_bellows,
+}
+
+
+def default_socket_path():
+    """
+    The daemon socket, under XDG_RUNTIME_DIR, or ~/.cache if it is not set.
+
+    Returns
+    -------
+    string
+    """
+    runtime = os.environ.get('XDG_RUNTIME_DIR') or os.path.join(os.path.expanduser('~'),
+                                                                '.cache')
+    return os.path.join(runtime, 'qemachine', 'daemon.sock')
+
+
+def _key_path(socket_path):
+    # the authentication key of the daemon on a socket
+    return socket_path + '.key'
+
+
+def _read_key(socket_path):
+    with open(_key_path(socket_path), 'rb') as file:
+        return file.read()
+
+
+def _write_key(socket_path):
+    # a new random key, written where only the owner can read it
+    key = os.urandom(32)
+    temporary = _key_path(socket_path) + '.tmp'
+    descriptor = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(descriptor, 'wb') as file:
+        file.write(key)
+    os.replace(temporary, _key_path(socket_path))
+    return key
+
+
+def _private_directory(directory):
+    # make the socket directory, or check an existing one is private to us
+    try:
+        os.mkdir(directory, 0o700)
+    except FileExistsError:
+        pass
+    info = os.lstat(directory)
+    if not stat.S_ISDIR(info.st_mode):
+        raise RuntimeError('%s is not a directory, refusing to put the daemon socket in it'
+                           % directory)
+    if info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise RuntimeError('%s is not private to this user (owner %i, mode %o), refusing '
+                           'to put the daemon socket in it'
+                           % (directory, info.st_uid, stat.S_IMODE(info.st_mode)))
+
+
+def _lock_lamp(address):
+    # a lock on the lamp's Lantronix address, held by the returned file,
+    # shared by every user of the machine
+    filename = os.path.join(tempfile.gettempdir(),
+                            'qemachine_lamp_%s_%s.lock' % tuple(address))
+    try:
+        descriptor = os.open(filename, os.O_RDONLY | os.O_CREAT, 0o644)
+    except PermissionError:
+        # made by another user, it can still be locked
+        descriptor = os.open(filename, os.O_RDONLY)
+    try:
+        fcntl.flock(descriptor, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(descriptor)
+        raise RuntimeError('the lamp at %s:%s is already in use by another process'
+                           % tuple(address))
+    return descriptor
+
+
+def _picklable(err):
+    # exceptions with extra constructor arguments, like ConfigError, can not
+    # be unpickled on the other side, send those as a RuntimeError
+    try:
+        pickle.loads(pickle.dumps(err))
+        return err
+    except Exception:
+        return RuntimeError('%s: %s' % (type(err).__name__, err))
+
+
+class QEDaemon:
+    """
+    The daemon: owns the devices and serves calls on them.
+
+    Parameters
+    ----------
+    config_filename: string
+        The configuration file, typically 'config.yaml'
+    socket_path: string, optional
+        The Unix socket to listen on. Defaults to default_socket_path().
+    verbose: bool, optional
+        Passed on to the ccd controllers, and prints connections and
+        device startups
+    """
+    def __init__(self, config_filename, socket_path=None, verbose=True):
+        self.config = qe_config.load_config(config_filename)
+        self.socket_path = socket_path or default_socket_path()
+        self.verbose = verbose
+
+        self._starters = {}
+        for name, start in _LANTRONIX_DEVICES.items():
+            if name in self.config['lantronix']:
+                self._starters[name] = lambda start=start: start(self.config)
+        if 'w_lamp' in self._starters:
+            self._starters['w_lamp'] = self._start_w_lamp
+        for name in self.config:
+            if re.fullmatch(r'ccd_controller\d+', str(name)):
+                self._starters[name] = (lambda name=name:
+                                        qe_api.start_controller(self.config, name,
+                                                                verbose=self.verbose))
+
+        self.devices = {}
+        # one lock per device, held while it starts and during every call
+        self._locks = {name: threading.Lock() for name in self._starters}
+        self._listener = None
+        self._authkey = None
+        self._stopping = threading.Event()
+        # the machine-wide lamp lock file, while the lamp is running
+        self._lamp_lock = None
+
+    def _start_w_lamp(self):
+        self._lamp_lock = _lock_lamp(lantronix.lantronix_address(self.config, 'w_lamp'))
+        try:
+            return qe_api.start_w_lamp(self.config)
+        except BaseException:
+            os.close(self._lamp_lock)
+            self._lamp_lock = None
+            raise
+
+    def _device(self, name):
+        # the device, started on first use; call with its lock held
+        if name not in self._starters:
+            raise KeyError('no device %r, expected one of %s' % (name, sorted(self._starters)))
+        device = self.devices.get(name)
+        if device is None:
+            if self.verbose:
+                print('Starting', name)
+            device = self.devices[name] = self._starters[name]()
+        return device
+
+    def call(self, name, method, args=(), kwargs=None):
+        """
+        Call a method of a device, starting the device if it has not been
+        used yet.
+
+        Parameters
+        ----------
+        name: string
+            The device, e.g. 'w_lamp'
+        method: string
+            The method to call, e.g. 'set_volts'
+        args: tuple, optional
+        kwargs: dict, optional
+
+        Returns
+        -------
+        The result of the method. A Future is waited for, and its result
+        returned.
+
+        Raises
+        ------
+        AttributeError:
+            If the method does not exist, is private or is shutdown
+        KeyError:
+            If there is no such device
+        """
+        if method.startswith('_') or method == 'shutdown':
+            raise AttributeError('%s.%s can not be called through the daemon' % (name, method))
+        if name not in self._locks:
+            raise KeyError('no device %r, expected one of %s' % (name, sorted(self._starters)))
+        with self._locks[name]:
+            result = getattr(self._device(name), method)(*args, **(kwargs or {}))
+        if isinstance(result, concurrent.futures.Future):
+            result = result.result()
+        return result
+
+    def _serve_connection(self, connection):
+        # one thread per client connection, runs until the client goes away
+        with connection:
+            while not self._stopping.is_set():
+                try:
+                    request = connection.recv()
+                except (EOFError, OSError):
+                    return
+                except Exception as err:
+                    # e.g. a pickle of a class the daemon can't import
+                    request = ('bad', err)
+                kind = request[0] if isinstance(request, tuple) and request else None
+                try:
+                    if kind == 'call':
+                        reply = ('ok', self.call(*request[1:]))
+                    elif kind == 'devices':
+                        reply = ('ok', {name: name in self.devices for name in self._starters})
+                    elif kind == 'stop':
+                        reply = ('ok', None)
+                        threading.Thread(target=self.stop, daemon=True).start()
+                    elif kind == 'bad':
+                        raise ValueError('request could not be read: %s' % request[1])
+                    else:
+                        raise ValueError('unknown request %r' % (request,))
+                except Exception as err:
+                    reply = ('error', _picklable(err))
+                try:
+                    try:
+                        connection.send(reply)
+                    except (pickle.PicklingError, TypeError, AttributeError) as err:
+                        what = ('%s.%s' % request[1:3] if kind == 'call' and len(request) > 2
+                                else kind)
+                        connection.send(('error', TypeError('%s returned %s, which can not be '
+                                                            'sent: %s'
+                                                            % (what, type(reply[1]).__name__,
+                                                               err))))
+                except OSError:
+                    return
+
+    def _listen(self):
+        directory = os.path.dirname(os.path.abspath(self.socket_path))
+        os.makedirs(os.path.dirname(directory), exist_ok=True)
+        _private_directory(directory)
+        if os.path.exists(self.socket_path):
+            try:
+                key = _read_key(self.socket_path)
+            except FileNotFoundError:
+                key = None
+            try:
+                Client(self.socket_path, family='AF_UNIX', authkey=key).close()
+            except (ConnectionRefusedError, FileNotFoundError):
+                # left behind by a daemon that died
+                os.remove(self.socket_path)
+            except (OSError, AuthenticationError):
+                # something answered, leave it be
+                pass
+            if os.path.exists(self.socket_path):
+                raise RuntimeError('a qe_machine daemon is already running on %s'
+                                   % self.socket_path)
+        self._authkey = _write_key(self.socket_path)
+        self._listener = Listener(self.socket_path, family='AF_UNIX', authkey=self._authkey)
+
+    def serve_forever(self):
+        """
+        Serve calls until stop is called, by a client or a signal, then shut
+        down every device.
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        RuntimeError:
+            If another daemon is already running on the socket
+        """
+        self._listen()
+        if self.verbose:
+            print('qe_machine daemon listening on', self.socket_path)
+        try:
+            while True:
+                try:
+                    connection = self._listener.accept()
+                except (AuthenticationError, EOFError, ConnectionError) as err:
+                    # a client without the key, or one that gave up
+                    if self.verbose:
+                        print('Refused a connection:', err)
+                    continue
+                if self._stopping.is_set():
+                    connection.close()
+                    break
+                threading.Thread(target=self._serve_connection, args=(connection,),
+                                 daemon=True).start()
+        finally:
+            self._listener.close()
+            self._shutdown_devices()
+            try:
+                os.remove(_key_path(self.socket_path))
+            except FileNotFoundError:
+                pass
+
+    def stop(self):
+        """
+        Stop serving. serve_forever shuts down the devices and returns.
+        Safe to call from a signal handler.
+
+        Returns
+        -------
+        None
+        """
+        self._stopping.set()
+        # closing the listener does not wake a thread blocked in accept, a
+        # connection does. It is made from its own thread, since the
+        # handshake has to be answered by accept, which may be running in
+        # this very thread, e.g. when a signal handler calls stop
+        threading.Thread(target=self._wake_listener, daemon=True).start()
+
+    def _wake_listener(self):
+        try:
+            Client(self.socket_path, family='AF_UNIX', authkey=self._authkey).close()
+        except (OSError, EOFError, AuthenticationError):
+            pass
+
+    def _shutdown_devices(self):
+        for name, device in list(self.devices.items()):
+            with self._locks[name]:
+                shutdown = getattr(device, 'shutdown', None)
+                if shutdown is None:
+                    continue
+                try:
+                    shutdown()
+                except Exception as err:
+                    print('%s shutdown failed: %s' % (name, err))
+        self.devices.clear()
+        if self._lamp_lock is not None:
+            os.close(self._lamp_lock)
+            self._lamp_lock = None
+
+
+class DeviceProxy:
+    """
+    Stands in for a device of the daemon, every method call is sent to it.
+    Made by DaemonClient, e.g. as client.w_lamp.
+    """
+    def __init__(self, client, name):
+        self._client = client
+        self._name = name
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+
+        def call(*args, **kwargs):
+            return self._client.call(self._name, method, *args, **kwargs)
+        call.__name__ = method
+        return call
+
+    def __repr__(self):
+        return '<DeviceProxy %s of %s>' % (self._name, self._client.socket_path)
+
+
+class DaemonClient:
+    """
+    A connection to a running daemon. Devices are attributes, e.g.
+    client.w_lamp, and calls to them run in the daemon.
+
+    Parameters
+    ----------
+    socket_path: string, optional
+        The daemon socket. Defaults to default_socket_path().
+
+    Notes
+    -----
+    A client can be shared by threads, calls are sent one at a time. Use
+    one client per thread for calls that should run side by side.
+    """
+    def __init__(self, socket_path=None):
+        self.socket_path = socket_path or default_socket_path()
+        self._connection = Client(self.socket_path, family='AF_UNIX',
+                                  authkey=_read_key(self.socket_path))
+        self._lock = threading.Lock()
+
+    def _request(self, *request):
+        with self._lock:
+            self._connection.send(request)
+            status, value = self._connection.recv()
+        if status == 'error':
+            raise value
+        return value
+
+    def call(self, name, method, *args, **kwargs):
+        """
+        Call a method of a device in the daemon, e.g.
+        client.call('w_lamp', 'set_volts', 9.0)
+        """
+        return self._request('call', name, method, args, kwargs)
+
+    def devices(self):
+        """
+        Returns
+        -------
+        devices: dict
+            name: started, for every device the daemon can run
+        """
+        return self._request('devices')
+
+    def stop_daemon(self):
+        """
+        Stop the daemon, which shuts down all its devices.
+
+        Returns
+        -------
+        None
+        """
+        self._request('stop')
+        self.close()
+
+    def close(self):
+        self._connection.close()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return DeviceProxy(self, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def connect(socket_path=None):
+    """
+    Connect to a running daemon.
+
+    Parameters
+    ----------
+    socket_path: string, optional
+        The daemon socket. Defaults to default_socket_path().
+
+    Returns
+    -------
+    instance of class DaemonClient
+
+    Raises
+    ------
+    FileNotFoundError, ConnectionRefusedError:
+        If no daemon is running
+    multiprocessing.AuthenticationError:
+        If the daemon's key can't be read, e.g. it belongs to another user
+    """
+    return DaemonClient(socket_path)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run the qe_machine hardware daemon')
+    parser.add_argument('config', nargs='?', default='config.yaml',
+                        help='configuration file, default config.yaml')
+    parser.add_argument('--socket', default=None,
+                        help='Unix socket path, default %s' % default_socket_path())
+    parser.add_argument('--quiet', action='store_true', help='turn off print outputs')
+    arguments = parser.parse_args()
+
+    daemon = QEDaemon(arguments.config, arguments.socket, verbose=not arguments.quiet)
+    # stop cleanly, shutting the lamp off, on ctrl-c or kill
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signal_number, lambda *_: daemon.stop())
+    daemon.serve_forever()
@@ -0,0 +1,207 @@
+"""
+A journal of the points of a QE scan, so a scan that dies partway through
+can be picked up where it stopped.
+
+A scan of a few hundred wavelengths takes hours, and a dropped lamp
+connection or a failed ktl write near the end used to mean starting over.
+With a journal, every finished point is appended to a JSON lines file as
+soon as its frame has been read out, and flushed to disk before the next
+point is taken:
+
+{"type": "scan", "wavelengths": [400.0, 410.0, ...], "started": 1760790000.0}
+{"type": "point", "index": 0, "wavelength": 400.0, "lamp": [11.5, 6.0],
+ "camera": {"GAINMODE": "Gain1", ...}, "exposure_time": 2.5,
+ "filename": "/data/qe/frame_0001.fits", "time": 1760790031.2}
+{"type": "reduced", "index": 0, "reduced": 41234.5}
+...
+
+The result of reducing a frame is journaled too, when it finishes, if it
+can be written as JSON, so a resumed scan does not reduce those frames
+again.
+
+Running the same scan again with the same journal, after reconnecting the
+hardware, skips the points already in the journal, puts the camera back the
+way it was at the last good point, and carries on from the next one:
+
+>>> run_qe_scan(plan.wavelengths, andorcam, monochromator, w_lamp,
+...             lamp_settings=settings_for, journal='qe_scan_2026-10-18.jsonl')
+
+A journal belongs to one scan. Using it for a different list of wavelengths
+is an error, so a stale journal can not silently drop points from a new
+scan.
+"""
+
+
+import json
+import os
+import threading
+import time
+
+
+class ScanJournal:
+    """
+    The journal of one scan, read from and appended to a JSON lines file.
+
+    Parameters
+    ----------
+    filename: string
+        The journal file. It is created by start if it does not exist, and
+        read if it does.
+
+    Attributes
+    ----------
+    wavelengths: list of floats or None
+        The wavelengths of the scan, or None before start
+    points: dict
+        Journal entries of the finished points, by index into wavelengths
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.wavelengths = None
+        self.points = {}
+        self._file = None
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.filename) as file:
+                lines = file.readlines()
+        except FileNotFoundError:
+            return
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # half written when the scan died, the point was not finished
+                continue
+            if entry.get('type') == 'scan':
+                self.wavelengths = entry['wavelengths']
+            elif entry.get('type') == 'point':
+                self.points[entry['index']] = entry
+            elif entry.get('type') == 'reduced' and entry['index'] in self.points:
+                self.points[entry['index']]['reduced'] = entry['reduced']
+
+    def _append(self, entry):
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.filename, 'a')
+            self._file.write(json.dumps(entry) + '\n')
+            # the point only counts once it is on disk
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def start(self, wavelengths):
+        """
+        Start a new scan, or check a resumed one is the same scan.
+
+        Parameters
+        ----------
+        wavelengths: list of floats
+            Every wavelength of the scan, in scan order
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        ValueError:
+            If the journal was written for a different list of wavelengths
+        """
+        wavelengths = [float(wavelength) for wavelength in wavelengths]
+        if self.wavelengths is None:
+            self._append({'type': 'scan', 'wavelengths': wavelengths, 'started': time.time()})
+            self.wavelengths = wavelengths
+        elif self.wavelengths != wavelengths:
+            raise ValueError('journal %s is for a different scan, of %i wavelengths from %s nm'
+                             % (self.filename, len(self.wavelengths),
+                                self.wavelengths[0] if self.wavelengths else None))
+
+    @property
+    def next_index(self):
+        """
+        The index of the first point still to take. Points finish in scan
+        order, so every point before it is in the journal.
+        """
+        return max(self.points) + 1 if self.points else 0
+
+    def last_point(self):
+        """
+        Returns
+        -------
+        entry: dict or None
+            The journal entry of the last finished point, or None if no
+            point has finished
+        """
+        return self.points[max(self.points)] if self.points else None
+
+    def record(self, index, wavelength, lamp=None, camera=None, exposure_time=None,
+               filename=None):
+        """
+        Journal a finished point.
+
+        Parameters
+        ----------
+        index: int
+            The index of the point into the wavelengths of the scan
+        wavelength: float
+        lamp: tuple, optional
+            (volts, amps) the lamp was set to
+        camera: dict, optional
+            The camera settings, from the controller's keyword_state
+        exposure_time: float, optional
+            The exposure time, in seconds, if the scan set it for this point
+        filename: string, optional
+            The file the frame was written to. Anything that is not a
+            string, e.g. a frame fetched into memory, is journaled as None.
+
+        Returns
+        -------
+        None
+        """
+        entry = {'type': 'point', 'index': index, 'wavelength': float(wavelength),
+                 'lamp': list(lamp) if lamp is not None else None,
+                 'camera': camera or {},
+                 'exposure_time': exposure_time,
+                 'filename': filename if isinstance(filename, str) else None,
+                 'time': time.time()}
+        self._append(entry)
+        self.points[index] = entry
+
+    def record_reduced(self, index, reduced):
+        """
+        Journal the result of reducing a point's frame.
+
+        Parameters
+        ----------
+        index: int
+            The index of a point already recorded
+        reduced: any
+            The result, journaled only if it can be written as JSON
+
+        Returns
+        -------
+        bool
+            True if it was journaled
+        """
+        try:
+            json.dumps(reduced)
+        except (TypeError, ValueError):
+            return False
+        self._append({'type': 'reduced', 'index': index, 'reduced': reduced})
+        self.points[index]['reduced'] = reduced
+        return True
+
+    def close(self):
+        """
+        Close the journal file. It is reopened if anything else is recorded.
+
+        Returns
+        -------
+        None
+        """
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
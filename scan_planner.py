@@ -0,0 +1,275 @@
+"""
+Planning the order and monochromator settings of a QE scan.
+
+Changing the Cornerstone grating, or rotating the filter wheel, takes far
+longer than a small wavelength step. The planner picks a grating and an
+order sorting filter for every wavelength of a scan, and the order to
+visit them in, so that the scan needs as few grating changes, filter
+rotations and as little slewing as possible.
+
+Which gratings and filters can be used at which wavelengths comes from the
+scan_plan section of config.yaml, together with how long each kind of move
+takes:
+
+scan_plan :
+    gratings :
+        1 : [200, 1000]
+        2 : [500, 2500]
+    filters :
+        1 : [200, 600]
+        2 : [590, 1100]
+        3 : [1050, 2500]
+    grating_change_time : 10.0
+    filter_change_time : 1.5
+    slew_rate : 100.0
+
+A filter is only ever used inside its range, so the order sorting stays
+correct whatever else the planner does.
+
+The wavelengths are visited in a single sweep, up or down, whichever is
+cheaper from where the monochromator starts. For the sweep, the grating and
+filter of every point are chosen together by dynamic programming over the
+valid combinations, which finds the cheapest assignment exactly, e.g. it
+keeps a filter that is valid over a longer stretch rather than switching to
+a better one and back.
+
+With the scan_plan above, and the monochromator on grating 1, filter 1 at
+400 nm, e.g. start=(monochromator.grating, monochromator.filter_index,
+monochromator.wavelength):
+
+>>> plan = plan_scan(range(400, 1201, 10), config['scan_plan'], start=(1, 1, 400.0))
+>>> plan
+<ScanPlan 81 points, 21.0 s motion, 1 grating changes, 2 filter changes, 800.0 nm slew>
+>>> run_qe_scan(plan.wavelengths, andorcam, monochromator,
+...             grating_for=plan.grating_for, filter_for=plan.filter_for)
+"""
+
+
+import collections
+
+
+PlanPoint = collections.namedtuple('PlanPoint', ['wavelength', 'grating', 'filter_index',
+                                                 'motion_time'])
+PlanPoint.__doc__ = """
+One point of a scan plan.
+
+wavelength: float
+    Center wavelength, in nm
+grating: int
+    The grating to use
+filter_index: int
+    The filter wheel position to use
+motion_time: float
+    Predicted seconds of monochromator motion to get here from the previous
+    point
+"""
+
+
+class ScanPlan:
+    """
+    The order and monochromator settings of a scan, as made by plan_scan.
+
+    Attributes
+    ----------
+    points: list of PlanPoint
+        In the order they are to be taken
+    motion_time: float
+        Predicted seconds of monochromator motion for the whole scan
+    grating_changes: int
+    filter_changes: int
+    slew: float
+        Total wavelength travel, in nm
+    """
+    def __init__(self, points, grating_changes, filter_changes, slew):
+        self.points = list(points)
+        self.motion_time = sum(point.motion_time for point in self.points)
+        self.grating_changes = grating_changes
+        self.filter_changes = filter_changes
+        self.slew = slew
+        self._settings = {point.wavelength: point for point in self.points}
+
+    def __repr__(self):
+        return ('<ScanPlan %i points, %.1f s motion, %i grating changes, %i filter changes, '
+                '%.1f nm slew>' % (len(self.points), self.motion_time, self.grating_changes,
+                                   self.filter_changes, self.slew))
+
+    @property
+    def wavelengths(self):
+        return [point.wavelength for point in self.points]
+
+    def grating_for(self, wavelength):
+        # the planned grating of a wavelength, for run_qe_scan
+        return self._settings[wavelength].grating
+
+    def filter_for(self, wavelength):
+        # the planned filter of a wavelength, for run_qe_scan
+        return self._settings[wavelength].filter_index
+
+
+def _ranges(plan_config, key):
+    # {index: (low, high)} from the config, with integer keys
+    return {int(index): (float(low), float(high))
+            for index, (low, high) in plan_config[key].items()}
+
+
+def _filter_steps(start, end, positions):
+    # the wheel turns whichever way is shorter
+    steps = abs(start - end) % positions
+    return min(steps, positions - steps)
+
+
+class _MotionModel:
+    # predicted seconds for the monochromator to go from one setting to another
+    def __init__(self, plan_config):
+        self.grating_change_time = float(plan_config.get('grating_change_time', 10.0))
+        self.filter_change_time = float(plan_config.get('filter_change_time', 1.5))
+        self.slew_rate = float(plan_config.get('slew_rate', 100.0))
+        self.filter_positions = int(plan_config.get('filter_positions', 6))
+
+    def time(self, start, end):
+        # start and end are (grating, filter_index, wavelength), start may
+        # have None for anything not known
+        grating, filter_index, wavelength = start
+        seconds = 0.0
+        if grating != end[0]:
+            seconds += self.grating_change_time
+        if filter_index != end[1]:
+            steps = (1 if filter_index is None
+                     else _filter_steps(filter_index, end[1], self.filter_positions))
+            seconds += self.filter_change_time * steps
+        if wavelength is not None:
+            seconds += abs(end[2] - wavelength) / self.slew_rate
+        return seconds
+
+
+def predict_motion_time(settings, plan_config, start=None):
+    """
+    Predict the monochromator motion time of any sequence of settings, e.g.
+    to compare a hand made scan order with a planned one.
+
+    Parameters
+    ----------
+    settings: iterable of tuples
+        (wavelength, grating, filter_index) for each point, in order
+    plan_config: dict
+        The scan_plan section of the config
+    start: tuple, optional
+        (grating, filter_index, wavelength) the monochromator starts at. If
+        None, the first move is counted as a grating and filter change with
+        no slew.
+
+    Returns
+    -------
+    motion_time: float
+        Predicted seconds
+    """
+    model = _MotionModel(plan_config)
+    current = start or (None, None, None)
+    seconds = 0.0
+    for wavelength, grating, filter_index in settings:
+        end = (grating, filter_index, wavelength)
+        seconds += model.time(current, end)
+        current = end
+    return seconds
+
+
+def _plan_sweep(wavelengths, combinations, model, start):
+    # choose a (grating, filter_index) for every wavelength of a sweep, in
+    # the order given, by dynamic programming over the valid combinations
+    # returns (cost, [(grating, filter_index), ...])
+    # best[combination] = (cost so far, index into history)
+    history = []
+    best = {}
+    for position, wavelength in enumerate(wavelengths):
+        valid = [combination for combination, (low, high) in combinations.items()
+                 if low <= wavelength <= high]
+        if not valid:
+            raise ValueError('no grating and filter combination covers %s nm' % wavelength)
+        new_best = {}
+        for combination in valid:
+            end = combination + (wavelength,)
+            if position == 0:
+                new_best[combination] = (model.time(start, end), None)
+                continue
+            previous_wavelength = wavelengths[position - 1]
+            new_best[combination] = min(
+                (cost + model.time(previous + (previous_wavelength,), end), previous)
+                for previous, (cost, _) in best.items())
+        history.append(new_best)
+        best = new_best
+
+    # walk back through the choices from the cheapest end
+    combination, (cost, _) = min(best.items(), key=lambda item: item[1][0])
+    total = cost
+    chosen = []
+    for step in reversed(history):
+        chosen.append(combination)
+        combination = step[combination][1]
+    chosen.reverse()
+    return total, chosen
+
+
+def plan_scan(wavelengths, plan_config, start=None):
+    """
+    Plan the order and monochromator settings of a scan.
+
+    Parameters
+    ----------
+    wavelengths: iterable of floats
+        The wavelengths to take, in nm, in any order. Repeats are taken once.
+    plan_config: dict
+        The scan_plan section of the config, with the 'gratings' and
+        'filters' validity ranges, and optionally 'grating_change_time' and
+        'filter_change_time' (per filter position turned) in seconds,
+        'slew_rate' in nm per second, and 'filter_positions'.
+    start: tuple, optional
+        (grating, filter_index, wavelength) the monochromator starts at,
+        e.g. the tracked state of a Monochromator. If None, the planner
+        assumes nothing about the starting state.
+
+    Returns
+    -------
+    instance of class ScanPlan
+
+    Raises
+    ------
+    ValueError:
+        If no grating and filter combination covers one of the wavelengths
+    """
+    model = _MotionModel(plan_config)
+    gratings = _ranges(plan_config, 'gratings')
+    filters = _ranges(plan_config, 'filters')
+    # the wavelengths each grating and filter pair covers, skipping pairs
+    # that don't overlap
+    combinations = {}
+    for grating, (grating_low, grating_high) in gratings.items():
+        for filter_index, (filter_low, filter_high) in filters.items():
+            low, high = max(grating_low, filter_low), min(grating_high, filter_high)
+            if low <= high:
+                combinations[(grating, filter_index)] = (low, high)
+
+    ascending = sorted(set(float(wavelength) for wavelength in wavelengths))
+    if not ascending:
+        return ScanPlan([], 0, 0, 0.0)
+    start = tuple(start) if start is not None else (None, None, None)
+
+    # sweep up or down, whichever is cheaper from the starting state
+    sweeps = []
+    for order in (ascending, ascending[::-1]):
+        cost, chosen = _plan_sweep(order, combinations, model, start)
+        sweeps.append((cost, order, chosen))
+    cost, order, chosen = min(sweeps, key=lambda sweep: sweep[0])
+
+    points = []
+    current = start
+    grating_changes = filter_changes = 0
+    slew = 0.0
+    for wavelength, (grating, filter_index) in zip(order, chosen):
+        end = (grating, filter_index, wavelength)
+        points.append(PlanPoint(wavelength, grating, filter_index, model.time(current, end)))
+        grating_changes += current[0] is not None and current[0] != grating
+        filter_changes += current[1] is not None and current[1] != filter_index
+        if current[2] is not None:
+            slew += abs(wavelength - current[2])
+        current = end
+    return ScanPlan(points, grating_changes, filter_changes, slew)
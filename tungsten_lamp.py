@@ -1,8 +1,82 @@
 
 
+import asyncio
+import collections
 import socket
 import re
-from time import sleep
+from time import monotonic, perf_counter, sleep
+
+import lantronix
+import metrics
+import wire_log
+
+
+def _volts_command(voltage):
+    # formating is 3 numaric characters, with the last one being the decimal place
+    # eg, float input  12.3
+    # characters  123
+    # string passed  'VOLT00123\r'
+
+    # multiply float by ten, then truncate
+    # % 1000 (modulus 1000) removes all digits above 3 places
+    sanitized_input = int(voltage * 10 % 1000)
+    return b'VOLT00%(volts)03d\r' % {b'volts': sanitized_input}
+
+
+def _curr_command(current):
+    # formating is 3 numeric characters, with the last two being decimal places
+    # eg, to set 4.56 amps, give float input  4.56
+    # then pass characters 456
+    # string passed  'CURR00456\r'
+    sanitized_input = int(current * 100 % 1000)
+    # %03d means: digits, if less than 3 pad with zeros out to 3 places
+    return b'CURR00%03d\r' % sanitized_input
+
+
+def _parse_outputs(reply):
+    # returned string has the voltage and current information
+    # eg, if set voltage = 12.3 V and set current = 4.56 A, the
+    # return message string will be: '123456\rOK\r'
+
+    # extract the info of interest: 6 digits followed by a \r
+    match = re.search(br'(\d{6})\r', reply)
+    if match is None:
+        raise RuntimeError('Unexpected reply: BK Precision power supply sent', reply)
+    raw_output_str = match[0]
+    raw_voltage = raw_output_str[:3]
+    raw_current = raw_output_str[3:6]
+
+    voltage = float(raw_voltage)/10
+    current = float(raw_current)/100
+
+    return voltage, current
+
+
+def _parse_display(reply):
+    # GETD returns the measured output, 4 digits of voltage and 4 of current,
+    # both with two decimal places, and the regulation mode, 0 for constant
+    # voltage, 1 for constant current
+    # eg, 12.30 V, 4.56 A in constant voltage mode: '123004560\rOK\r'
+    match = re.search(br'(\d{4})(\d{4})([01])\r', reply)
+    if match is None:
+        raise RuntimeError('Unexpected reply: BK Precision power supply sent', reply)
+    voltage = float(match[1]) / 100
+    current = float(match[2]) / 100
+    return voltage, current, match[3] == b'1'
+
+
+def _take_reply(buffer):
+    # remove and return the first complete, 'OK\r' terminated reply from a
+    # bytearray of received data, or None if there isn't one yet
+    # the null characters the BK/Lantronix emit on power up/down must already
+    # be stripped, since they can land in the middle of the 'OK\r'
+    end = buffer.find(b'OK\r')
+    if end < 0:
+        return None
+    end += len(b'OK\r')
+    reply = bytes(buffer[:end])
+    del buffer[:end]
+    return reply
 
 
 class TungstenLamp:
@@ -39,16 +113,18 @@ class TungstenLamp:
         hanging while it waits for a reply that will never come.
     message_size: int, optional
         The number of characters the client-side socket will request from the
-        server-side character buffer. Default is 1024, and represents a maximum
-        number of characters to receive. The BK power supply always ends a
-        reply with 'OK\r'. If the reply buffer does end with a 'OK\r', then
-        TunstenLamp will repeat the request every 100ms up to 5 times until a
-        'OK\r' is dectected at the buffer end. If after 5 times a 'OK\r' is not
-        detected, it will raise an error.
+        server-side character buffer in a single read. Default is 1024.
+        Received characters are collected in a buffer and split into replies
+        on the 'OK\r' terminator, so a reply that arrives in several pieces
+        is reassembled, and characters past the terminator are kept for the
+        next reply. If no complete reply arrives within timeout seconds, an
+        error is raised.
     verbose: bool
         If True, TungstenLamp will print statements to help with debugging.
         Specifically, it will print every byte-string send to and received from
-        the BK power supply.
+        the BK power supply. It is printed by the calling thread, as each
+        command goes out and each reply comes in; only writing the wire log
+        file is left to the wire_log background thread.
 
     Methods
     -------
@@ -62,6 +138,8 @@ class TungstenLamp:
         set the current of the power supply output
     get_outputs:
         Returns the voltage and current settings of the power supply output.
+    get_measured_outputs:
+        Returns the voltage and current actually measured at the output.
     shutdown:
         Turns off the output and shuts down the connection to the power supply
 
@@ -71,9 +149,9 @@ class TungstenLamp:
         Occurs when the server side of the connection to the Lantronix is
         closed.
     RuntimeError:
-        Occurs when a reply message that does not end with a 'OK\r' is found in
-        the output buffer of the Lantronix connection. This generally means the
-        BK power supply is not on.
+        Occurs when no reply ending with a 'OK\r' arrives from the Lantronix
+        connection within timeout seconds. This generally means the BK power
+        supply is not on.
 
     Notes
     -----
@@ -83,10 +161,11 @@ class TungstenLamp:
     power supply does not track number of hours of runtime, so this needs to be
     tracked in software. This has not yet been implemented
 
-    This needs some kind of logging. An obvious place is the _send_message and
-    _receive_message helper methods. They already contain optional print
-    statements of each byte-string send to and received from the BK, these seem
-    like a good thing to also log.
+    Every byte-string sent to and received from the BK is handed to wire_log
+    by the _send_message and _receive_message helper methods, which _query
+    calls with the connection's lock held, so threads sharing the Lantronix
+    connection don't take each other's replies. Call
+    wire_log.open_wire_log to keep a timestamped record of them on disk.
 
     Currently, set commands return None.  They could be set to return the reply
     string, but that redundant with error checks, and inconsistent with the get
@@ -107,29 +186,31 @@ class TungstenLamp:
     def __init__(self, ip_port, timeout=8, message_size=1024, verbose=True):
         self.verbose = verbose
         self.message_size = message_size
+        self.timeout = timeout
 
         # set up the communication here
         # record the ip address and port
         self.ip_address = ip_port[0]
         self.port_number = ip_port[1]
-        # build the socket
-        self._lan_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-        self._lan_socket.settimeout(timeout)
+        # the connection is shared with anything else using this Lantronix
+        # port, and reconnects by itself if the Lantronix drops it
+        self._connection = lantronix.get_connection(ip_port, timeout=timeout,
+                                                    message_size=message_size)
+        # (command, send time) of the command waiting on a reply, for metrics
+        self._sent = None
 
         # connect to the port and ip address.
-        self._lan_socket.connect(ip_port)
+        self._connection.connect()
         # when the BK powers down, b'\x00\x00\x00' will be found in the output buffer
         # when the BK powers up, b'\x00' will be found in the output buffer.
         # Not sure if the source of the above is the Lantronix or the BK power supply.
         # Random characters can also be found in the output buffer, these are probably noise
+        # The null characters are stripped by the connection as they are read
 
         # start remote session by disabling the front panel.
         # If the user really wants the front panel, they can reverse this by sending b'ENDS00\r"
-        self._send_message(b'SESS00\r', empty=False)
-
         # recieve the ok, and discard. This also clears the buffer
-        self._receive_message()
+        self._query(b'SESS00\r', empty=False)
 
         # I haven't found the initialization commands in the tcl code
         # possible initialization calls
@@ -138,70 +219,59 @@ class TungstenLamp:
 
     # methods for controlling the current
 
-    # prototypes for sending and recieving communications from the current controller.
-    # these will probably be wrappers for a generic communication class
+    # sending and recieving communications from the current controller.
+    # these are wrappers for the shared Lantronix connection
 
-    def _send_message(self, output_string, verbose=None, empty=True, **kwargs):
+    def _send_message(self, output_string, verbose=None, empty=True):
         # strings must be in binary ASCII
         if verbose is None:
             verbose = self.verbose
 
-        if empty:
-            # empty the buffer by performing a call and response, and discarding the reply
-            # this is a cludge, to deal with noise appearing in the bitstream
-            # simply requesting the buffer to send it's data empties the data
-            # but the request will result in a timeout error if there is no data to receive
-            # to prevent a timeout, send a 'GETS00\r' to ensure something is in the buffer
-            # in the future, someone should figure out a better way of emptying the buffer
-            # UPDATE: the SPG says there is a way of clearing the buffer
-            self._lan_socket.sendall(b'GETS00\r')
-            if verbose:
-                print('Command sent:', b'GETS00\r')
-            sleep(0.1)  # sleep briefly to let the message send
-            self._receive_message()
-
-        self._lan_socket.sendall(output_string, **kwargs)
-        if verbose:
-            print('Command sent:', output_string)
-        sleep(0.1)  # sleep briefly to let the message send
-
-    def _receive_message(self, verbose=None, **kwargs):
+        # empty=True discards stale characters, e.g. noise, or replies that
+        # nobody waited for, before sending
+        if metrics.registry.enabled:
+            # time the round trip from here to the end of _receive_message
+            self._sent = (output_string[:4].decode('ascii', errors='replace'), perf_counter())
+        self._connection.send(output_string, empty=empty)
+        # logged from a background thread, only printed here if verbose
+        wire_log.record('w_lamp', 'send', output_string, echo=verbose)
+
+    def _receive_message(self, verbose=None, timeout=None):
         if verbose is None:
             verbose = self.verbose
-        # connection should automatically time out after 8 secs
-        reply = self._lan_socket.recv(self.message_size, **kwargs)
-
-        if reply == '':
-            # this means the lantronix closed the socket for some reason
-            # close this end, and raise error
-            self._lan_socket.close()
-            raise BrokenPipeError(str(self.ip_address) + str(self.port_number) + 'closed connection')
-
-        # check for end of string having a 'OK\r'
-        tries = 1
-        while reply[-3:] != b'OK\r':
-            # if verbose:
-            #     print('Message request', tries, 'received:', reply)
-
-            # it should never take more than 2 tries
-            # give it five tries, then raise an error
-            if tries == 5:
-                # possible exception classes:
-                # ValueError
-                # RuntimeError
-                # consider makign a custom error
-                raise RuntimeError('Unexpected reply: BK Precision power supply responded with', reply)
-            # sleep for a moment
-            sleep(0.1)
-            # get more of the buffer
-            reply += self._lan_socket.recv(self.message_size, **kwargs)
-            tries += 1
-
-        if verbose:
-            print('Reply received:', reply)
+
+        # wait for a complete reply, i.e. everything up to and including the
+        # next 'OK\r', until the timeout runs out
+        try:
+            reply = self._connection.read_until(b'OK\r', timeout=timeout)
+        except socket.timeout as err:
+            # possible exception classes:
+            # ValueError
+            # RuntimeError
+            # consider makign a custom error
+            raise RuntimeError('Unexpected reply: BK Precision power supply did not respond',
+                               str(err))
+        finally:
+            # a failed command must not be timed against the next reply
+            sent, self._sent = self._sent, None
+
+        if metrics.registry.enabled and sent is not None:
+            command, sent_at = sent
+            metrics.registry.observe('lamp_command_seconds', perf_counter() - sent_at,
+                                     command=command)
+
+        wire_log.record('w_lamp', 'recv', reply, echo=verbose)
 
         return reply
 
+    def _query(self, output_string, empty=True):
+        # send a command and return its reply, holding the connection lock
+        # for both, so another thread sharing the connection can't take the
+        # reply
+        with self._connection.lock:
+            self._send_message(output_string, empty=empty)
+            return self._receive_message()
+
     def off(self):
         """
         Turns the power output of the BK Precision power supply off
@@ -213,9 +283,7 @@ class TungstenLamp:
         None
 
         """
-        self._send_message(output_string=b'SOUT001\r')
-
-        self._receive_message()
+        self._query(b'SOUT001\r')
 
     def on(self):
         """
@@ -227,7 +295,8 @@ class TungstenLamp:
         -------
         None
         """
-        self._send_message(output_string=b'SOUT000\r')
+        # clear buffer and check for errors
+        self._query(b'SOUT000\r')
 
     def set_volts(self, voltage):
         """
@@ -246,23 +315,11 @@ class TungstenLamp:
         None
 
         """
-        # formating is 3 numaric characters, with the last one being the decimal place
-        # eg, float input  12.3
-        # characters  123
-        # string passed  'VOLT00123\r'
-
-        # multiply float by ten, then truncate
-        # % 1000 (modulus 1000) removes all digits above 3 places
-        sanitized_input = int(voltage * 10 % 1000)
-        command = b'VOLT00%(volts)03d\r' % {b'volts': sanitized_input}
-        # command = b'VOLT00{:03d}\r'.format(sanitized_input)
-        self._send_message(command)
-
         # pause while the command
         # clear the buffer.
         # This will raise an error if the most recent command did not execute
         # not sure if I should return this function
-        self._receive_message()
+        self._query(_volts_command(voltage))
 
     def set_curr(self, current):
         """
@@ -283,18 +340,8 @@ class TungstenLamp:
         -------
         None
         """
-        # formating is 3 numeric characters, with the last two being decimal places
-        # eg, to set 4.56 amps, give float input  4.56
-        # then pass characters 456
-        # string passed  'CURR00456\r'
-        sanitized_input = int(current * 100 % 1000)
-        # command = 'CURR00{:03d}\r'.format(sanitized_input)
-        # %03d means: digits, if less than 3 pad with zeros out to 3 places
-        command = b'CURR00%03d\r' % sanitized_input
-        self._send_message(command)
-
         # clear buffer and check for errors
-        self._receive_message()
+        self._query(_curr_command(current))
 
     def get_outputs(self):
         """
@@ -319,23 +366,116 @@ class TungstenLamp:
         """
         # NOTE: this has not been found in the tcl code
 
-        self._send_message(b'GETS00\r')
         # logging and error handling
+        reply = self._query(b'GETS00\r')
 
-        # returned string has the voltage and current information
-        # eg, if set voltage = 12.3 V and set current = 4.56 A, the
-        # return message string will be: '123456\rOK\r'
-        reply = self._receive_message()
+        return _parse_outputs(reply)
 
-        # extract the info of interest: 6 digits followed by a \r
-        raw_output_str = re.search(br'(\d{6})\r', reply)[0]
-        raw_voltage = raw_output_str[:3]
-        raw_current = raw_output_str[3:6]
+    def get_measured_outputs(self):
+        """
+        Query the BK Precision 1697 power supply for the voltage and current
+        it is actually putting out, as shown on its display.
 
-        voltage = float(raw_voltage)/10
-        current = float(raw_current)/100
+        Unlike get_outputs, which returns the voltage setting and the
+        current limit, this follows the lamp: while the filament warms up
+        its resistance rises, and the current it draws falls.
 
-        return voltage, current
+        Returns
+        -------
+        voltage: float
+            The measured output voltage, in volts, e.g. 12.30
+        current: float
+            The measured output current, in amps, e.g. 4.56
+        constant_current: bool
+            True if the supply is limiting the current, False if it is
+            regulating the voltage
+        """
+        reply = self._query(b'GETD00\r')
+        return _parse_display(reply)
+
+    def wait_for_warmup(self, tolerance=1e-3, poll_interval=1.0, window=30, timeout=900,
+                        signal=None, verbose=None):
+        """
+        Wait until the lamp output has settled after being turned on.
+
+        The lamp warms up over a period of unknown length. Instead of
+        sleeping for a fixed, conservative time, this polls a signal and fits
+        the settling curve as the samples arrive, returning as soon as the
+        predicted remaining drift is within tolerance.
+
+        The most recent window samples are split into three equal blocks,
+        and the block means m0, m1, m2 are compared. For an exponential
+        settling curve, the steps m1 - m0 and m2 - m1 shrink by a constant
+        ratio r, and the drift still to come is (m2 - m1) * r / (1 - r). If
+        the signal is not settling like an exponential, the latest step
+        m2 - m1 is used as the drift estimate instead.
+
+        Parameters
+        ----------
+        tolerance: float, optional
+            The largest acceptable remaining drift, as a fraction of the
+            signal, e.g. 1e-3 for 0.1%.
+        poll_interval: float, optional
+            Seconds between samples.
+        window: int, optional
+            The number of samples the fit uses. Must be at least 3.
+        timeout: float, optional
+            Seconds to wait before giving up.
+        signal: callable, optional
+            A function with no arguments returning the quantity to watch,
+            e.g. the mean of a camera window. If None, the electrical power
+            going into the lamp, measured volts times measured amps from
+            get_measured_outputs, is used. The settings from get_outputs
+            can't be used, they never change by themselves.
+        verbose: bool, optional
+            If True, print the drift estimate at every sample. Defaults to
+            the class verbose setting.
+
+        Returns
+        -------
+        value: float
+            The settled signal value, the mean of the last block
+
+        Raises
+        ------
+        TimeoutError:
+            If the signal has not settled after timeout seconds
+        """
+        if verbose is None:
+            verbose = self.verbose
+        if signal is None:
+            def signal():
+                volts, amps, _ = self.get_measured_outputs()
+                return volts * amps
+        # a multiple of 3, so the blocks are equal
+        window = max(3, window - window % 3)
+        block = window // 3
+
+        samples = collections.deque(maxlen=window)
+        deadline = monotonic() + timeout
+        while True:
+            sample_time = monotonic()
+            samples.append(signal())
+
+            if len(samples) == window:
+                values = list(samples)
+                m0, m1, m2 = (sum(values[i * block:(i + 1) * block]) / block for i in range(3))
+                step0, step1 = m1 - m0, m2 - m1
+                if step0 != 0 and 0 <= step1 / step0 < 1:
+                    ratio = step1 / step0
+                    drift = step1 * ratio / (1 - ratio)
+                else:
+                    drift = step1
+                relative_drift = abs(drift) / abs(m2) if m2 else abs(drift)
+                if verbose:
+                    print('Lamp warm-up: signal %g, predicted drift %.2e' % (m2, relative_drift))
+                if relative_drift <= tolerance:
+                    return m2
+
+            if sample_time + poll_interval > deadline:
+                raise TimeoutError('Lamp output did not settle to within %g in %s s'
+                                   % (tolerance, timeout))
+            sleep(max(sample_time + poll_interval - monotonic(), 0))
 
     def shutdown(self):
         """
@@ -358,10 +498,9 @@ class TungstenLamp:
         # turn off the lamp power
         self.off()
         # return panel control
-        self._send_message(b'ENDS00\r')
-        self._receive_message()
+        self._query(b'ENDS00\r')
         # last, close the socket
-        self._lan_socket.close()
+        self._connection.close()
 
     # lamp_volts, lamp_current, on_off
     # keep track of how long the lamp is on for
@@ -369,4 +508,294 @@ class TungstenLamp:
     # work on figuring out what serial codes to send later
 
     # not sure what w_lamp() is, where it is defined
-    # sqlset w_lamp(volt,value) $volt
\ No newline at end of file
+    # sqlset w_lamp(volt,value) $volt
+
+
+class AsyncTungstenLamp:
+    """
+    An asyncio version of TungstenLamp, for controlling the BK Precision 1697
+    power supply from inside an event loop.
+
+    AsyncTungstenLamp has the same methods as TungstenLamp, but every method
+    is a coroutine. Commands are written to the Lantronix as soon as they are
+    issued, without waiting for the previous reply, and each command is
+    matched to its 'OK\r' reply in the order the commands were sent. This
+    lets lamp commands overlap camera readout and monochromator motion in the
+    same event loop.
+
+    The same restrictions as TungstenLamp apply: only one instance should run
+    at a time, and shutdown must be awaited before discarding an instance.
+
+    If a command times out, its reply may still turn up later, and would be
+    taken as the reply to a later command. So after a timeout every command
+    still waiting fails too, and the next command first waits for the
+    connection to go quiet, throwing away whatever arrives, before it is
+    sent.
+
+    Parameters
+    ----------
+    ip_port: tuple
+        the ip address of the Lantronix, and the particular Lantronix port
+        controlling the BK Precision 1697 power supply. This should have the
+        format: (<ip address>, <port number>).
+    timeout: non-negative float or None, optional
+        The number of seconds to wait for the connection, and for the reply
+        to each command. If set to None, commands never time out.
+    message_size: int, optional
+        The maximum number of characters read from the connection at once.
+    verbose: bool
+        If True, print every byte-string sent to and received from the BK
+        power supply.
+
+    Notes
+    -----
+    The connection is not opened by the constructor, since constructors can't
+    be awaited. Either await the open method, or build an instance with the
+    connect class method:
+
+    >>> w_lamp = await AsyncTungstenLamp.connect(('128.114.17.186', 10002))
+    >>> await asyncio.gather(w_lamp.set_volts(9.0), w_lamp.set_curr(4.56))
+    >>> await w_lamp.on()
+    """
+    # seconds of silence that show every late reply has arrived
+    _RESYNC_QUIET_TIME = 0.5
+
+    def __init__(self, ip_port, timeout=8, message_size=1024, verbose=True):
+        self.verbose = verbose
+        self.timeout = timeout
+        self.message_size = message_size
+
+        self.ip_address = ip_port[0]
+        self.port_number = ip_port[1]
+
+        self._reader = None
+        self._writer = None
+        self._reply_task = None
+        # futures for the commands still waiting on a reply, oldest first
+        self._in_flight = collections.deque()
+        # set when a command times out, until the late replies are drained
+        self._desynchronized = False
+        self._resync_lock = None
+
+    @classmethod
+    async def connect(cls, ip_port, **kwargs):
+        """
+        Build an AsyncTungstenLamp instance and open the connection.
+
+        Parameters
+        ----------
+        ip_port: tuple
+            (<ip address>, <port number>) of the Lantronix port
+        kwargs: optional
+            Pass-through keyword arguments for the AsyncTungstenLamp class
+
+        Returns
+        -------
+        instance of class AsyncTungstenLamp
+        """
+        w_lamp = cls(ip_port, **kwargs)
+        await w_lamp.open()
+        return w_lamp
+
+    async def open(self):
+        """
+        Connect to the Lantronix and start a remote session, which disables
+        the front panel.
+
+        Returns
+        -------
+        None
+        """
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.ip_address, self.port_number),
+            self.timeout)
+        self._reply_task = asyncio.ensure_future(self._read_replies())
+        self._resync_lock = asyncio.Lock()
+
+        await self._command(b'SESS00\r')
+
+    async def _read_replies(self):
+        # hand each 'OK\r' terminated reply to the oldest command in flight
+        buffer = bytearray()
+        try:
+            while True:
+                reply = _take_reply(buffer)
+                if reply is None:
+                    chunk = await self._reader.read(self.message_size)
+                    if not chunk:
+                        raise asyncio.IncompleteReadError(bytes(buffer), None)
+                    # frame on the stripped data, a reply can arrive split
+                    # across reads, with noise anywhere in it
+                    buffer += chunk.replace(b'\x00', b'')
+                    continue
+                wire_log.record('w_lamp', 'recv', reply, echo=self.verbose)
+                if not self._in_flight:
+                    # noise, or a reply to a command sent by someone else
+                    continue
+                future = self._in_flight.popleft()
+                if not future.done():
+                    future.set_result(reply)
+        except asyncio.IncompleteReadError:
+            error = BrokenPipeError(str(self.ip_address) + ':' + str(self.port_number)
+                                    + ' closed connection')
+        except Exception as exc:
+            error = exc
+        while self._in_flight:
+            future = self._in_flight.popleft()
+            if not future.done():
+                future.set_exception(error)
+
+    async def _resynchronize(self):
+        # after a timeout, replies can no longer be matched to commands. Stop
+        # reading replies, throw away everything until the connection has
+        # been quiet for a while, then start over with nothing in flight
+        self._reply_task.cancel()
+        try:
+            await self._reply_task
+        except asyncio.CancelledError:
+            pass
+        discarded = b''
+        while True:
+            try:
+                chunk = await asyncio.wait_for(self._reader.read(self.message_size),
+                                               self._RESYNC_QUIET_TIME)
+            except asyncio.TimeoutError:
+                break
+            if not chunk:
+                raise BrokenPipeError(str(self.ip_address) + ':' + str(self.port_number)
+                                      + ' closed connection')
+            discarded += chunk
+        if discarded:
+            wire_log.record('w_lamp', 'recv', discarded, echo=self.verbose, discarded=True)
+        self._reply_task = asyncio.ensure_future(self._read_replies())
+        self._desynchronized = False
+
+    async def _command(self, output_string):
+        # send a command and wait for the matching reply. Several commands can
+        # be waiting at once, the queue keeps them in send order
+        if self._reply_task is None or self._reply_task.done():
+            raise BrokenPipeError(str(self.ip_address) + ':' + str(self.port_number)
+                                  + ' is not connected')
+        if self._desynchronized:
+            async with self._resync_lock:
+                if self._desynchronized:
+                    await self._resynchronize()
+
+        future = asyncio.get_event_loop().create_future()
+        # queue the future and write the command with no await in between, so
+        # the queue order always matches the order on the wire
+        self._in_flight.append(future)
+        self._writer.write(output_string)
+        wire_log.record('w_lamp', 'send', output_string, echo=self.verbose)
+        await self._writer.drain()
+
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            # the replies still to come can't be trusted to line up, fail
+            # every command in flight, and drain before the next one
+            self._desynchronized = True
+            error = RuntimeError('Unexpected reply: BK Precision power supply lost track of '
+                                 'replies after a command timed out', output_string)
+            while self._in_flight:
+                waiting = self._in_flight.popleft()
+                if not waiting.done():
+                    waiting.set_exception(error)
+            raise RuntimeError('Unexpected reply: BK Precision power supply did not respond to',
+                               output_string)
+
+    async def off(self):
+        """
+        Turns the power output of the BK Precision power supply off
+
+        Returns
+        -------
+        None
+        """
+        await self._command(b'SOUT001\r')
+
+    async def on(self):
+        """
+        Turns the power output of the BK Precision power supply on.
+
+        Returns
+        -------
+        None
+        """
+        await self._command(b'SOUT000\r')
+
+    async def set_volts(self, voltage):
+        """
+        Sets the voltage output of the BK power supply, in volts.
+
+        Parameters
+        ----------
+        voltage: float
+            Same format as TungstenLamp.set_volts, e.g. 12.3
+
+        Returns
+        -------
+        None
+        """
+        await self._command(_volts_command(voltage))
+
+    async def set_curr(self, current):
+        """
+        Set the current output limit of the BK power supply, in amps.
+
+        Parameters
+        ----------
+        current: float
+            Same format as TungstenLamp.set_curr, e.g. 4.56
+
+        Returns
+        -------
+        None
+        """
+        await self._command(_curr_command(current))
+
+    async def get_outputs(self):
+        """
+        Query the BK Precision 1697 power supply for it's voltage and
+        current output settings.
+
+        Returns
+        -------
+        voltage: float
+            The voltage output, in volts.
+        current: float
+            The current output, in amps.
+        """
+        reply = await self._command(b'GETS00\r')
+
+        return _parse_outputs(reply)
+
+    async def get_measured_outputs(self):
+        """
+        Query the BK Precision 1697 power supply for the voltage and current
+        it is actually putting out, see TungstenLamp.get_measured_outputs.
+
+        Returns
+        -------
+        voltage: float
+        current: float
+        constant_current: bool
+        """
+        reply = await self._command(b'GETD00\r')
+
+        return _parse_display(reply)
+
+    async def shutdown(self):
+        """
+        Turns off the lamp, re-enables the front panel, and closes the
+        connection to the Lantronix.
+
+        Returns
+        -------
+        None
+        """
+        await self.off()
+        await self._command(b'ENDS00\r')
+
+        self._reply_task.cancel()
+        self._writer.close()
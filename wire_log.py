@@ -0,0 +1,248 @@
+"""
+Buffered, structured log of everything sent to and received from the
+hardware.
+
+The device drivers hand every byte-string they send and receive, and every
+ktl keyword they write, to record(). Records are put on a queue and
+written by a background thread, so logging never waits on the disk or the
+terminal inside the I/O path. The log is a JSON lines file, one record per
+line, rotated when it grows past max_bytes:
+
+{"t": 1697040000.123456, "dev": "w_lamp", "dir": "send", "data": "VOLT00090\\r"}
+{"t": 1697040000.125012, "dev": "w_lamp", "dir": "recv", "data": "OK\\r"}
+{"t": 1697040000.2, "dev": "shanegcam", "dir": "write", "keyword": "EXPOSURE", "data": "0.5"}
+
+Byte-strings are stored decoded as latin-1, so every byte, including the
+null noise characters, survives the round trip through JSON.
+
+The verbose options of the drivers also go through here. A record with
+echo=True is printed straight away, by the caller, so it comes out in
+order with everything else the script prints; only the file writing is
+left to the background thread.
+
+>>> import wire_log
+>>> wire_log.open_wire_log('qe_wire.jsonl')
+>>> # ... run a scan ...
+>>> wire_log.close_wire_log()
+"""
+
+
+import atexit
+import json
+import os
+import queue
+import threading
+from time import time
+
+
+class WireLog:
+    """
+    A background writer for wire records.
+
+    Parameters
+    ----------
+    filename: string or None
+        The JSON lines file to append to. If None, records are not stored,
+        only echoed.
+    max_bytes: int, optional
+        Rotate the file when it grows past this size. 0 never rotates.
+    backup_count: int, optional
+        How many rotated files to keep, as filename.1, filename.2, ...
+    max_queued: int, optional
+        The most records waiting to be written. If the writer falls this far
+        behind, new records are dropped and counted in the dropped
+        attribute, rather than slowing down the drivers.
+    """
+    def __init__(self, filename=None, max_bytes=10 * 1024 ** 2, backup_count=5,
+                 max_queued=100000):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.dropped = 0
+
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._file = None
+        # bytes in the file, counted as records are written
+        self._size = 0
+        self._thread = threading.Thread(target=self._run, name='WireLog', daemon=True)
+        self._thread.start()
+
+    def record(self, device, direction, data, echo=False, **fields):
+        """
+        Queue a record. Never blocks.
+
+        Parameters
+        ----------
+        device: string
+            Which device, e.g. 'w_lamp' or a ktl service name
+        direction: string
+            'send', 'recv', or 'write'
+        data: bytes or any
+            The byte-string on the wire, or the keyword value written
+        echo: bool, optional
+            If True, also print the record, like the drivers' verbose output
+        fields: optional
+            Extra fields for the record, e.g. keyword='EXPOSURE'
+
+        Returns
+        -------
+        None
+        """
+        if echo:
+            _echo(device, direction, data, fields)
+        if self.filename is None:
+            return
+        try:
+            self._queue.put_nowait((time(), device, direction, data, fields))
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self):
+        """
+        Block until every record queued so far has been written.
+
+        Returns
+        -------
+        None
+        """
+        self._queue.join()
+
+    def close(self):
+        """
+        Write the remaining records, and stop the background thread.
+
+        Returns
+        -------
+        None
+        """
+        self._queue.put(None)
+        self._thread.join()
+
+    def _open(self):
+        if self.filename is not None and self._file is None:
+            self._file = open(self.filename, 'a', encoding='utf-8')
+            self._size = self._file.tell()
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        for index in range(self.backup_count - 1, 0, -1):
+            older = '%s.%i' % (self.filename, index)
+            if os.path.exists(older):
+                os.replace(older, '%s.%i' % (self.filename, index + 1))
+        if self.backup_count > 0:
+            os.replace(self.filename, self.filename + '.1')
+        else:
+            os.remove(self.filename)
+        self._open()
+
+    def _write(self, item):
+        timestamp, device, direction, data, fields = item
+        if isinstance(data, (bytes, bytearray)):
+            text = bytes(data).decode('latin-1')
+        else:
+            text = str(data)
+
+        line = dict(t=timestamp, dev=device, dir=direction, data=text, **fields)
+        self._open()
+        # json.dumps escapes everything outside ascii, one character per byte
+        line = json.dumps(line, separators=(',', ':')) + '\n'
+        self._file.write(line)
+        self._size += len(line)
+        # rotate as soon as the file is full, even in the middle of a burst
+        if self.max_bytes and self._size >= self.max_bytes:
+            self._rotate()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    break
+                self._write(item)
+                # flush once the queue runs dry, so bursts are written in one go
+                if self._file is not None and self._queue.empty():
+                    self._file.flush()
+            except Exception as err:
+                # never let a logging problem take down the drivers
+                print('wire_log: could not write record:', err)
+            finally:
+                self._queue.task_done()
+
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+# the log the drivers write to, None until open_wire_log is called
+_active = None
+
+
+def _echo(device, direction, data, fields):
+    # the drivers' verbose output
+    if direction == 'send':
+        print('Command sent:', data)
+    elif direction == 'recv':
+        print('Reply received:', data)
+    else:
+        print(fields.get('keyword', device), data)
+
+
+def record(device, direction, data, echo=False, **fields):
+    """
+    Record wire traffic to the open wire log, if there is one.
+
+    This is what the drivers call. With no log open and echo False it
+    returns straight away.
+
+    Parameters are the same as WireLog.record.
+
+    Returns
+    -------
+    None
+    """
+    log = _active
+    if log is None:
+        if echo:
+            _echo(device, direction, data, fields)
+        return
+    log.record(device, direction, data, echo=echo, **fields)
+
+
+def open_wire_log(filename, **kwargs):
+    """
+    Start logging wire traffic from every driver to a file.
+
+    Parameters
+    ----------
+    filename: string
+        The JSON lines file to append to
+    kwargs: optional
+        Pass-through keyword arguments for WireLog, e.g. max_bytes
+
+    Returns
+    -------
+    instance of class WireLog
+    """
+    global _active
+    close_wire_log()
+    _active = WireLog(filename, **kwargs)
+    return _active
+
+
+def close_wire_log():
+    """
+    Write out and close the open wire log, if there is one.
+
+    Returns
+    -------
+    None
+    """
+    global _active
+    log, _active = _active, None
+    if log is not None:
+        log.close()
+
+
+# make sure queued records reach the disk
+atexit.register(close_wire_log)